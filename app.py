@@ -1,32 +1,175 @@
-from flask import Flask, request, render_template, send_file, jsonify
+from flask import Flask, request, render_template, send_file, jsonify, Response, g, has_request_context, stream_with_context
 import base64
 import io
+import contextlib
+import copy
 import os
 import json
 import logging
 from google.cloud import secretmanager
 from google.oauth2 import service_account
 from google.cloud import firestore
+from google.api_core.exceptions import AlreadyExists
 import csv
+import codecs
+import tempfile
+import shutil
+import mmap
+import collections
 import zipfile
-import locale
 import uuid
+import hashlib
+import struct
+import zlib
+import hmac
+import functools
+import re
+import unicodedata
 import qrcode
+import time
+import math
+import random
+import html
+import queue
+import smtplib
+import sqlite3
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from email.message import EmailMessage
+from email.utils import make_msgid
 from urllib.parse import quote_plus
-from datetime import datetime
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Data as MultipartData, Field as MultipartField, File as MultipartFile, Epilogue as MultipartEpilogue
+from datetime import datetime, timezone
 from PIL import Image, ImageDraw, ImageFont
-import logging
+import logging.handlers
+import atexit
+import sys
 
-# Configura o logger básico
-logging.basicConfig(
-    level=logging.INFO,  # Pode trocar para DEBUG se quiser mais detalhe
-    format='%(asctime)s [%(levelname)s] %(message)s'
-)
+##### Logging
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # Pode trocar para DEBUG se quiser mais detalhe
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" (Cloud Logging) ou "texto"
+LOG_DEBUG_AMOSTRAGEM = int(os.getenv("LOG_DEBUG_AMOSTRAGEM", 100))  # 1 a cada N eventos DEBUG por linha de código
+
+
+class JsonFormatter(logging.Formatter):
+    """Uma linha JSON por evento, no formato que o Cloud Logging entende (severity/message)."""
+
+    def format(self, record):
+        evento = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "logger": record.name,
+        }
+        campos = getattr(record, "campos", None)
+        if campos:
+            evento.update(campos)
+        excecao = getattr(record, "excecao", None) or (self.formatException(record.exc_info) if record.exc_info else None)
+        if excecao:
+            evento["exception"] = excecao
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+
+class TextoFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s [%(levelname)s] %(message)s')
+
+    def format(self, record):
+        texto = super().format(record)
+        campos = getattr(record, "campos", None)
+        if campos:
+            texto += " " + " ".join(f"{k}={v}" for k, v in campos.items())
+        excecao = getattr(record, "excecao", None)
+        if excecao:
+            texto += "\n" + excecao
+        return texto
+
+
+class FilaLogHandler(logging.handlers.QueueHandler):
+    """QueueHandler que guarda o traceback em record.excecao em vez de colá-lo na
+    mensagem (o prepare() padrão formata tudo junto e descarta exc_info), para o
+    JSON sair com o campo "exception" separado."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.excecao = logging.Formatter().formatException(record.exc_info) if record.exc_info else None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+
+class AmostragemDebugFilter(logging.Filter):
+    """Deixa passar só 1 a cada N eventos DEBUG de cada linha de código."""
+
+    def __init__(self, taxa):
+        super().__init__()
+        self.taxa = max(1, taxa)
+        self._contagem = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.taxa == 1:
+            return True
+        chave = (record.pathname, record.lineno)
+        with self._lock:
+            n = self._contagem.get(chave, 0)
+            self._contagem[chave] = n + 1
+        return n % self.taxa == 0
+
+
+_log_listener = None
+
+def configurar_logging():
+    """Logs vão para uma fila em memória e são escritos por uma thread própria,
+    então formatar/escrever nunca bloqueia a renderização. Também é chamada
+    nos processos do pool de renderização (a thread não sobrevive ao fork)."""
+    global _log_listener
+
+    if _log_listener is not None:
+        try:
+            _log_listener.stop()
+        except Exception:
+            pass
+
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextoFormatter())
+
+    fila = queue.SimpleQueue()
+    queue_handler = FilaLogHandler(fila)
+    queue_handler.addFilter(AmostragemDebugFilter(LOG_DEBUG_AMOSTRAGEM))
+
+    raiz = logging.getLogger()
+    for handler in list(raiz.handlers):
+        raiz.removeHandler(handler)
+    raiz.addHandler(queue_handler)
+    raiz.setLevel(LOG_LEVEL)
+
+    _log_listener = logging.handlers.QueueListener(fila, saida, respect_handler_level=True)
+    _log_listener.start()
+
+
+def _parar_logging():
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+configurar_logging()
+atexit.register(_parar_logging)
 
 # Cria o logger
 logger = logging.getLogger(__name__)
 
 
+def log_evento(nivel, evento, **campos):
+    """Evento estruturado: os campos viram chaves no JSON em vez de texto formatado."""
+    if logger.isEnabledFor(nivel):
+        logger.log(nivel, evento, extra={"campos": campos})
+
 
 app = Flask(__name__, static_folder="static")
 
@@ -35,20 +178,26 @@ db = None
 ### Inicializa Firestore
 def get_firestore_client():
     try:
-        print("🚀 Iniciando conexão com Firestore...")
+        logger.info("🚀 Iniciando conexão com Firestore...")
+        project_id = os.environ.get("GOOGLE_CLOUD_PROJECT") or "equilibrion-moodle"
+
+        # Com o emulador (gcloud emulators firestore start) não há credenciais
+        if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+            logger.info("🧪 Usando emulador do Firestore em %s", os.environ["FIRESTORE_EMULATOR_HOST"])
+            return firestore.Client(project=project_id)
+
         secret_client = secretmanager.SecretManagerServiceClient()
 
-        project_id = os.environ.get("GOOGLE_CLOUD_PROJECT") or "equilibrion-moodle"
         secret_name = "FIRESTORE_CREDENTIALS"
         version = "latest"
         secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/{version}"
 
-        print(f"🔐 Buscando secret: {secret_path}")
+        logger.info("🔐 Buscando secret: %s", secret_path)
 
         response = secret_client.access_secret_version(request={"name": secret_path})
         secret_payload = response.payload.data.decode("UTF-8")
 
-        print("✅ Secret recuperado com sucesso!")
+        logger.info("✅ Secret recuperado com sucesso!")
 
         service_account_info = json.loads(secret_payload)
 
@@ -56,11 +205,11 @@ def get_firestore_client():
 
         db = firestore.Client(credentials=credentials, project=project_id)
 
-        print("✅ Firestore inicializado e cliente criado!")
+        logger.info("✅ Firestore inicializado e cliente criado!")
         return db
 
     except Exception as e:
-        print(f"❌ Erro ao inicializar Firestore com Secret Manager: {e}")
+        logger.error("❌ Erro ao inicializar Firestore com Secret Manager: %s", e)
         return None
 
 
@@ -76,17 +225,178 @@ def get_secure_base_url():
     return f"{scheme}://{host}"
 
 
-db = get_firestore_client()
+### Firestore em memória (desenvolvimento, benchmarks e testes de carga)
+class _SnapshotMemoria:
+    def __init__(self, reference, dados):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = dados is not None
+        self._dados = dados
 
-if db:
-    print("✅ Cliente Firestore inicializado e pronto!")
-else:
-    print("❌ Firestore não inicializado!")
+    def to_dict(self):
+        return copy.deepcopy(self._dados) if self._dados is not None else None
+
+    def get(self, campo):
+        return (self._dados or {}).get(campo)
+
+
+class _DocumentoMemoria:
+    def __init__(self, colecao, doc_id):
+        self._colecao = colecao
+        self.id = doc_id
+
+    def get(self):
+        with self._colecao.lock:
+            return _SnapshotMemoria(self, copy.deepcopy(self._colecao.docs.get(self.id)))
+
+    def set(self, dados, merge=False):
+        with self._colecao.lock:
+            if merge and self.id in self._colecao.docs:
+                self._colecao.docs[self.id].update(copy.deepcopy(dados))
+            else:
+                self._colecao.docs[self.id] = copy.deepcopy(dados)
+
+    def create(self, dados):
+        with self._colecao.lock:
+            if self.id in self._colecao.docs:
+                raise AlreadyExists(f"Documento {self.id} já existe")
+            self._colecao.docs[self.id] = copy.deepcopy(dados)
+
+    def update(self, dados):
+        with self._colecao.lock:
+            if self.id not in self._colecao.docs:
+                raise KeyError(f"Documento {self.id} não existe")
+            self._colecao.docs[self.id].update(copy.deepcopy(dados))
+
+    def delete(self):
+        with self._colecao.lock:
+            self._colecao.docs.pop(self.id, None)
+
+
+class _ColecaoMemoria:
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def document(self, doc_id=None):
+        return _DocumentoMemoria(self, doc_id or uuid.uuid4().hex)
+
+    def stream(self):
+        with self.lock:
+            itens = list(self.docs.items())
+        return iter([_SnapshotMemoria(self.document(doc_id), copy.deepcopy(dados)) for doc_id, dados in itens])
+
+    def where(self, filter):
+        return _ConsultaMemoria(self).where(filter=filter)
+
+    def select(self, campos):
+        return _ConsultaMemoria(self).select(campos)
+
+
+class _ConsultaMemoria:
+    """where(filter=FieldFilter(...)) e select() sobre uma coleção em memória."""
+
+    _OPERADORES = {
+        "==": lambda a, b: a == b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+    }
+
+    def __init__(self, colecao, filtros=(), campos=None):
+        self._colecao = colecao
+        self._filtros = list(filtros)
+        self._campos = campos
+
+    def where(self, filter):
+        return _ConsultaMemoria(self._colecao, self._filtros + [filter], self._campos)
+
+    def select(self, campos):
+        return _ConsultaMemoria(self._colecao, self._filtros, list(campos))
+
+    def stream(self):
+        for snapshot in self._colecao.stream():
+            dados = snapshot.to_dict()
+            if not all(
+                f.field_path in dados and self._OPERADORES[f.op_string](dados[f.field_path], f.value)
+                for f in self._filtros
+            ):
+                continue
+            if self._campos is not None:
+                dados = {campo: dados[campo] for campo in self._campos if campo in dados}
+            yield _SnapshotMemoria(snapshot.reference, dados)
+
+
+class _LoteEscritaMemoria:
+    """WriteBatch em memória: acumula as escritas e aplica tudo no commit()."""
+
+    def __init__(self):
+        self._operacoes = []
+
+    def set(self, referencia, dados, merge=False):
+        self._operacoes.append(lambda: referencia.set(dados, merge=merge))
+
+    def update(self, referencia, dados):
+        self._operacoes.append(lambda: referencia.update(dados))
+
+    def commit(self):
+        for operacao in self._operacoes:
+            operacao()
+        self._operacoes = []
+
+
+class FirestoreEmMemoria:
+    """Substituto mínimo do cliente do Firestore, selecionado com FIRESTORE_BACKEND=memoria.
+
+    Implementa só o que o app usa (collection/document/get/set/create/stream/where/select/batch/
+    get_all); os dados vivem no processo e somem ao reiniciar.
+    """
+
+    def __init__(self):
+        self._colecoes = {}
+        self._lock = threading.Lock()
+
+    def collection(self, nome):
+        with self._lock:
+            return self._colecoes.setdefault(nome, _ColecaoMemoria())
+
+    def batch(self):
+        return _LoteEscritaMemoria()
+
+    def get_all(self, referencias, field_paths=None):
+        for referencia in referencias:
+            snapshot = referencia.get()
+            if field_paths is not None and snapshot.exists:
+                dados = snapshot.to_dict()
+                snapshot = _SnapshotMemoria(referencia, {campo: dados[campo] for campo in field_paths if campo in dados})
+            yield snapshot
+
+
+FIRESTORE_BACKEND = os.getenv("FIRESTORE_BACKEND", "firestore")
+
+
+def inicializar_firestore():
+    # Chamada por inicializar(): os workers do pool não abrem cliente gRPC próprio
+    global db
+    if FIRESTORE_BACKEND == "memoria":
+        logger.info("🧪 Usando Firestore em memória (FIRESTORE_BACKEND=memoria)")
+        db = FirestoreEmMemoria()
+    else:
+        db = get_firestore_client()
+
+    if db:
+        logger.info("✅ Cliente Firestore inicializado e pronto!")
+    else:
+        logger.error("❌ Firestore não inicializado!")
 
 UPLOAD_FOLDER = "uploads"
 OUTPUT_FOLDER = "generated_certificates"
+ARTEFATOS_FOLDER = os.getenv("ARTEFATOS_FOLDER", "certificados_renderizados")
+ARQUIVOS_TURMA_FOLDER = os.getenv("ARQUIVOS_TURMA_FOLDER", "arquivos_turmas")
 TEMPLATE_PATH = "static/certificate.png"
 SIGNATURE_PATH = "static/signature.png"
+CARD_SOCIAL_TAMANHO = (1200, 627)  # og:image no formato recomendado pelo LinkedIn
 
 # Inicializar Firestore
 #db = firestore.Client()
@@ -99,17 +409,452 @@ FONT_PATH = DEFAULT_FONT_PATH if os.path.exists(DEFAULT_FONT_PATH) else FALLBACK
 # Criar pastas se não existirem
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(ARTEFATOS_FOLDER, exist_ok=True)
+os.makedirs(ARQUIVOS_TURMA_FOLDER, exist_ok=True)
+
+##### Métricas
+
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metricas:
+    """Registro simples de contadores, gauges e histogramas no formato texto do Prometheus."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histogramas = {}
+        self._contadores = {}
+        self._gauges = {}
+        self._ajuda = {}
+
+    def descrever(self, nome, ajuda):
+        self._ajuda[nome] = ajuda
+
+    def observar(self, nome, valor, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histogramas.get(chave)
+            if hist is None:
+                hist = self._histogramas[chave] = [[0] * len(BUCKETS_LATENCIA), 0.0, 0]
+            for i, limite in enumerate(BUCKETS_LATENCIA):
+                if valor <= limite:
+                    hist[0][i] += 1
+            hist[1] += valor
+            hist[2] += 1
+
+    def incrementar(self, nome, valor=1, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def definir(self, nome, valor, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[chave] = valor
+
+    @contextlib.contextmanager
+    def medir(self, nome, **labels):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **labels)
+
+    @staticmethod
+    def _formatar_labels(labels, extra=None):
+        itens = list(labels) + ([extra] if extra else [])
+        if not itens:
+            return ""
+        corpo = ",".join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in itens
+        )
+        return "{" + corpo + "}"
+
+    def exportar(self):
+        with self._lock:
+            histogramas = {k: (list(v[0]), v[1], v[2]) for k, v in self._histogramas.items()}
+            contadores = dict(self._contadores)
+            gauges = dict(self._gauges)
+
+        linhas = []
+        for tipo, series in (("counter", contadores), ("gauge", gauges), ("histogram", histogramas)):
+            for nome in sorted({nome for nome, _ in series}):
+                if nome in self._ajuda:
+                    linhas.append(f"# HELP {nome} {self._ajuda[nome]}")
+                linhas.append(f"# TYPE {nome} {tipo}")
+                for (n, labels), valor in sorted(series.items()):
+                    if n != nome:
+                        continue
+                    if tipo != "histogram":
+                        linhas.append(f"{nome}{self._formatar_labels(labels)} {valor}")
+                        continue
+                    buckets, soma, total = valor
+                    for limite, qtd in zip(BUCKETS_LATENCIA, buckets):
+                        linhas.append(f"{nome}_bucket{self._formatar_labels(labels, ('le', limite))} {qtd}")
+                    linhas.append(f"{nome}_bucket{self._formatar_labels(labels, ('le', '+Inf'))} {total}")
+                    linhas.append(f"{nome}_sum{self._formatar_labels(labels)} {soma}")
+                    linhas.append(f"{nome}_count{self._formatar_labels(labels)} {total}")
+        return "\n".join(linhas) + "\n"
+
+
+metricas = Metricas()
+metricas.descrever("http_requisicao_segundos", "Duração das requisições HTTP por rota")
+metricas.descrever("certificado_estagio_segundos", "Duração de cada estágio da montagem do certificado")
+metricas.descrever("firestore_segundos", "Latência das operações no Firestore")
+metricas.descrever("render_fila_espera_segundos", "Tempo de espera na fila do pool de renderização")
+metricas.descrever("render_fila_profundidade", "Pedidos aguardando no pool de renderização")
+metricas.descrever("render_em_execucao", "Renderizações em andamento nos workers")
+metricas.descrever("cache_total", "Consultas aos caches por resultado (hit/miss)")
+metricas.descrever("render_rejeitados_total", "Renderizações interativas recusadas com 503")
+metricas.descrever("codigos_verificados_total", "Códigos verificados localmente por resultado")
+metricas.descrever("filtro_codigos_total", "Consultas ao filtro de códigos emitidos por resultado")
+metricas.descrever("filtro_codigos_itens", "Códigos no filtro de códigos emitidos")
+metricas.descrever("render_memoria_pico_bytes", "Maior memória somada ao worker por uma renderização")
+metricas.descrever("render_worker_rss_bytes", "Maior memória residente observada num worker de renderização")
+metricas.descrever("emails_total", "E-mails de certificado enviados por status final")
+metricas.descrever("fila_eventos_total", "Eventos de conclusão processados pela fila por resultado")
+metricas.descrever("fila_atraso_segundos", "Tempo entre a chegada do evento mais antigo de um lote e a emissão")
+metricas.descrever("fila_profundidade", "Eventos de conclusão na fila por status")
+metricas.descrever("fila_atraso_atual_segundos", "Idade do evento mais antigo ainda não emitido")
+
+# Estágios medidos dentro do worker de renderização são acumulados aqui e
+# devolvidos ao processo principal junto com os artefatos (ver _renderizar_artefatos_worker).
+_coletor_estagios = threading.local()
+
+
+def rota_atual():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return "fora_de_requisicao"
+
+
+@contextlib.contextmanager
+def medir_estagio(estagio):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao = time.perf_counter() - inicio
+        coletados = getattr(_coletor_estagios, "estagios", None)
+        if coletados is not None:
+            coletados.append((estagio, duracao))
+        else:
+            metricas.observar("certificado_estagio_segundos", duracao, rota=rota_atual(), estagio=estagio)
+
+        medida = getattr(_coletor_estagios, "memoria", None)
+        if medida is not None:
+            rss = rss_atual()
+            medida["rss_max"] = max(medida["rss_max"], rss)
+
 
-# Definir localidade para garantir o formato correto da data
 try:
-    locale.setlocale(locale.LC_TIME, 'pt_BR.utf8')
-except locale.Error:
+    _TAMANHO_PAGINA = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _TAMANHO_PAGINA = 4096
+
+
+def rss_atual():
+    """Memória residente do processo em bytes (0 onde /proc não existe)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _TAMANHO_PAGINA
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+@contextlib.contextmanager
+def medir_memoria():
+    # Amostra a memória residente ao fim de cada estágio: "pico" é o quanto a
+    # renderização somou ao processo e "rss_max" o tamanho total do worker
+    medida = {"inicial": rss_atual(), "rss_max": 0}
+    anterior = getattr(_coletor_estagios, "memoria", None)
+    _coletor_estagios.memoria = medida
+    try:
+        yield medida
+    finally:
+        _coletor_estagios.memoria = anterior
+        medida["rss_max"] = max(medida["rss_max"], medida["inicial"])
+        medida["pico"] = medida["rss_max"] - medida["inicial"]
+
+
+@contextlib.contextmanager
+def coletar_estagios():
+    anteriores = getattr(_coletor_estagios, "estagios", None)
+    _coletor_estagios.estagios = []
     try:
-        locale.setlocale(locale.LC_TIME, 'pt_BR')
-    except locale.Error:
-        print("Aviso: Não foi possível definir a localidade para português do Brasil.")
+        yield _coletor_estagios.estagios
+    finally:
+        _coletor_estagios.estagios = anteriores
+
+
+def somar_estagios(estagios):
+    # Estágios repetidos numa mesma renderização (ex.: text_draw) viram um único total
+    totais = {}
+    for estagio, duracao in estagios:
+        totais[estagio] = totais.get(estagio, 0.0) + duracao
+    return totais
+
+
+def registrar_estagios(estagios, rota):
+    for estagio, duracao in somar_estagios(estagios).items():
+        metricas.observar("certificado_estagio_segundos", duracao, rota=rota, estagio=estagio)
+
+
+### Acesso ao Firestore com medição de latência
+def buscar_documento(colecao, doc_id):
+    with metricas.medir("firestore_segundos", operacao="get", colecao=colecao):
+        return db.collection(colecao).document(doc_id).get()
+
+
+FIRESTORE_LEITURAS_POR_LOTE = 100
+
+
+def buscar_documentos(colecao, doc_ids, campos=None):
+    """{doc_id: snapshot} com get_all(), até 100 documentos por chamada (campos limita a projeção)."""
+    documentos = {}
+    doc_ids = list(doc_ids)
+    for inicio in range(0, len(doc_ids), FIRESTORE_LEITURAS_POR_LOTE):
+        referencias = [db.collection(colecao).document(doc_id) for doc_id in doc_ids[inicio:inicio + FIRESTORE_LEITURAS_POR_LOTE]]
+        with metricas.medir("firestore_segundos", operacao="get_all", colecao=colecao):
+            for snapshot in db.get_all(referencias, field_paths=campos):
+                documentos[snapshot.id] = snapshot
+    return documentos
+
+
+def gravar_documento(colecao, doc_id, dados):
+    with metricas.medir("firestore_segundos", operacao="set", colecao=colecao):
+        return db.collection(colecao).document(doc_id).set(dados)
+
+
+def criar_documento(colecao, doc_id, dados):
+    """Cria o documento só se ele ainda não existir (levanta AlreadyExists caso contrário)."""
+    with metricas.medir("firestore_segundos", operacao="create", colecao=colecao):
+        return db.collection(colecao).document(doc_id).create(dados)
+
+
+def atualizar_documento(colecao, doc_id, dados):
+    """Mescla os campos no documento (set com merge)."""
+    with metricas.medir("firestore_segundos", operacao="set", colecao=colecao):
+        return db.collection(colecao).document(doc_id).set(dados, merge=True)
+
+
+FIRESTORE_ESCRITAS_POR_LOTE = 500  # limite de operações por WriteBatch
+
+
+def atualizar_em_lotes(colecao, atualizacoes):
+    """Aplica {doc_id: campos} com update() em WriteBatches (um commit a cada 500 documentos)."""
+    itens = list(atualizacoes.items())
+    for inicio in range(0, len(itens), FIRESTORE_ESCRITAS_POR_LOTE):
+        lote = db.batch()
+        for doc_id, campos in itens[inicio:inicio + FIRESTORE_ESCRITAS_POR_LOTE]:
+            lote.update(db.collection(colecao).document(doc_id), campos)
+        with metricas.medir("firestore_segundos", operacao="batch", colecao=colecao):
+            lote.commit()
+
+
+def gravar_em_lotes(colecao, documentos):
+    """Grava {doc_id: dados} com set(merge=True) em WriteBatches (um commit a cada 500 documentos)."""
+    itens = list(documentos.items())
+    for inicio in range(0, len(itens), FIRESTORE_ESCRITAS_POR_LOTE):
+        lote = db.batch()
+        for doc_id, dados in itens[inicio:inicio + FIRESTORE_ESCRITAS_POR_LOTE]:
+            lote.set(db.collection(colecao).document(doc_id), dados, merge=True)
+        with metricas.medir("firestore_segundos", operacao="batch", colecao=colecao):
+            lote.commit()
+
+
+def registrar_cache(cache, hit):
+    metricas.incrementar("cache_total", cache=cache, resultado="hit" if hit else "miss")
+
+
+##### Fontes (cadeia de fallback por cobertura de glifos)
+
+# Fontes tentadas depois de FONT_PATH, na ordem, para caracteres que ela não tem
+# (CJK, árabe, hebraico...). Caminhos inexistentes são ignorados.
+FONTES_FALLBACK_PADRAO = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Bold.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSansArabic-Bold.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSansHebrew-Bold.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSansDevanagari-Bold.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSansThai-Bold.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansSymbols2-Regular.ttf",
+]
+FONTES_FALLBACK = [
+    caminho.strip()
+    for caminho in os.getenv("FONTES_FALLBACK", ",".join(FONTES_FALLBACK_PADRAO)).split(",")
+    if caminho.strip()
+]
+# Marcas combinantes, ZWJ e seletores de variação seguem a fonte do caractere anterior
+_CATEGORIAS_ACOMPANHANTES = {"Mn", "Me", "Cf"}
+
+
+def _cobertura_cmap(caminho):
+    """Bitset (um bit por code point) dos caracteres que a fonte mapeia para um glifo.
+
+    Lê direto a tabela cmap (subtabela de formato 12, ou 4 só para o BMP); em
+    coleções .ttc usa a primeira fonte.
+    """
+    with open(caminho, "rb") as f:
+        dados = f.read()
+
+    inicio_fonte = struct.unpack_from(">I", dados, 12)[0] if dados[:4] == b"ttcf" else 0
+    (num_tabelas,) = struct.unpack_from(">H", dados, inicio_fonte + 4)
+    cmap = None
+    for i in range(num_tabelas):
+        tag, _, deslocamento, _ = struct.unpack_from(">4sIII", dados, inicio_fonte + 12 + 16 * i)
+        if tag == b"cmap":
+            cmap = deslocamento
+            break
+    if cmap is None:
+        raise ValueError("fonte sem tabela cmap")
+
+    subtabelas = {}
+    for i in range(struct.unpack_from(">H", dados, cmap + 2)[0]):
+        plataforma, codificacao, deslocamento = struct.unpack_from(">HHI", dados, cmap + 4 + 8 * i)
+        if plataforma == 0 or (plataforma == 3 and codificacao in (1, 10)):
+            (formato,) = struct.unpack_from(">H", dados, cmap + deslocamento)
+            subtabelas.setdefault(formato, cmap + deslocamento)
+
+    bits = bytearray(0x110000 // 8)
+
+    def marcar(codepoint):
+        bits[codepoint >> 3] |= 1 << (codepoint & 7)
+
+    if 12 in subtabelas:
+        posicao = subtabelas[12]
+        (grupos,) = struct.unpack_from(">I", dados, posicao + 12)
+        for inicio, fim, glifo in struct.iter_unpack(">III", dados[posicao + 16:posicao + 16 + 12 * grupos]):
+            for codepoint in range(inicio + (glifo == 0), min(fim, 0x10FFFF) + 1):
+                marcar(codepoint)
+    elif 4 in subtabelas:
+        posicao = subtabelas[4]
+        (segmentos_x2,) = struct.unpack_from(">H", dados, posicao + 6)
+        fins = posicao + 14
+        inicios = fins + segmentos_x2 + 2
+        deltas = inicios + segmentos_x2
+        offsets = deltas + segmentos_x2
+        for s in range(0, segmentos_x2, 2):
+            (fim,) = struct.unpack_from(">H", dados, fins + s)
+            (inicio,) = struct.unpack_from(">H", dados, inicios + s)
+            (delta,) = struct.unpack_from(">H", dados, deltas + s)
+            (offset,) = struct.unpack_from(">H", dados, offsets + s)
+            for codepoint in range(inicio, min(fim, 0xFFFE) + 1):
+                if offset == 0:
+                    glifo = (codepoint + delta) & 0xFFFF
+                else:
+                    (glifo,) = struct.unpack_from(">H", dados, offsets + s + offset + 2 * (codepoint - inicio))
+                    glifo = (glifo + delta) & 0xFFFF if glifo else 0
+                if glifo:
+                    marcar(codepoint)
+    else:
+        raise ValueError("cmap sem subtabela Unicode de formato 4 ou 12")
+    return bits
+
+
+@functools.lru_cache(maxsize=128)
+def _fonte_truetype(caminho, tamanho):
+    return ImageFont.truetype(caminho, tamanho)
+
+
+class CadeiaFontes:
+    """Fontes em ordem de preferência, com a cobertura (cmap) de cada uma lida uma vez.
+
+    O texto é quebrado em trechos e cada trecho sai na primeira fonte que tem
+    seus caracteres. Escolher a fonte é consultar um bit por caractere, sem
+    renderizar nada. Caractere que nenhuma fonte cobre fica na principal.
+    """
+
+    def __init__(self, caminhos):
+        self.caminhos = []
+        self._coberturas = []
+        for caminho in caminhos:
+            if caminho in self.caminhos or not os.path.exists(caminho):
+                continue
+            try:
+                cobertura = _cobertura_cmap(caminho)
+            except Exception as e:
+                logger.warning("⚠️ Fonte %s ignorada: %s", caminho, e)
+                continue
+            self.caminhos.append(caminho)
+            self._coberturas.append(cobertura)
+        logger.debug("🔤 Cadeia de fontes: %s", self.caminhos)
+
+    def _indice_para(self, caractere):
+        codepoint = ord(caractere)
+        for indice, cobertura in enumerate(self._coberturas):
+            if cobertura[codepoint >> 3] >> (codepoint & 7) & 1:
+                return indice
+        return None
+
+    @staticmethod
+    def _acompanha_anterior(caractere):
+        return caractere.isspace() or unicodedata.category(caractere) in _CATEGORIAS_ACOMPANHANTES
+
+    def trechos(self, texto):
+        """[(indice_da_fonte, trecho)], juntando caracteres vizinhos da mesma fonte."""
+        trechos = []
+        for caractere in texto:
+            if trechos and self._acompanha_anterior(caractere):
+                indice = trechos[-1][0]
+            else:
+                indice = self._indice_para(caractere) or 0
+            if trechos and trechos[-1][0] == indice:
+                trechos[-1][1] += caractere
+            else:
+                trechos.append([indice, caractere])
+        return [(indice, trecho) for indice, trecho in trechos]
+
+    def sem_cobertura(self, texto):
+        """Caracteres que nenhuma fonte da cadeia tem (sairiam como quadrados)."""
+        return sorted({
+            caractere for caractere in texto
+            if not self._acompanha_anterior(caractere) and self._indice_para(caractere) is None
+        })
 
-def get_font_by_name_length(name):
+    def fonte(self, indice, tamanho):
+        if not self.caminhos:
+            raise FileNotFoundError("❌ Nenhuma fonte disponível encontrada!")
+        return _fonte_truetype(self.caminhos[indice], tamanho)
+
+    def largura(self, texto, tamanho):
+        """Avanço horizontal do texto, somando os trechos em cada fonte."""
+        return sum(self.fonte(indice, tamanho).getlength(trecho) for indice, trecho in self.trechos(texto))
+
+    def limites_horizontais(self, texto, tamanho):
+        """(esquerda, direita) da tinta do texto desenhado em x=0, como em textbbox."""
+        x = 0
+        esquerda = direita = 0
+        for i, (indice, trecho) in enumerate(self.trechos(texto)):
+            fonte = self.fonte(indice, tamanho)
+            caixa = fonte.getbbox(trecho)
+            if i == 0:
+                esquerda = caixa[0]
+            direita = x + caixa[2]
+            x += fonte.getlength(trecho)
+        return esquerda, direita
+
+    def desenhar(self, draw, xy, texto, tamanho, fill):
+        trechos = self.trechos(texto)
+        if len(trechos) <= 1:
+            draw.text(xy, texto, font=self.fonte(trechos[0][0] if trechos else 0, tamanho), fill=fill)
+            return
+
+        # Trechos em fontes diferentes compartilham a linha de base da fonte principal
+        x, y = xy
+        linha_base = y + self.fonte(0, tamanho).getmetrics()[0]
+        for indice, trecho in trechos:
+            fonte = self.fonte(indice, tamanho)
+            draw.text((x, linha_base), trecho, font=fonte, fill=fill, anchor="ls")
+            x += fonte.getlength(trecho)
+
+
+cadeia_fontes = CadeiaFontes([FONT_PATH] + FONTES_FALLBACK)
+
+
+def tamanho_fonte_nome(name, escala=1.0):
     length = len(name)
 
     if length <= 12:
@@ -121,22 +866,116 @@ def get_font_by_name_length(name):
     else:
         font_size = 30
 
-    print(f"✅ Nome: {name} (len: {length}) | Usando fonte de tamanho {font_size}")
+    font_size = max(1, round(font_size * escala))
+    logger.debug("✅ Nome: %s (len: %s) | Usando fonte de tamanho %s", name, length, font_size)
+    return font_size
+
+
+def get_font_by_name_length(name, escala=1.0):
+    return cadeia_fontes.fonte(0, tamanho_fonte_nome(name, escala))
+
+
+##### Idiomas dos certificados
+# Datas e rótulos vêm destas tabelas, não do locale do sistema: cada certificado
+# sai no idioma da sua turma, em qualquer thread, sem locale-gen no contêiner.
+
+IDIOMA_PADRAO = os.getenv("IDIOMA_PADRAO", "pt-BR")
+
+IDIOMAS = {
+    "pt-BR": {
+        "nome": "Português (Brasil)",
+        "meses": (
+            "janeiro", "fevereiro", "março", "abril", "maio", "junho",
+            "julho", "agosto", "setembro", "outubro", "novembro", "dezembro",
+        ),
+        "data": "{dia:02d} de {mes} de {ano}",
+        "turma": "Turma: {}",
+        "data_evento": "Data do evento: {}",
+        "carga_horaria": "Carga horária: {}h",
+        "codigo": "ID: {}",
+    },
+    "en": {
+        "nome": "English",
+        "meses": (
+            "January", "February", "March", "April", "May", "June",
+            "July", "August", "September", "October", "November", "December",
+        ),
+        "data": "{mes} {dia}, {ano}",
+        "turma": "Class: {}",
+        "data_evento": "Event date: {}",
+        "carga_horaria": "Workload: {}h",
+        "codigo": "ID: {}",
+    },
+    "es": {
+        "nome": "Español",
+        "meses": (
+            "enero", "febrero", "marzo", "abril", "mayo", "junio",
+            "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre",
+        ),
+        "data": "{dia} de {mes} de {ano}",
+        "turma": "Grupo: {}",
+        "data_evento": "Fecha del evento: {}",
+        "carga_horaria": "Carga horaria: {}h",
+        "codigo": "ID: {}",
+    },
+}
+
+# Mês por nome em qualquer idioma, para reescrever datas já gravadas (inclusive as
+# "10 de March de 2025" de contêineres sem o locale pt_BR)
+_MESES_POR_NOME = {
+    mes.casefold(): numero
+    for textos in IDIOMAS.values()
+    for numero, mes in enumerate(textos["meses"], 1)
+}
+_DATA_DIA_MES_ANO_RE = re.compile(r"^(\d{1,2}) de (\w+) de (\d{4})$")
+_DATA_MES_DIA_ANO_RE = re.compile(r"^(\w+) (\d{1,2}), (\d{4})$")
+
+
+def idioma_valido(idioma):
+    return idioma if idioma in IDIOMAS else IDIOMA_PADRAO
+
+
+def opcoes_idioma(selecionado):
+    return "".join(
+        f'<option value="{idioma}"{" selected" if idioma == selecionado else ""}>{textos["nome"]}</option>'
+        for idioma, textos in IDIOMAS.items()
+    )
+
+
+def textos_idioma(idioma):
+    return IDIOMAS[idioma_valido(idioma)]
+
+
+def formatar_data(data, idioma=None):
+    textos = textos_idioma(idioma)
+    return textos["data"].format(dia=data.day, mes=textos["meses"][data.month - 1], ano=data.year)
+
 
-    # Usa o caminho já definido anteriormente
-    if os.path.exists(DEFAULT_FONT_PATH):
-        font_path = DEFAULT_FONT_PATH
-    elif os.path.exists(FALLBACK_FONT_PATH):
-        font_path = FALLBACK_FONT_PATH
+def data_no_idioma(texto, idioma):
+    """Reescreve uma data de emissão gravada ("10 de março de 2025", "March 10, 2025"...)
+    no idioma pedido; texto que não é reconhecido volta como está."""
+    texto = (texto or "").strip()
+    encontrado = _DATA_DIA_MES_ANO_RE.match(texto)
+    if encontrado:
+        dia, mes, ano = encontrado.groups()
     else:
-        raise FileNotFoundError("❌ Nenhuma fonte disponível encontrada!")
-    
-    return ImageFont.truetype(font_path, font_size)
+        encontrado = _DATA_MES_DIA_ANO_RE.match(texto)
+        if not encontrado:
+            return texto
+        mes, dia, ano = encontrado.groups()
+
+    numero_mes = _MESES_POR_NOME.get(mes.casefold())
+    if numero_mes is None:
+        return texto
+    try:
+        return formatar_data(datetime(int(ano), numero_mes, int(dia)), idioma)
+    except ValueError:
+        return texto
 
 
 # Obter data atual formatada corretamente
-def get_current_date():
-    return datetime.now().strftime("%d de %B de %Y")
+def get_current_date(idioma=None):
+    return formatar_data(datetime.now(), idioma)
 
 # Garantir que a pasta de saída está vazia antes de gerar novos certificados
 def clear_output_folder():
@@ -146,52 +985,70 @@ def clear_output_folder():
             if os.path.isfile(file_path):
                 os.unlink(file_path)
         except Exception as e:
-            print(f"Erro ao limpar arquivo {file_path}: {e}")
+            logger.warning("Erro ao limpar arquivo %s: %s", file_path, e)
 
 # Função para salvar certificado no Firestore
-def save_certificate_to_firestore(
+def registro_certificado(
     nome,
     data_emissao,
     codigo,
     turma_nome=None,
     data_evento=None,
     nome_treinamento=None,
-    carga_horaria=None
+    carga_horaria=None,
+    turma_id=None,
+    template_id=None,
+    template_versao=None,
+    idioma=None
 ):
+    """Documento da coleção "certificados" com os dados obrigatórios e os opcionais presentes."""
+    certificado_data = {
+        'nome': nome,
+        'data_emissao': data_emissao,
+        'codigo': codigo,
+        'criado_em': datetime.now(timezone.utc)
+    }
+
+    # Adiciona as informações opcionais se estiverem disponíveis
+    if turma_id:
+        certificado_data['turma_id'] = turma_id
+    if turma_nome:
+        certificado_data['turma_nome'] = turma_nome
+    if data_evento:
+        certificado_data['data_evento'] = data_evento
+    if nome_treinamento:
+        certificado_data['nome_treinamento'] = nome_treinamento
+    if carga_horaria:
+        certificado_data['carga_horaria'] = carga_horaria
+    if template_id:
+        certificado_data['template_id'] = template_id
+        certificado_data['template_versao'] = template_versao
+    if idioma:
+        certificado_data['idioma'] = idioma
+    return certificado_data
+
+
+def save_certificate_to_firestore(nome, data_emissao, codigo, **dados):
     global db
 
     try:
-        logger.info(f"💾 Salvando certificado no Firestore: Nome={nome}, Código={codigo}")
+        logger.debug("💾 Salvando certificado no Firestore: Nome=%s, Código=%s", nome, codigo)
 
         if db is None:
             logger.error("❌ Firestore não inicializado!")
             return False
 
-        # Monta o dicionário com os dados obrigatórios
-        certificado_data = {
-            'nome': nome,
-            'data_emissao': data_emissao,
-            'codigo': codigo
-        }
-
-        # Adiciona as informações opcionais se estiverem disponíveis
-        if turma_nome:
-            certificado_data['turma_nome'] = turma_nome
-        if data_evento:
-            certificado_data['data_evento'] = data_evento
-        if nome_treinamento:
-            certificado_data['nome_treinamento'] = nome_treinamento
-        if carga_horaria:
-            certificado_data['carga_horaria'] = carga_horaria
+        certificado_data = registro_certificado(nome, data_emissao, codigo, **dados)
 
         # Salva ou atualiza no Firestore
-        db.collection("certificados").document(codigo).set(certificado_data)
+        gravar_documento("certificados", codigo, certificado_data)
+        filtro_codigos.adicionar(codigo)
 
-        logger.info(f"✅ Certificado salvo no Firestore com sucesso! Dados: {certificado_data}")
+        logger.debug("✅ Certificado salvo no Firestore com sucesso! Dados: %s", certificado_data)
         return True
 
     except Exception as e:
-        logger.error(f"❌ Erro ao salvar certificado no Firestore: {e}")
+        logger.error("❌ Erro ao salvar certificado no Firestore: %s", e)
         return False
 
 
@@ -214,7 +1071,7 @@ def gerar_qr_code(codigo, base_url=None):
     rota_validacao = "validar?codigo="
     url_validacao = f"{base_url}{rota_validacao}{codigo}"
 
-    print(f"✅ URL para QRCode gerada: {url_validacao}")
+    logger.debug("✅ URL para QRCode gerada: %s", url_validacao)
 
     qr = qrcode.QRCode(version=1, box_size=10, border=2)
     qr.add_data(url_validacao)
@@ -223,6 +1080,317 @@ def gerar_qr_code(codigo, base_url=None):
     qr_img = qr.make_image(fill_color="black", back_color="white").convert('RGB')
     return qr_img
 
+##### Buffers de renderização (economia de memória)
+
+# O template é decodificado uma vez por processo. Se o canal alfa não é usado (todo
+# pixel opaco), ele vira RGB: o PNG sai com 3 canais (menor e mais rápido de
+# codificar) e colar a assinatura não mexe mais em alfa. Na memória o Pillow guarda
+# RGB com 4 bytes por pixel, então o ganho de memória vem do reuso: os canvas são
+# reaproveitados e a renderização seguinte cola o template por cima do mesmo buffer
+# em vez de alocar ~11 MB de novo.
+RENDER_CANVAS_LIVRES = int(os.getenv("RENDER_CANVAS_LIVRES", 2))
+
+# Os pixels decodificados do template ficam num arquivo cru em memória compartilhada
+# (tmpfs), mapeado somente leitura por todos os processos: mais workers não
+# multiplicam a memória do template. Cada worker só copia para o próprio canvas.
+RENDER_TEMPLATE_COMPARTILHADO = os.getenv("RENDER_TEMPLATE_COMPARTILHADO", "1") == "1"
+RENDER_MEMORIA_COMPARTILHADA_DIR = os.getenv(
+    "RENDER_MEMORIA_COMPARTILHADA_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
+
+_assinaturas = {}
+_assinaturas_lock = threading.Lock()
+_canvas_livres = {}
+_canvas_lock = threading.Lock()
+
+
+def sem_alfa_se_opaco(imagem):
+    if imagem.mode == "RGBA" and imagem.getchannel("A").getextrema() == (255, 255):
+        return imagem.convert("RGB")
+    return imagem
+
+
+def _decodificar_template(caminho):
+    template = Image.open(caminho)
+    template.load()
+    if template.mode not in ("RGB", "RGBA"):
+        template = template.convert("RGBA")
+    return sem_alfa_se_opaco(template)
+
+
+def template_compartilhado(caminho):
+    """Template mapeado do arquivo cru em memória compartilhada (somente leitura).
+
+    O primeiro processo decodifica e grava o arquivo; os demais só mapeiam. O nome
+    leva tamanho e data do PNG, então trocar o template gera um arquivo novo (e o
+    da versão anterior é apagado; quem ainda o tem mapeado continua funcionando).
+    """
+    st = os.stat(caminho)
+    caminho_abs = os.path.abspath(caminho)
+    id_caminho = hashlib.sha1(caminho_abs.encode("utf-8")).hexdigest()[:8]
+    id_versao = hashlib.sha1(f"{caminho_abs}|{st.st_size}|{st.st_mtime_ns}".encode("utf-8")).hexdigest()[:12]
+    prefixo_caminho = f"certificado-template-{id_caminho}-"
+    prefixo = os.path.join(RENDER_MEMORIA_COMPARTILHADA_DIR, f"{prefixo_caminho}{id_versao}-")
+
+    arquivos = [nome for nome in os.listdir(RENDER_MEMORIA_COMPARTILHADA_DIR)
+                if nome.startswith(prefixo_caminho) and nome.endswith(".raw")]
+    existentes = [nome for nome in arquivos if nome.startswith(os.path.basename(prefixo))]
+    if existentes:
+        arquivo = os.path.join(RENDER_MEMORIA_COMPARTILHADA_DIR, existentes[0])
+        dimensoes, modo_raw = existentes[0][len(os.path.basename(prefixo)):-len(".raw")].split("-")
+        tamanho = tuple(int(n) for n in dimensoes.split("x"))
+    else:
+        decodificado = _decodificar_template(caminho)
+        # O Pillow guarda RGB com 4 bytes por pixel (RGBX): o arquivo já fica nesse layout
+        modo_raw = "RGBX" if decodificado.mode == "RGB" else "RGBA"
+        tamanho = decodificado.size
+        arquivo = f"{prefixo}{tamanho[0]}x{tamanho[1]}-{modo_raw}.raw"
+        temporario = f"{arquivo}.{uuid.uuid4().hex}.tmp"
+        with open(temporario, "wb") as f:
+            f.write(decodificado.tobytes("raw", modo_raw))
+        os.replace(temporario, arquivo)
+        decodificado.close()
+        logger.info("🧩 Template %s decodificado em %s", caminho, arquivo)
+
+        for nome in arquivos:
+            with contextlib.suppress(OSError):
+                os.unlink(os.path.join(RENDER_MEMORIA_COMPARTILHADA_DIR, nome))
+
+    with open(arquivo, "rb") as f:
+        mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Image.frombuffer(modo_raw, tamanho, mapa, "raw", modo_raw, 0, 1)
+
+
+def modo_canvas(template):
+    # O template compartilhado vem como RGBX (RGB com o byte de preenchimento explícito)
+    return "RGB" if template.mode in ("RGB", "RGBX") else template.mode
+
+
+def assinatura_redimensionada(tamanho):
+    with _assinaturas_lock:
+        assinatura = _assinaturas.get(tamanho)
+        registrar_cache("assinatura", assinatura is not None)
+        if assinatura is None:
+            with Image.open(SIGNATURE_PATH) as original:
+                assinatura = _assinaturas[tamanho] = original.convert("RGBA").resize(tamanho)
+        return assinatura
+
+
+def obter_canvas(template):
+    """Cópia do template para desenhar, reaproveitando um buffer liberado se houver."""
+    chave = (modo_canvas(template), template.size)
+    with _canvas_lock:
+        livres = _canvas_livres.get(chave)
+        canvas = livres.pop() if livres else None
+    registrar_cache("canvas", canvas is not None)
+    if canvas is None:
+        canvas = Image.new(*chave)
+    # Cópia direta dos pixels (RGBX e RGB têm o mesmo layout), sem conversão intermediária
+    canvas.im.paste(template.im, (0, 0) + template.size)
+    return canvas
+
+
+def liberar_canvas(canvas):
+    """Devolve o canvas para reuso; quem chama não pode mais usá-lo."""
+    if canvas is None:
+        return
+    chave = (canvas.mode, canvas.size)
+    with _canvas_lock:
+        livres = _canvas_livres.setdefault(chave, [])
+        if len(livres) < RENDER_CANVAS_LIVRES:
+            livres.append(canvas)
+            return
+    canvas.close()
+
+
+##### Registro de templates
+
+# templates.json: cada template tem um id e versões numeradas (versão -> PNG). A turma
+# guarda o id e a versão vigente quando foi criada e o certificado guarda os mesmos,
+# então remontar um certificado antigo usa exatamente o template com que ele saiu.
+TEMPLATES_ARQUIVO = os.getenv("TEMPLATES_ARQUIVO", "templates.json")
+TEMPLATES_CACHE_MB = int(os.getenv("TEMPLATES_CACHE_MB", 64))  # ~11 MB por template de 2000x1414
+# Ids decodificados antes do fork dos workers (vazio = só o template padrão)
+TEMPLATES_PREAQUECER = [t.strip() for t in os.getenv("TEMPLATES_PREAQUECER", "").split(",") if t.strip()]
+TEMPLATES_VERIFICAR_S = float(os.getenv("TEMPLATES_VERIFICAR_S", 2))  # intervalo entre checagens dos arquivos
+
+
+class RegistroTemplates:
+    """Templates por id e versão, decodificados sob demanda.
+
+    Os decodificados (e o que é derivado deles, como o rascunho reduzido e o fundo
+    do card social) ficam num LRU limitado pelo tamanho em memória. Se o PNG ou o
+    templates.json muda no disco, cada processo percebe pela data do arquivo e
+    recarrega na próxima renderização, inclusive os workers do pool, sem reinício.
+    """
+
+    def __init__(self, arquivo, limite_bytes):
+        self.arquivo = arquivo
+        self.limite_bytes = limite_bytes
+        self.padrao = None
+        self._versoes = {}    # id -> {versao: caminho}
+        self._nomes = {}      # id -> nome para exibição
+        self._manifesto_mtime = None
+        self._cache = collections.OrderedDict()  # (id, versao) -> entrada
+        self._bytes = 0
+        self._verificado_em = {}
+        self._lock = threading.RLock()
+        self._carregar_manifesto()
+
+    def _carregar_manifesto(self):
+        try:
+            mtime = os.stat(self.arquivo).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._versoes and mtime == self._manifesto_mtime:
+            return
+
+        # Sem manifesto vale só o template histórico
+        versoes, nomes, padrao = {"padrao": {1: TEMPLATE_PATH}}, {"padrao": "Padrão"}, "padrao"
+        if mtime is not None:
+            try:
+                with open(self.arquivo, encoding="utf-8") as f:
+                    manifesto = json.load(f)
+                versoes = {
+                    template_id: {int(versao): caminho for versao, caminho in dados["versoes"].items()}
+                    for template_id, dados in manifesto["templates"].items()
+                }
+                nomes = {template_id: dados.get("nome", template_id) for template_id, dados in manifesto["templates"].items()}
+                padrao = manifesto.get("padrao") or next(iter(versoes))
+                if padrao not in versoes or not all(versoes.values()):
+                    raise ValueError(f"template padrão '{padrao}' ausente ou template sem versões")
+            except (OSError, ValueError, KeyError, TypeError, AttributeError, StopIteration) as e:
+                logger.error("❌ Registro de templates %s inválido: %s", self.arquivo, e)
+                self._manifesto_mtime = mtime
+                if self._versoes:
+                    return
+                versoes, nomes, padrao = {"padrao": {1: TEMPLATE_PATH}}, {"padrao": "Padrão"}, "padrao"
+
+        if self._manifesto_mtime is not None:
+            logger.info("♻️ Registro de templates recarregado: %s", ", ".join(sorted(versoes)))
+        self._versoes, self._nomes, self.padrao = versoes, nomes, padrao
+        self._manifesto_mtime = mtime
+
+    def _hora_de_verificar(self, chave):
+        agora = time.monotonic()
+        if agora - self._verificado_em.get(chave, float("-inf")) < TEMPLATES_VERIFICAR_S:
+            return False
+        self._verificado_em[chave] = agora
+        return True
+
+    def resolver(self, template_id=None, versao=None):
+        """(id, versao, caminho). Sem id vale o padrão; sem versão, a mais recente."""
+        with self._lock:
+            if self._hora_de_verificar(self.arquivo):
+                self._carregar_manifesto()
+            if template_id not in self._versoes:
+                if template_id:
+                    logger.warning("⚠️ Template '%s' não está no registro, usando '%s'", template_id, self.padrao)
+                template_id, versao = self.padrao, None
+            versoes = self._versoes[template_id]
+            if versao is not None and int(versao) not in versoes:
+                logger.warning("⚠️ Template '%s' sem a versão %s, usando a mais recente", template_id, versao)
+                versao = None
+            versao = max(versoes) if versao is None else int(versao)
+            return template_id, versao, versoes[versao]
+
+    def listar(self):
+        """[(id, nome, versão mais recente)] para os formulários."""
+        with self._lock:
+            self.resolver()
+            return [(template_id, self._nomes[template_id], max(versoes)) for template_id, versoes in self._versoes.items()]
+
+    def _entrada(self, template_id, versao):
+        template_id, versao, caminho = self.resolver(template_id, versao)
+        chave = (template_id, versao)
+        entrada = self._cache.get(chave)
+
+        if entrada is not None and self._hora_de_verificar(chave):
+            try:
+                alterado = os.stat(caminho).st_mtime_ns != entrada["mtime"]
+            except OSError:
+                alterado = False  # arquivo sumiu: segue com o que já está decodificado
+            if alterado or caminho != entrada["caminho"]:
+                logger.info("♻️ Template %s v%s alterado no disco, recarregando", template_id, versao)
+                self._bytes -= self._cache.pop(chave)["bytes"]
+                entrada = None
+
+        registrar_cache("template", entrada is not None)
+        if entrada is None:
+            entrada = self._carregar(caminho)
+            self._cache[chave] = entrada
+            self._bytes += entrada["bytes"]
+            self._verificado_em[chave] = time.monotonic()
+        self._cache.move_to_end(chave)
+        self._limitar()
+        return entrada
+
+    def _carregar(self, caminho):
+        mtime = os.stat(caminho).st_mtime_ns
+        imagem = None
+        if RENDER_TEMPLATE_COMPARTILHADO:
+            try:
+                imagem = template_compartilhado(caminho)
+            except (OSError, ValueError) as e:
+                logger.warning("⚠️ Template compartilhado indisponível, decodificando no processo: %s", e)
+        if imagem is None:
+            imagem = _decodificar_template(caminho)
+        return {"imagem": imagem, "caminho": caminho, "mtime": mtime, "bytes": imagem.width * imagem.height * 4, "derivados": {}}
+
+    def _limitar(self):
+        # O mais recente sempre fica, mesmo que sozinho passe do limite
+        while self._bytes > self.limite_bytes and len(self._cache) > 1:
+            (template_id, versao), entrada = self._cache.popitem(last=False)
+            self._bytes -= entrada["bytes"]
+            logger.debug("🗑️ Template %s v%s saiu do cache", template_id, versao)
+
+    def obter(self, template_id=None, versao=None):
+        with self._lock:
+            return self._entrada(template_id, versao)["imagem"]
+
+    def derivado(self, cache, chave, construir, template_id=None, versao=None):
+        """Imagem derivada do template, guardada junto dele (e descartada quando ele é recarregado)."""
+        with self._lock:
+            entrada = self._entrada(template_id, versao)
+            imagem = entrada["derivados"].get(chave)
+            registrar_cache(cache, imagem is not None)
+            if imagem is None:
+                imagem = entrada["derivados"][chave] = construir(entrada["imagem"])
+                entrada["bytes"] += imagem.width * imagem.height * 4
+                self._bytes += imagem.width * imagem.height * 4
+                self._limitar()
+            return imagem
+
+    def preaquecer(self, ids=None):
+        for template_id in ids or [self.padrao]:
+            self.obter(template_id)
+        logger.info("🔥 Templates pré-aquecidos: %s (%s MB)", ", ".join(ids or [self.padrao]), self._bytes // (1024 * 1024))
+
+
+registro_templates = RegistroTemplates(TEMPLATES_ARQUIVO, TEMPLATES_CACHE_MB * 1024 * 1024)
+
+
+def template_decodificado(template_id=None, versao=None):
+    return registro_templates.obter(template_id, versao)
+
+
+def template_em_escala(escala, template_id=None, versao=None):
+    # Rascunhos (pré-visualização do lote) usam o template já reduzido, guardado por escala
+    def reduzir(original):
+        largura, altura = original.size
+        fator = round(1 / escala)
+        if abs(fator * escala - 1) < 1e-9:
+            # Redução por fator inteiro: bem mais rápida que resize()
+            template = original.reduce(fator)
+        else:
+            template = original.resize((max(1, round(largura * escala)), max(1, round(altura * escala))), Image.BILINEAR)
+        if template.mode != modo_canvas(template):
+            template = template.convert(modo_canvas(template))
+        return template
+
+    return registro_templates.derivado("template_rascunho", ("rascunho", escala), reduzir, template_id, versao)
+
+
 def montar_certificado_imagem(
     nome,
     data_emissao,
@@ -231,240 +1399,1492 @@ def montar_certificado_imagem(
     turma_nome=None,
     data_evento=None,
     nome_treinamento=None,
-    carga_horaria=None
+    carga_horaria=None,
+    escala=1.0,
+    template_id=None,
+    template_versao=None,
+    idioma=None
 ):
+    """Monta o certificado. Com escala < 1 gera um rascunho reduzido (sem QR Code
+    real, com fontes e posições proporcionais) muitas vezes mais barato, usado
+    na pré-visualização do lote."""
+    rascunho = escala != 1.0
+    textos = textos_idioma(idioma)
+
+    def px(valor):
+        return valor * escala if rascunho else valor
+
+    def tamanho_em_escala(tamanho):
+        return max(1, round(tamanho * escala))
+
+    def fonte(tamanho):
+        return cadeia_fontes.fonte(0, tamanho_em_escala(tamanho))
+
     try:
-        logger.info(f"🖼️ Iniciando montagem do certificado para {nome} (ID: {codigo})")
+        logger.debug("🖼️ Iniciando montagem do certificado para %s (ID: %s)", nome, codigo)
 
         # === Carrega o template ===
         try:
-            template = Image.open(TEMPLATE_PATH)
-            logger.info(f"✅ Template carregado com sucesso: {TEMPLATE_PATH}")
+            with medir_estagio("template_load"):
+                if rascunho:
+                    template = template_em_escala(escala, template_id, template_versao)
+                else:
+                    template = template_decodificado(template_id, template_versao)
+            logger.debug("✅ Template carregado com sucesso: %s v%s", template_id or "padrão", template_versao or "atual")
         except Exception as e:
-            logger.error(f"❌ Erro ao carregar o template: {e}")
+            logger.error("❌ Erro ao carregar o template: %s", e)
             return None
 
-        # === Carrega a assinatura ===
+        # === Carrega a assinatura (já no tamanho final) ===
         try:
-            signature = Image.open(SIGNATURE_PATH).convert("RGBA")
-            logger.info(f"✅ Assinatura carregada com sucesso: {SIGNATURE_PATH}")
+            with medir_estagio("signature_load"):
+                signature = assinatura_redimensionada((round(px(300)), round(px(100))))
+            logger.debug("✅ Assinatura carregada com sucesso: %s", SIGNATURE_PATH)
         except Exception as e:
-            logger.error(f"❌ Erro ao carregar a assinatura: {e}")
+            logger.error("❌ Erro ao carregar a assinatura: %s", e)
+            return None
+
+        # === Carrega as fontes ===
+        try:
+            with medir_estagio("font_load"):
+                tamanho_nome = tamanho_fonte_nome(nome, escala)
+                font_date = fonte(40)
+                font_hash = fonte(10)
+                font_info = fonte(20)
+                font_info_title = fonte(35)
+        except Exception as e:
+            logger.error("❌ Erro ao carregar as fontes: %s", e)
             return None
 
         # === Prepara a cópia do template para desenhar ===
-        certificate = template.copy()
+        with medir_estagio("canvas_copy"):
+            certificate = obter_canvas(template)
         draw = ImageDraw.Draw(certificate)
 
         # === NOME DO PARTICIPANTE ===
         try:
-            font_nome = get_font_by_name_length(nome)
+            with medir_estagio("text_draw"):
+                # Largura medida trecho a trecho, já com as fontes de fallback
+                esquerda, direita = cadeia_fontes.limites_horizontais(nome, tamanho_nome)
+                text_width = direita - esquerda
+                cert_width, _ = certificate.size
 
-            bbox = draw.textbbox((0, 0), nome, font=font_nome)
-            text_width = bbox[2] - bbox[0]
-            cert_width, _ = certificate.size
-            
-            offset_x = 200  # ➡️ Ajuste esse valor para calibrar
-            nome_x = (cert_width - text_width) / 2 + offset_x
-            nome_y = 650
+                offset_x = px(200)  # ➡️ Ajuste esse valor para calibrar
+                nome_x = (cert_width - text_width) / 2 + offset_x
+                nome_y = px(650)
 
-            logger.info(f"✍️ Desenhando nome: '{nome}' (Fonte: {font_nome.size}px) em x={nome_x}, y={nome_y}")
-            draw.text((nome_x, nome_y), nome, font=font_nome, fill="black")
+                logger.debug("✍️ Desenhando nome: '%s' (Fonte: %spx) em x=%s, y=%s", nome, tamanho_nome, nome_x, nome_y)
+                cadeia_fontes.desenhar(draw, (nome_x, nome_y), nome, tamanho_nome, "black")
 
         except Exception as e:
-            logger.error(f"❌ Erro ao desenhar o nome no certificado: {e}")
+            logger.error("❌ Erro ao desenhar o nome no certificado: %s", e)
             return None
 
         # === DATA DE EMISSÃO ===
         try:
-            font_date = ImageFont.truetype(FONT_PATH, 40)
-            draw.text((600, 1100), data_emissao, font=font_date, fill="black")
-            logger.info(f"🗓️ Data de emissão desenhada: {data_emissao}")
+            with medir_estagio("text_draw"):
+                draw.text((px(600), px(1100)), data_emissao, font=font_date, fill="black")
+            logger.debug("🗓️ Data de emissão desenhada: %s", data_emissao)
 
         except Exception as e:
-            logger.error(f"❌ Erro ao desenhar a data de emissão: {e}")
+            logger.error("❌ Erro ao desenhar a data de emissão: %s", e)
             return None
 
         # === ASSINATURA ===
         try:
-            signature_resized = signature.resize((300, 100))
-            certificate.paste(signature_resized, (1500, 1050), signature_resized)
-            logger.info("🖋️ Assinatura colada com sucesso!")
+            with medir_estagio("paste"):
+                certificate.paste(signature, (round(px(1500)), round(px(1050))), signature)
+            logger.debug("🖋️ Assinatura colada com sucesso!")
 
         except Exception as e:
-            logger.error(f"❌ Erro ao colar a assinatura: {e}")
+            logger.error("❌ Erro ao colar a assinatura: %s", e)
             return None
 
         # === CÓDIGO/ID ===
         try:
-            font_hash = ImageFont.truetype(FONT_PATH, 10)
-            codigo_texto = f"ID: {codigo}"
-            draw.text((50, 1400), codigo_texto, font=font_hash, fill="black")
-            logger.info(f"🔐 Código desenhado: {codigo_texto}")
+            codigo_texto = textos["codigo"].format(codigo)
+            with medir_estagio("text_draw"):
+                draw.text((px(50), px(1400)), codigo_texto, font=font_hash, fill="black")
+            logger.debug("🔐 Código desenhado: %s", codigo_texto)
 
         except Exception as e:
-            logger.error(f"❌ Erro ao desenhar o código/ID: {e}")
+            logger.error("❌ Erro ao desenhar o código/ID: %s", e)
             return None
 
         # === QR CODE ===
         try:
-            qr_img = gerar_qr_code(codigo, base_url)
-            qr_size = 150
-            qr_resized = qr_img.resize((qr_size, qr_size))
-
+            qr_size = round(px(150))
             cert_width, cert_height = certificate.size
-            qr_x = cert_width - qr_size - 50
-            qr_y = cert_height - qr_size - 50
-
-            certificate.paste(qr_resized, (qr_x, qr_y))
-            logger.info(f"📲 QR Code colado na posição x={qr_x}, y={qr_y}")
+            qr_x = cert_width - qr_size - round(px(50))
+            qr_y = cert_height - qr_size - round(px(50))
+
+            if rascunho:
+                # No rascunho só marcamos onde o QR Code vai ficar
+                draw.rectangle((qr_x, qr_y, qr_x + qr_size, qr_y + qr_size), outline="gray", width=1)
+            else:
+                with medir_estagio("qr_generate"):
+                    qr_img = gerar_qr_code(codigo, base_url)
+                    qr_resized = qr_img.resize((qr_size, qr_size))
+                    qr_img.close()
+
+                with medir_estagio("paste"):
+                    certificate.paste(qr_resized, (qr_x, qr_y))
+                    qr_resized.close()
+            logger.debug("📲 QR Code colado na posição x=%s, y=%s", qr_x, qr_y)
 
         except Exception as e:
-            logger.error(f"❌ Erro ao gerar ou colar o QR Code: {e}")
+            logger.error("❌ Erro ao gerar ou colar o QR Code: %s", e)
             return None
 
-        # === INFORMAÇÕES ADICIONAIS ===
         # === INFORMAÇÕES ADICIONAIS ===
         try:
-            font_info = ImageFont.truetype(FONT_PATH, 20)
-            font_info_title = ImageFont.truetype(FONT_PATH, 35)
-
-            # 🔹 Parte 1: Informações que ficam no laço (Turma e Data do Evento)
-            info_lines = []
-            if turma_nome:
-                info_lines.append(f"Turma: {turma_nome}")
-            if data_evento:
-                info_lines.append(f"Data do evento: {data_evento}")
-
-            info_x = 50
-            start_y = 1320  # Começa antes para dar espaço
-            line_height = 25
-
-            for i, line in enumerate(info_lines):
-                y = start_y + i * line_height
-                draw.text((info_x, y), line, font=font_info, fill="black")
-                logger.info(f"📝 Informação adicional desenhada: {line} em x={info_x}, y={y}")
-
-            # 🔹 Parte 2: Nome do treinamento (posição personalizada)
-            if nome_treinamento:
-                treinamento_x = 600  # ➡️ Altere conforme o template
-                treinamento_y = 900  # ➡️ Altere conforme o template
-                treinamento_text = f"{nome_treinamento}"
-                draw.text((treinamento_x, treinamento_y), treinamento_text, font=font_info_title, fill="black")
-                logger.info(f"📝 Nome do treinamento desenhado: {treinamento_text} em x={treinamento_x}, y={treinamento_y}")
-
-            # 🔹 Parte 3: Carga horária (posição personalizada)
-            if carga_horaria:
-                carga_x = 600  # ➡️ Altere conforme o template
-                carga_y = 1380  # ➡️ Altere conforme o template
-                carga_text = f"Carga horária: {carga_horaria}h"
-                draw.text((carga_x, carga_y), carga_text, font=font_info, fill="black")
-                logger.info(f"📝 Carga horária desenhada: {carga_text} em x={carga_x}, y={carga_y}")
+            with medir_estagio("text_draw"):
+                # 🔹 Parte 1: Informações que ficam no laço (Turma e Data do Evento)
+                info_lines = []
+                if turma_nome:
+                    info_lines.append(textos["turma"].format(turma_nome))
+                if data_evento:
+                    info_lines.append(textos["data_evento"].format(data_evento))
+
+                info_x = px(50)
+                start_y = px(1320)  # Começa antes para dar espaço
+                line_height = px(25)
+
+                for i, line in enumerate(info_lines):
+                    y = start_y + i * line_height
+                    cadeia_fontes.desenhar(draw, (info_x, y), line, font_info.size, "black")
+                    logger.debug("📝 Informação adicional desenhada: %s em x=%s, y=%s", line, info_x, y)
+
+                # 🔹 Parte 2: Nome do treinamento (posição personalizada)
+                if nome_treinamento:
+                    treinamento_x = px(600)  # ➡️ Altere conforme o template
+                    treinamento_y = px(900)  # ➡️ Altere conforme o template
+                    treinamento_text = f"{nome_treinamento}"
+                    cadeia_fontes.desenhar(draw, (treinamento_x, treinamento_y), treinamento_text, font_info_title.size, "black")
+                    logger.debug("📝 Nome do treinamento desenhado: %s em x=%s, y=%s", treinamento_text, treinamento_x, treinamento_y)
+
+                # 🔹 Parte 3: Carga horária (posição personalizada)
+                if carga_horaria:
+                    carga_x = px(600)  # ➡️ Altere conforme o template
+                    carga_y = px(1380)  # ➡️ Altere conforme o template
+                    carga_text = textos["carga_horaria"].format(carga_horaria)
+                    cadeia_fontes.desenhar(draw, (carga_x, carga_y), carga_text, font_info.size, "black")
+                    logger.debug("📝 Carga horária desenhada: %s em x=%s, y=%s", carga_text, carga_x, carga_y)
 
         except Exception as e:
-            logger.error(f"❌ Erro ao desenhar informações adicionais: {e}")
+            logger.error("❌ Erro ao desenhar informações adicionais: %s", e)
             return None
 
-        logger.info(f"🎉 Certificado montado com sucesso para {nome}!")
+        logger.debug("🎉 Certificado montado com sucesso para %s!", nome)
         return certificate
 
     except Exception as e:
-        logger.error(f"❌ Erro inesperado ao montar certificado: {e}")
+        logger.error("❌ Erro inesperado ao montar certificado: %s", e)
         return None
 
 
+##### Pool de renderização
 
-def generate_certificate_for_student(
-    name,
-    base_url,
-    nome_turma=None,
-    data_evento=None,
-    nome_treinamento=None,
-    carga_horaria=None
-):
-    try:
-        logger.info(f"🚀 Iniciando geração de certificado para estudante: {name}")
+# Prioridades da fila (menor = atendido primeiro)
+PRIORIDADE_INTERATIVA = 0
+PRIORIDADE_LOTE = 10
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+# Orçamento de memória para a renderização (0 = sem limite). Com ele definido, o
+# número de workers é limitado a quantos cabem no orçamento.
+RENDER_MEMORIA_MB = int(os.getenv("RENDER_MEMORIA_MB", 0))
+RENDER_MEMORIA_BASE_MB = int(os.getenv("RENDER_MEMORIA_BASE_MB", 40))  # interpretador + bibliotecas por worker
+RENDER_MAX_FILA = int(os.getenv("RENDER_MAX_FILA", 8))
+RENDER_RETRY_AFTER = int(os.getenv("RENDER_RETRY_AFTER", 5))
+# forkserver/spawn: os workers nascem de um processo limpo, sem o cliente gRPC do
+# Firestore nem as threads do processo principal (fork não é seguro com elas)
+RENDER_START_METHOD = os.getenv(
+    "RENDER_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def estimar_memoria_worker():
+    """Memória de renderização em bytes (estimativa conservadora): (por_worker, compartilhada)."""
+    with Image.open(registro_templates.resolver()[2]) as template:  # só lê o cabeçalho
+        largura, altura = template.size
+    canvas = largura * altura * 4  # o Pillow usa 4 bytes por pixel em RGB e RGBA
+    por_worker = (
+        RENDER_MEMORIA_BASE_MB * 1024 * 1024
+        + canvas                                          # canvas
+        + canvas // 4                                     # prévia web (metade em cada eixo)
+        + CARD_SOCIAL_TAMANHO[0] * CARD_SOCIAL_TAMANHO[1] * 4 * 2  # fundo + card
+        + canvas // 2                                     # PNG codificado (pior caso)
+    )
+    # Conta os templates pré-aquecidos (os demais entram sob demanda, até TEMPLATES_CACHE_MB).
+    # Compartilhados contam uma vez só; sem isso, cada worker tem a sua cópia.
+    templates = canvas * max(1, len(TEMPLATES_PREAQUECER))
+    if RENDER_TEMPLATE_COMPARTILHADO:
+        return por_worker, templates
+    return por_worker + templates, 0
+
+
+def workers_no_orcamento(workers, orcamento_mb):
+    if not orcamento_mb or workers <= 0:
+        return workers
+    por_worker, compartilhada = estimar_memoria_worker()
+    cabem = max(1, (orcamento_mb * 1024 * 1024 - compartilhada) // por_worker)
+    if cabem < workers:
+        logger.info(
+            "💾 Orçamento de %s MB comporta %s worker(s) de ~%s MB (pedidos: %s)",
+            orcamento_mb, cabem, por_worker // (1024 * 1024), workers
+        )
+    return min(workers, cabem)
+
+
+RENDER_WORKERS = workers_no_orcamento(RENDER_WORKERS, RENDER_MEMORIA_MB)
 
-        # Tenta abrir o template
+
+class RenderPoolSaturado(Exception):
+    """Fila de renderização interativa cheia; o cliente deve tentar mais tarde."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Fila de renderização cheia (retry em {retry_after}s)")
+        self.retry_after = retry_after
+
+
+def _iniciar_worker():
+    # Initializer dos processos do pool: logging próprio e templates já decodificados
+    configurar_logging()
+    registro_templates.preaquecer(TEMPLATES_PREAQUECER)
+
+
+def _renderizar_artefatos_worker(dados):
+    # Executa no processo do pool: monta o certificado uma vez e já devolve todos os
+    # artefatos codificados ({tipo: bytes}), assim só bytes atravessam a fronteira
+    # entre processos.
+    # Os tempos de cada estágio e o pico de memória voltam junto para serem registrados
+    # no processo principal.
+    with coletar_estagios() as estagios, medir_memoria() as memoria:
+        certificate = montar_certificado_imagem(**dados)
+        if certificate is None:
+            return None, estagios, memoria
+
+        artefatos = {}
+        try:
+            with medir_estagio("png_encode"):
+                img_io = io.BytesIO()
+                certificate.save(img_io, 'PNG')
+                artefatos["png"] = img_io.getvalue()
+                img_io.close()
+
+            with medir_estagio("web_encode"):
+                previa = montar_previa_web(certificate)
+                artefatos["web"] = codificar_jpeg(previa)
+                if previa is not certificate:
+                    previa.close()
+        finally:
+            liberar_canvas(certificate)
+
+        with medir_estagio("social_encode"):
+            card = montar_card_social(**dados_card_social(dados))
+            artefatos["social"] = codificar_jpeg(card)
+            card.close()
+    return artefatos, estagios, memoria
+
+
+def _renderizar_card_social_worker(dados):
+    # Só o card 1200x627: usado quando falta apenas ele no armazém
+    with coletar_estagios() as estagios:
+        with medir_estagio("social_encode"):
+            conteudo = codificar_jpeg(montar_card_social(**dados_card_social(dados)))
+    return conteudo, estagios
+
+
+class RenderPool:
+    """Executor de renderização com fila limitada e prioridade.
+
+    Os pedidos entram numa fila de prioridade e são despachados por uma thread
+    por worker para um ProcessPoolExecutor; com RENDER_WORKERS=0 a renderização
+    acontece na própria thread despachante (útil em desenvolvimento).
+    Pedidos interativos acima de RENDER_MAX_FILA são rejeitados com
+    RenderPoolSaturado; pedidos de lote nunca são rejeitados, só esperam.
+    """
+
+    def __init__(self, workers, max_fila, retry_after, start_method):
+        self.workers = workers
+        self.max_fila = max_fila
+        self.retry_after = retry_after
+
+        self._fila = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+        self._na_fila = {PRIORIDADE_INTERATIVA: 0, PRIORIDADE_LOTE: 0}
+        self._em_execucao = 0
+        self._concluidos = 0
+        self._rejeitados = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+
+        self._executor = None
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=_iniciar_worker
+            )
+
+        for i in range(max(workers, 1)):
+            t = threading.Thread(target=self._despachar, name=f"render-dispatch-{i}", daemon=True)
+            t.start()
+
+    def submit(self, fn, *args, prioridade=PRIORIDADE_INTERATIVA):
+        with self._lock:
+            if prioridade == PRIORIDADE_INTERATIVA and self._na_fila[prioridade] >= self.max_fila:
+                self._rejeitados += 1
+                metricas.incrementar("render_rejeitados_total")
+                raise RenderPoolSaturado(self.retry_after)
+            self._na_fila[prioridade] = self._na_fila.get(prioridade, 0) + 1
+
+        future = Future()
+        self._fila.put((prioridade, next(self._seq), time.monotonic(), future, fn, args))
+        return future
+
+    def render(self, fn, *args, prioridade=PRIORIDADE_INTERATIVA):
+        return self.submit(fn, *args, prioridade=prioridade).result()
+
+    def _despachar(self):
+        while True:
+            prioridade, _, enfileirado_em, future, fn, args = self._fila.get()
+            espera = time.monotonic() - enfileirado_em
+
+            with self._lock:
+                self._na_fila[prioridade] -= 1
+                self._em_execucao += 1
+                self._espera_total += espera
+                self._espera_max = max(self._espera_max, espera)
+            metricas.observar("render_fila_espera_segundos", espera, prioridade=self._nome_prioridade(prioridade))
+
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if self._executor is not None:
+                        resultado = self._executor.submit(fn, *args).result()
+                    else:
+                        resultado = fn(*args)
+                    future.set_result(resultado)
+                except BaseException as e:
+                    future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._em_execucao -= 1
+                    self._concluidos += 1
+
+    @staticmethod
+    def _nome_prioridade(prioridade):
+        return "interativa" if prioridade == PRIORIDADE_INTERATIVA else "lote"
+
+    def stats(self):
+        with self._lock:
+            atendidos = self._concluidos + self._em_execucao
+            return {
+                "workers": self.workers,
+                "max_fila": self.max_fila,
+                "fila_interativa": self._na_fila[PRIORIDADE_INTERATIVA],
+                "fila_lote": self._na_fila[PRIORIDADE_LOTE],
+                "em_execucao": self._em_execucao,
+                "concluidos": self._concluidos,
+                "rejeitados": self._rejeitados,
+                "espera_media_s": (self._espera_total / atendidos) if atendidos else 0.0,
+                "espera_max_s": self._espera_max,
+            }
+
+
+render_pool = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool():
+    # Criado sob demanda para não iniciar processos durante o import do módulo
+    global render_pool
+    with _render_pool_lock:
+        if render_pool is None:
+            # O processo principal também monta imagens (prévias, RENDER_WORKERS=0)
+            registro_templates.preaquecer(TEMPLATES_PREAQUECER)
+            render_pool = RenderPool(RENDER_WORKERS, RENDER_MAX_FILA, RENDER_RETRY_AFTER, RENDER_START_METHOD)
+            logger.info("⚙️ Pool de renderização iniciado com %s worker(s), fila máxima %s", RENDER_WORKERS, RENDER_MAX_FILA)
+        return render_pool
+
+
+_memoria_maxima = {"pico": 0, "rss_max": 0}
+_memoria_aviso_dado = False
+
+
+def registrar_memoria(memoria):
+    global _memoria_aviso_dado
+    _memoria_maxima["pico"] = max(_memoria_maxima["pico"], memoria["pico"])
+    _memoria_maxima["rss_max"] = max(_memoria_maxima["rss_max"], memoria["rss_max"])
+    metricas.definir("render_memoria_pico_bytes", _memoria_maxima["pico"])
+    metricas.definir("render_worker_rss_bytes", _memoria_maxima["rss_max"])
+
+    # O orçamento usa uma estimativa; se a medida real passar dela, avisa uma vez
+    if RENDER_MEMORIA_MB and RENDER_WORKERS and not _memoria_aviso_dado:
+        if memoria["rss_max"] * RENDER_WORKERS > RENDER_MEMORIA_MB * 1024 * 1024:
+            _memoria_aviso_dado = True
+            logger.warning(
+                "⚠️ Worker de renderização com %s MB: %s workers passam do orçamento de %s MB",
+                memoria["rss_max"] // (1024 * 1024), RENDER_WORKERS, RENDER_MEMORIA_MB
+            )
+
+
+def renderizar_artefatos(prioridade=PRIORIDADE_INTERATIVA, **dados):
+    """Renderiza o certificado no pool e devolve {tipo: bytes} (ou None em caso de falha)."""
+    return enviar_artefatos(prioridade=prioridade, **dados).result()
+
+
+def enviar_artefatos(prioridade=PRIORIDADE_LOTE, **dados):
+    """Versão assíncrona de renderizar_artefatos, usada pelo lote."""
+    rota = rota_atual()
+    interno = get_render_pool().submit(_renderizar_artefatos_worker, dados, prioridade=prioridade)
+    externo = Future()
+
+    def concluir(f):
+        try:
+            artefatos, estagios, memoria = f.result()
+        except BaseException as e:
+            externo.set_exception(e)
+            return
+        registrar_estagios(estagios, rota)
+        registrar_memoria(memoria)
+
+        # Um único evento por certificado, com o tempo de cada estágio
+        log_evento(
+            logging.INFO if artefatos else logging.ERROR,
+            "certificado_renderizado" if artefatos else "certificado_falhou",
+            codigo=dados.get("codigo"),
+            rota=rota,
+            bytes={tipo: len(conteudo) for tipo, conteudo in artefatos.items()} if artefatos else 0,
+            memoria_pico_mb=round(memoria["pico"] / (1024 * 1024), 1),
+            worker_rss_mb=round(memoria["rss_max"] / (1024 * 1024), 1),
+            estagios_ms={estagio: round(duracao * 1000, 2) for estagio, duracao in somar_estagios(estagios).items()},
+        )
+        externo.set_result(artefatos)
+
+    interno.add_done_callback(concluir)
+    return externo
+
+
+##### Códigos dos certificados
+
+# Códigos novos são curtos (9 caracteres, ver AlocadorCodigos): um número de
+# sequência único, embaralhado e com dígito verificador. Com CODIGO_FORMATO=aleatorio
+# volta o formato anterior: com CODIGO_SEGREDO definido, o código leva um HMAC
+# truncado do próprio identificador e dá para saber em microssegundos, sem ler o
+# Firestore, se foi emitido por nós. Os códigos antigos (16 primeiros caracteres de
+# um UUID4) e os assinados continuam válidos.
+CODIGO_FORMATO = os.getenv("CODIGO_FORMATO", "curto")  # "curto" ou "aleatorio"
+CODIGO_SEGREDO = os.getenv("CODIGO_SEGREDO")
+# Segredos anteriores, separados por vírgula, aceitos na verificação (rotação de chave)
+CODIGO_SEGREDOS_ANTIGOS = [segredo for segredo in os.getenv("CODIGO_SEGREDOS_ANTIGOS", "").split(",") if segredo]
+# Validação rápida: código assinado válido já é confirmado como autêntico sem consultar o
+# Firestore (um certificado apagado continuaria aparecendo como autêntico nesse modo)
+VALIDACAO_RAPIDA = os.getenv("VALIDACAO_RAPIDA", "0") == "1"
+
+CODIGO_ID_BYTES = 10   # 16 caracteres em base32
+CODIGO_MAC_BYTES = 5   # 8 caracteres em base32 (40 bits)
+
+# Números de sequência reservados por vez; o que sobra de um bloco quando a instância
+# reinicia é descartado (2^40 números dão para um bilhão de blocos). Não é configurável:
+# o bloco n cobre [n * CODIGO_BLOCO, (n + 1) * CODIGO_BLOCO), e um tamanho diferente
+# (outra instância no meio de um deploy, ou uma troca de valor) sobreporia faixas já
+# reservadas e repetiria códigos.
+CODIGO_BLOCO = 1000
+# Chave da permutação que embaralha a sequência (o código não revela a ordem de emissão).
+# Não mude depois de emitir: outra chave leva os próximos números a códigos já usados.
+CODIGO_CURTO_CHAVE = os.getenv("CODIGO_CURTO_CHAVE", "certificados:codigo-curto:v1")
+CODIGO_CURTO_BITS = 40  # 8 caracteres em base32
+
+# Base32 de Crockford: sem I, L, O e U, que se confundem com 1, 0 e V ao digitar
+_ALFABETO_CODIGO = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_CONFUSOES_CODIGO = str.maketrans({"O": "0", "I": "1", "L": "1"})
+
+_CODIGO_LEGADO_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{2}$")
+_CODIGO_ASSINADO_RE = re.compile(r"^[a-z2-7]{24}$")
+_CODIGO_CURTO_RE = re.compile(r"^[0-9A-HJKMNP-TV-Z]{9}$")
+
+
+def _base32(dados):
+    return base64.b32encode(dados).decode("ascii").rstrip("=").lower()
+
+
+def _mac_codigo(segredo, identificador):
+    mac = hmac.new(segredo.encode("utf-8"), f"certificado:v1:{identificador}".encode("ascii"), hashlib.sha256)
+    return _base32(mac.digest()[:CODIGO_MAC_BYTES])
+
+
+def _embaralhar(numero):
+    # Rede de Feistel de 4 rodadas sobre 40 bits: uma permutação, então números
+    # distintos sempre dão códigos distintos
+    metade = CODIGO_CURTO_BITS // 2
+    mascara = (1 << metade) - 1
+    esquerda, direita = numero >> metade, numero & mascara
+    for rodada in range(4):
+        f = hmac.new(CODIGO_CURTO_CHAVE.encode("utf-8"), f"{rodada}:{direita}".encode("ascii"), hashlib.sha256)
+        esquerda, direita = direita, esquerda ^ (int.from_bytes(f.digest()[:4], "big") & mascara)
+    return (esquerda << metade) | direita
+
+
+def _digito_verificador(corpo):
+    # Luhn mod 32: pega qualquer caractere trocado e quase toda inversão de vizinhos
+    fator, soma = 2, 0
+    for caractere in reversed(corpo):
+        adendo = fator * _ALFABETO_CODIGO.index(caractere)
+        soma += adendo // 32 + adendo % 32
+        fator = 1 if fator == 2 else 2
+    return _ALFABETO_CODIGO[-soma % 32]
+
+
+def codigo_curto(numero):
+    embaralhado = _embaralhar(numero)
+    corpo = "".join(
+        _ALFABETO_CODIGO[(embaralhado >> deslocamento) & 31]
+        for deslocamento in range(CODIGO_CURTO_BITS - 5, -1, -5)
+    )
+    return corpo + _digito_verificador(corpo)
+
+
+def normalizar_codigo(codigo):
+    """Código curto digitado com minúsculas, espaços, hífens ou O/I/L no lugar de 0/1
+    vira a forma canônica; os outros formatos só perdem os espaços das pontas."""
+    codigo = (codigo or "").strip()
+    limpo = re.sub(r"[\s-]", "", codigo).upper().translate(_CONFUSOES_CODIGO)
+    return limpo if _CODIGO_CURTO_RE.match(limpo) else codigo
+
+
+class AlocadorCodigos:
+    """Entrega códigos curtos únicos sem consultar o Firestore a cada código.
+
+    Reserva um bloco de CODIGO_BLOCO números de sequência com create() em
+    "blocos_codigos/<n>" (falha se outra instância pegou o mesmo bloco, e aí tenta o
+    próximo) e emite os números do bloco localmente. "contadores/codigos" guarda só
+    uma dica do último bloco, para a busca começar perto do fim.
+    """
+
+    def __init__(self, tamanho_bloco):
+        self.tamanho_bloco = tamanho_bloco
+        self._lock = threading.Lock()
+        self._proximo = 0
+        self._fim = 0
+
+    def _reservar_bloco(self):
+        dica = buscar_documento("contadores", "codigos")
+        bloco = (dica.to_dict().get("ultimo_bloco", 0) if dica.exists else 0) + 1
+        while True:
+            try:
+                criar_documento("blocos_codigos", str(bloco), {
+                    "tamanho": self.tamanho_bloco,
+                    "inicio": bloco * self.tamanho_bloco,
+                    "fim": (bloco + 1) * self.tamanho_bloco,
+                    "reservado_em": datetime.now(timezone.utc),
+                })
+                break
+            except AlreadyExists:
+                bloco += 1
+        atualizar_documento("contadores", "codigos", {"ultimo_bloco": bloco})
+        logger.info("🔢 Bloco de códigos %s reservado (%s códigos)", bloco, self.tamanho_bloco)
+        return bloco
+
+    def proximo(self):
+        with self._lock:
+            if self._proximo >= self._fim:
+                bloco = self._reservar_bloco()
+                self._proximo, self._fim = bloco * self.tamanho_bloco, (bloco + 1) * self.tamanho_bloco
+            numero = self._proximo
+            self._proximo += 1
+        return codigo_curto(numero)
+
+
+alocador_codigos = AlocadorCodigos(CODIGO_BLOCO)
+
+
+def gerar_codigo():
+    if CODIGO_FORMATO == "curto" and db is not None:
+        try:
+            return alocador_codigos.proximo()
+        except Exception as e:
+            # Sem bloco não há código curto garantido: emite no formato aleatório
+            logger.warning("⚠️ Não foi possível reservar bloco de códigos, usando código aleatório: %s", e)
+    if not CODIGO_SEGREDO:
+        return str(uuid.uuid4())[:16]
+    identificador = _base32(os.urandom(CODIGO_ID_BYTES))
+    return identificador + _mac_codigo(CODIGO_SEGREDO, identificador)
+
+
+def verificar_codigo(codigo):
+    """Classifica o código sem acessar o Firestore: "curto", "assinado", "legado" ou "invalido"."""
+    if not codigo:
+        resultado = "invalido"
+    elif _CODIGO_CURTO_RE.match(codigo):
+        resultado = "curto" if _digito_verificador(codigo[:-1]) == codigo[-1] else "invalido"
+    elif _CODIGO_LEGADO_RE.match(codigo):
+        resultado = "legado"
+    elif _CODIGO_ASSINADO_RE.match(codigo):
+        identificador, mac = codigo[:-8], codigo[-8:]
+        segredos = [CODIGO_SEGREDO] + CODIGO_SEGREDOS_ANTIGOS if CODIGO_SEGREDO else CODIGO_SEGREDOS_ANTIGOS
+        valido = any(hmac.compare_digest(_mac_codigo(segredo, identificador), mac) for segredo in segredos)
+        resultado = "assinado" if valido else "invalido"
+    else:
+        resultado = "invalido"
+
+    metricas.incrementar("codigos_verificados_total", resultado=resultado)
+    return resultado
+
+
+##### Filtro de códigos emitidos (Bloom)
+
+# Todo código emitido entra num filtro de Bloom em memória. O filtro é local e fica
+# atrás das outras instâncias, então "fora do filtro" não prova que o código não
+# existe: o código é lido uma vez no Firestore e, se não existir mesmo, a ausência
+# fica num cache curto (FILTRO_CODIGOS_AUSENTES_S). Scanners e crawlers repetindo o
+# mesmo código inexistente recebem 404 sem novas leituras; um código encontrado na
+# leitura entra no filtro (inclusive documentos antigos sem criado_em).
+#
+# O filtro é montado no início com uma varredura só de IDs e depois sincronizado a
+# cada FILTRO_CODIGOS_ATUALIZACAO segundos com os certificados criados por outras
+# instâncias (campo criado_em). Um snapshot em disco evita a varredura completa no
+# próximo início. Códigos assinados e curtos não passam pelo filtro: a assinatura (ou
+# o dígito verificador) já separa os digitados errado, e o código pode ter acabado de
+# ser emitido por outra instância ainda não sincronizada.
+FILTRO_CODIGOS = os.getenv("FILTRO_CODIGOS", "1") == "1"
+FILTRO_CODIGOS_CAPACIDADE = int(os.getenv("FILTRO_CODIGOS_CAPACIDADE", 1_000_000))
+FILTRO_CODIGOS_FALSO_POSITIVO = float(os.getenv("FILTRO_CODIGOS_FALSO_POSITIVO", 0.001))
+FILTRO_CODIGOS_ARQUIVO = os.getenv("FILTRO_CODIGOS_ARQUIVO", "filtro_codigos.bin")
+FILTRO_CODIGOS_ATUALIZACAO = int(os.getenv("FILTRO_CODIGOS_ATUALIZACAO", 15))
+FILTRO_CODIGOS_MARGEM = 60  # segundos de folga para relógios desalinhados entre instâncias
+FILTRO_CODIGOS_AUSENTES_S = float(os.getenv("FILTRO_CODIGOS_AUSENTES_S", 30))
+FILTRO_CODIGOS_AUSENTES_MAX = int(os.getenv("FILTRO_CODIGOS_AUSENTES_MAX", 100_000))
+
+
+class FiltroBloom:
+    _CABECALHO = struct.Struct("<4sIIQd")  # assinatura, bits, hashes, itens, sincronizado_em
+    _ASSINATURA = b"BLM1"
+
+    def __init__(self, bits, hashes, dados=None, itens=0):
+        self.bits = bits
+        self.hashes = hashes
+        self.itens = itens
+        self._dados = dados if dados is not None else bytearray((bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def para_capacidade(cls, capacidade, falso_positivo):
+        bits = math.ceil(-capacidade * math.log(falso_positivo) / (math.log(2) ** 2))
+        hashes = max(1, round(bits / capacidade * math.log(2)))
+        return cls(bits, hashes)
+
+    def _posicoes(self, codigo):
+        # Hash duplo (Kirsch-Mitzenmacher): k posições a partir de um só digest
+        digest = hashlib.blake2b(codigo.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def adicionar(self, codigo):
+        posicoes = self._posicoes(codigo)
+        with self._lock:
+            novo = False
+            for p in posicoes:
+                byte, mascara = p >> 3, 1 << (p & 7)
+                if not self._dados[byte] & mascara:
+                    self._dados[byte] |= mascara
+                    novo = True
+            if novo:
+                self.itens += 1
+
+    def __contains__(self, codigo):
+        return all(self._dados[p >> 3] & (1 << (p & 7)) for p in self._posicoes(codigo))
+
+    def serializar(self, sincronizado_em):
+        with self._lock:
+            cabecalho = self._CABECALHO.pack(self._ASSINATURA, self.bits, self.hashes, self.itens, sincronizado_em)
+            return cabecalho + zlib.compress(bytes(self._dados), 1)
+
+    @classmethod
+    def desserializar(cls, conteudo):
+        assinatura, bits, hashes, itens, sincronizado_em = cls._CABECALHO.unpack_from(conteudo)
+        if assinatura != cls._ASSINATURA:
+            raise ValueError("Snapshot do filtro com formato desconhecido")
+        dados = bytearray(zlib.decompress(conteudo[cls._CABECALHO.size:]))
+        if len(dados) != (bits + 7) // 8:
+            raise ValueError("Snapshot do filtro truncado")
+        return cls(bits, hashes, dados, itens), sincronizado_em
+
+
+class FiltroCodigos:
+    """Filtro de Bloom dos códigos emitidos, com snapshot e sincronização em segundo plano."""
+
+    def __init__(self, capacidade, falso_positivo, arquivo, intervalo, ausentes_s=30, ausentes_max=100_000):
+        self.arquivo = arquivo
+        self.intervalo = intervalo
+        self.capacidade = capacidade
+        self.ausentes_s = ausentes_s
+        self.ausentes_max = ausentes_max
+        self._bloom = FiltroBloom.para_capacidade(capacidade, falso_positivo)
+        self._pronto = False
+        self._sincronizado_em = None
+        self._alterado = False
+        self._ausentes = {}  # código -> instante (monotonic) em que a ausência expira
+        self._ausentes_lock = threading.Lock()
+
+    def descartar(self, codigo):
+        """True só quando o código está fora do filtro e uma leitura recente confirmou que não existe."""
+        if not self._pronto:
+            return False
+        if codigo in self._bloom:
+            metricas.incrementar("filtro_codigos_total", resultado="talvez")
+            return False
+        expira = self._ausentes.get(codigo)
+        if expira is not None and expira > time.monotonic():
+            metricas.incrementar("filtro_codigos_total", resultado="descartado")
+            return True
+        metricas.incrementar("filtro_codigos_total", resultado="consultado")
+        return False
+
+    def confirmar(self, codigo, existe):
+        """Resultado da leitura no Firestore de um código que passou pelo filtro."""
+        if existe:
+            self._ausentes.pop(codigo, None)
+            if codigo not in self._bloom:
+                self.adicionar(codigo)
+            return
+        if not self._pronto or codigo in self._bloom:
+            return
+        agora = time.monotonic()
+        with self._ausentes_lock:
+            if len(self._ausentes) >= self.ausentes_max:
+                self._ausentes = {c: expira for c, expira in self._ausentes.items() if expira > agora}
+                # Ainda cheio: descarta os mais antigos (o dict mantém a ordem de inserção)
+                for antigo in list(self._ausentes)[:len(self._ausentes) - self.ausentes_max + 1]:
+                    del self._ausentes[antigo]
+            self._ausentes[codigo] = agora + self.ausentes_s
+
+    def adicionar(self, codigo):
+        self._bloom.adicionar(codigo)
+        self._alterado = True
+
+    def iniciar(self):
+        self._carregar_snapshot()
+        threading.Thread(target=self._sincronizar_sempre, name="filtro-codigos", daemon=True).start()
+
+    def _carregar_snapshot(self):
         try:
-            template = Image.open(TEMPLATE_PATH)
-            logger.info(f"✅ Template carregado: {TEMPLATE_PATH}")
+            with open(self.arquivo, "rb") as f:
+                bloom, sincronizado_em = FiltroBloom.desserializar(f.read())
         except FileNotFoundError:
-            logger.error(f"❌ Template não encontrado em {TEMPLATE_PATH}")
-            return None
+            return
+        except Exception as e:
+            logger.warning("⚠️ Snapshot do filtro de códigos ignorado: %s", e)
+            return
+
+        if (bloom.bits, bloom.hashes) != (self._bloom.bits, self._bloom.hashes):
+            logger.info("🔁 Capacidade do filtro de códigos mudou, refazendo a varredura")
+            return
+
+        self._bloom = bloom
+        self._sincronizado_em = sincronizado_em
+        self._pronto = True
+        logger.info("✅ Filtro de códigos carregado do snapshot (%s códigos)", bloom.itens)
+
+    def _varrer(self, desde=None):
+        consulta = db.collection("certificados")
+        if desde is not None:
+            consulta = consulta.where(filter=firestore.FieldFilter(
+                "criado_em", ">=", datetime.fromtimestamp(desde - FILTRO_CODIGOS_MARGEM, timezone.utc)
+            ))
+        # Só os IDs: a projeção em __name__ não traz os campos dos documentos
+        for doc in consulta.select(["__name__"]).stream():
+            self.adicionar(doc.id)
+
+    def _sincronizar(self):
+        inicio = time.time()
+        with metricas.medir("firestore_segundos", operacao="varredura", colecao="certificados"):
+            self._varrer(self._sincronizado_em)
+        self._sincronizado_em = inicio
+
+        if not self._pronto:
+            self._pronto = True
+            logger.info("✅ Filtro de códigos montado com %s códigos", self._bloom.itens)
+        if self._bloom.itens > self.capacidade:
+            logger.warning("⚠️ Filtro de códigos acima da capacidade (%s); aumente FILTRO_CODIGOS_CAPACIDADE", self._bloom.itens)
+        metricas.definir("filtro_codigos_itens", self._bloom.itens)
+
+    def salvar_snapshot(self):
+        if not self._pronto or not self._alterado:
+            return
+        self._alterado = False
+        temporario = f"{self.arquivo}.{uuid.uuid4().hex}.tmp"
+        with open(temporario, "wb") as f:
+            f.write(self._bloom.serializar(self._sincronizado_em))
+        os.replace(temporario, self.arquivo)
+
+    def _sincronizar_sempre(self):
+        while True:
+            try:
+                self._sincronizar()
+                self.salvar_snapshot()
+            except Exception as e:
+                logger.error("❌ Erro ao sincronizar o filtro de códigos: %s", e)
+            time.sleep(self.intervalo)
+
+
+filtro_codigos = FiltroCodigos(
+    FILTRO_CODIGOS_CAPACIDADE, FILTRO_CODIGOS_FALSO_POSITIVO, FILTRO_CODIGOS_ARQUIVO, FILTRO_CODIGOS_ATUALIZACAO,
+    FILTRO_CODIGOS_AUSENTES_S, FILTRO_CODIGOS_AUSENTES_MAX
+)
+
+
+def codigo_descartado(codigo, situacao=None):
+    """True quando o código certamente não existe e dá para responder 404 sem ler o Firestore."""
+    situacao = situacao or verificar_codigo(codigo)
+    if situacao == "invalido":
+        return True
+    if situacao in ("assinado", "curto"):
+        return False
+    return filtro_codigos.descartar(codigo)
+
+
+def buscar_certificado(codigo, situacao=None):
+    """Snapshot do certificado (ou None se o código foi descartado sem leitura).
+
+    A leitura alimenta o filtro: encontrado entra nele, ausente fica no cache curto.
+    """
+    if codigo_descartado(codigo, situacao):
+        return None
+    doc = buscar_documento("certificados", codigo)
+    filtro_codigos.confirmar(codigo, doc.exists)
+    return doc
+
+
+##### Artefatos renderizados (renderiza uma vez, serve bytes estáticos)
+
+# O certificado é renderizado na emissão e guardado em três formatos; as rotas de
+# leitura só consultam os metadados no Firestore e devolvem os bytes prontos.
+ARTEFATOS_BACKEND = os.getenv("ARTEFATOS_BACKEND", "disco")  # "disco" ou "memoria"
+ARTEFATOS_MAX_AGE = int(os.getenv("ARTEFATOS_MAX_AGE", 3600))
+CARD_SOCIAL_MAX_AGE = int(os.getenv("CARD_SOCIAL_MAX_AGE", 7 * 24 * 3600))
+PREVIA_WEB_LARGURA = 1000
+
+TIPOS_ARTEFATO = {
+    "png": {"sufixo": ".png", "mimetype": "image/png"},              # certificado completo
+    "web": {"sufixo": ".web.jpg", "mimetype": "image/jpeg"},         # prévia para as páginas
+    "social": {"sufixo": ".og.jpg", "mimetype": "image/jpeg"},       # og:image (card 1200x627)
+}
+
 
-        # Tenta abrir a assinatura
+def codificar_jpeg(imagem, qualidade=85):
+    img_io = io.BytesIO()
+    rgb = imagem if imagem.mode == "RGB" else imagem.convert("RGB")
+    rgb.save(img_io, "JPEG", quality=qualidade, optimize=True, progressive=True)
+    if rgb is not imagem:
+        rgb.close()
+    return img_io.getvalue()
+
+
+def montar_previa_web(certificate):
+    fator = max(1, certificate.width // PREVIA_WEB_LARGURA)
+    return certificate.reduce(fator) if fator > 1 else certificate
+
+
+CARD_SOCIAL_TOPO = 40        # corte vertical do template reduzido para 1200px de largura
+CARD_SOCIAL_CENTRO_X = 756   # centro da coluna de texto do template
+CARD_SOCIAL_LARGURA_TEXTO = 640
+
+
+def fundo_card_social(template_id=None, versao=None):
+    # Faixa do template (selo + "CERTIFICADO DE CONCLUSÃO") já no tamanho final,
+    # guardada junto do template decodificado
+    def recortar(template):
+        largura, altura = CARD_SOCIAL_TAMANHO
+        reduzido = template.resize((largura, round(template.height * largura / template.width)), Image.LANCZOS)
+        return reduzido.convert("RGB").crop((0, CARD_SOCIAL_TOPO, largura, CARD_SOCIAL_TOPO + altura))
+
+    return registro_templates.derivado("card_social_fundo", ("card_social",), recortar, template_id, versao)
+
+
+def _tamanho_que_cabe(texto, tamanho, minimo=22):
+    while tamanho > minimo:
+        if cadeia_fontes.largura(texto, tamanho) <= CARD_SOCIAL_LARGURA_TEXTO:
+            return tamanho
+        tamanho -= 2
+    return minimo
+
+
+def dados_card_social(dados):
+    return {
+        "nome": dados.get("nome"),
+        "nome_treinamento": dados.get("nome_treinamento"),
+        "turma_nome": dados.get("turma_nome"),
+        "data_evento": dados.get("data_evento"),
+        "carga_horaria": dados.get("carga_horaria"),
+        "template_id": dados.get("template_id"),
+        "template_versao": dados.get("template_versao"),
+    }
+
+
+def montar_card_social(
+    nome, nome_treinamento=None, turma_nome=None, data_evento=None, carga_horaria=None,
+    template_id=None, template_versao=None
+):
+    """Card 1200x627 para o og:image: nome e treinamento, sem QR Code.
+
+    Bem mais leve que o certificado completo, então as prévias do LinkedIn,
+    Slack e WhatsApp carregam rápido.
+    """
+    card = fundo_card_social(template_id, template_versao).copy()
+    draw = ImageDraw.Draw(card)
+
+    def centralizado(y, texto, tamanho, cor):
+        x = CARD_SOCIAL_CENTRO_X - cadeia_fontes.largura(texto, tamanho) / 2
+        cadeia_fontes.desenhar(draw, (x, y), texto, tamanho, cor)
+
+    # "Certificamos que" e "completou com sucesso o treinamento" já estão no template
+    centralizado(330, nome, _tamanho_que_cabe(nome, 56), "#3b1f5c")
+    if nome_treinamento:
+        centralizado(475, nome_treinamento, _tamanho_que_cabe(nome_treinamento, 40), "#6b2fa0")
+
+    carga = f"{carga_horaria}h" if str(carga_horaria or "").isdigit() else carga_horaria
+    detalhes = " · ".join(str(parte) for parte in (turma_nome, data_evento, carga) if parte)
+    if detalhes:
+        centralizado(540, detalhes, _tamanho_que_cabe(detalhes, 24, minimo=16), "#555555")
+    return card
+
+
+class Artefato:
+    """Um artefato pronto para servir: caminho em disco ou os bytes em memória."""
+
+    def __init__(self, tipo, tamanho, etag, modificado, caminho=None, conteudo=None):
+        self.tipo = tipo
+        self.tamanho = tamanho
+        self.etag = etag
+        self.modificado = modificado
+        self.caminho = caminho
+        self.conteudo = conteudo
+
+    @property
+    def mimetype(self):
+        return TIPOS_ARTEFATO[self.tipo]["mimetype"]
+
+    def arquivo(self):
+        return self.caminho if self.caminho else io.BytesIO(self.conteudo)
+
+    def ler(self):
+        if self.conteudo is not None:
+            return self.conteudo
+        with open(self.caminho, "rb") as f:
+            return f.read()
+
+
+# Armazéns: um objeto por (código, tipo), com gravar(codigo, tipo, conteudo),
+# obter(codigo, tipo) -> Artefato ou None se ainda não existe, e remover(codigo).
+
+class ArmazemDisco:
+    def __init__(self, pasta):
+        self.pasta = os.path.abspath(pasta)
+        os.makedirs(self.pasta, exist_ok=True)
+
+    def _caminho(self, codigo, tipo):
+        return os.path.join(self.pasta, f"{codigo}{TIPOS_ARTEFATO[tipo]['sufixo']}")
+
+    def gravar(self, codigo, tipo, conteudo):
+        # Escrita atômica: quem lê nunca vê um arquivo pela metade
+        caminho = self._caminho(codigo, tipo)
+        temporario = f"{caminho}.{uuid.uuid4().hex}.tmp"
+        with open(temporario, "wb") as f:
+            f.write(conteudo)
+        os.replace(temporario, caminho)
+
+    def obter(self, codigo, tipo):
+        caminho = self._caminho(codigo, tipo)
         try:
-            signature = Image.open(SIGNATURE_PATH).convert("RGBA")
-            logger.info(f"✅ Assinatura carregada: {SIGNATURE_PATH}")
+            st = os.stat(caminho)
         except FileNotFoundError:
-            logger.error(f"❌ Assinatura não encontrada em {SIGNATURE_PATH}")
             return None
+        return Artefato(
+            tipo, st.st_size, f"{st.st_size:x}-{st.st_mtime_ns:x}",
+            datetime.fromtimestamp(st.st_mtime, timezone.utc), caminho=caminho
+        )
 
-        # Limpa a pasta de saída
-        clear_output_folder()
-        logger.info(f"🧹 Pasta {OUTPUT_FOLDER} limpa para novos certificados")
+    def remover(self, codigo):
+        for tipo in TIPOS_ARTEFATO:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._caminho(codigo, tipo))
+
+
+class ArmazemObjetosEmMemoria:
+    """Substituto local de um object storage (GCS/S3): objetos inteiros com ETag MD5."""
+
+    def __init__(self):
+        self._objetos = {}
+        self._lock = threading.Lock()
+
+    def gravar(self, codigo, tipo, conteudo):
+        etag = hashlib.md5(conteudo).hexdigest()
+        with self._lock:
+            self._objetos[(codigo, tipo)] = (conteudo, etag, datetime.now(timezone.utc))
+
+    def obter(self, codigo, tipo):
+        with self._lock:
+            objeto = self._objetos.get((codigo, tipo))
+        if objeto is None:
+            return None
+        conteudo, etag, modificado = objeto
+        return Artefato(tipo, len(conteudo), etag, modificado, conteudo=conteudo)
+
+    def remover(self, codigo):
+        with self._lock:
+            for tipo in TIPOS_ARTEFATO:
+                self._objetos.pop((codigo, tipo), None)
+
+
+if ARTEFATOS_BACKEND == "memoria":
+    armazem_artefatos = ArmazemObjetosEmMemoria()
+else:
+    armazem_artefatos = ArmazemDisco(ARTEFATOS_FOLDER)
+
+
+def guardar_artefatos(codigo, artefatos):
+    for tipo, conteudo in artefatos.items():
+        armazem_artefatos.gravar(codigo, tipo, conteudo)
+
+
+def dados_para_render(codigo, data, base_url):
+    # Campos gravados no Firestore -> argumentos de montar_certificado_imagem
+    return {
+        "nome": data.get('nome'),
+        "data_emissao": data.get('data_emissao'),
+        "codigo": codigo,
+        "base_url": base_url,
+        "turma_nome": data.get('turma_nome', 'Turma não informada'),
+        "data_evento": data.get('data_evento', 'Data do evento não informada'),
+        "nome_treinamento": data.get('nome_treinamento', 'Treinamento não especificado'),
+        "carga_horaria": data.get('carga_horaria', 'Carga horária não informada'),
+        "template_id": data.get('template_id'),
+        "template_versao": data.get('template_versao'),
+        "idioma": data.get('idioma'),
+    }
+
+
+def artefato_atual(artefato, renderizado_em):
+    """O artefato existe e foi gravado depois da última remontagem pedida.
+
+    renderizado_em é gravado no certificado (e na turma) pela reemissão: o armazém
+    de cada instância pode ter ficado com a imagem anterior à correção.
+    """
+    return artefato is not None and (renderizado_em is None or artefato.modificado >= renderizado_em)
+
+
+def obter_artefato(codigo, tipo, data, base_url):
+    """Artefato pronto do armazém.
+
+    Certificados emitidos antes do armazém (ou cujo artefato foi perdido ou ficou
+    anterior a uma reemissão) são renderizados aqui uma única vez e guardados; as
+    próximas leituras já são estáticas.
+    """
+    renderizado_em = data.get("renderizado_em")
+    artefato = armazem_artefatos.obter(codigo, tipo)
+    atual = artefato_atual(artefato, renderizado_em)
+    registrar_cache("artefatos", atual)
+    if atual:
+        return artefato
+
+    with _lock_emissao(f"artefato:{codigo}"):
+        artefato = armazem_artefatos.obter(codigo, tipo)
+        if artefato_atual(artefato, renderizado_em):
+            return artefato
+
+        dados = dados_para_render(codigo, data, base_url)
+        if tipo == "social":
+            # O card é barato: não precisa remontar o certificado inteiro
+            conteudo, estagios = get_render_pool().render(
+                _renderizar_card_social_worker, dados, prioridade=PRIORIDADE_INTERATIVA
+            )
+            registrar_estagios(estagios, rota_atual())
+            armazem_artefatos.gravar(codigo, tipo, conteudo)
+        else:
+            logger.info("🖼️ Artefatos de %s ausentes, renderizando sob demanda", codigo)
+            artefatos = renderizar_artefatos(prioridade=PRIORIDADE_INTERATIVA, **dados)
+            if not artefatos:
+                return None
+            guardar_artefatos(codigo, artefatos)
+    return armazem_artefatos.obter(codigo, tipo)
+
+
+def servir_artefato(artefato, download_name=None, max_age=ARTEFATOS_MAX_AGE):
+    # conditional=True responde 304 (If-None-Match/If-Modified-Since) e 206 (Range)
+    return send_file(
+        artefato.arquivo(),
+        mimetype=artefato.mimetype,
+        as_attachment=download_name is not None,
+        download_name=download_name,
+        conditional=True,
+        etag=artefato.etag,
+        last_modified=artefato.modificado,
+        max_age=max_age
+    )
+
+
+##### Emissão idempotente (uma emissão por pessoa e turma)
+
+EMISSOES_CACHE_MAX = int(os.getenv("EMISSOES_CACHE_MAX", 10000))
+
+_emissoes_cache = collections.OrderedDict()
+_emissoes_cache_lock = threading.Lock()
+# Locks em faixas fixas (hash da chave): memória constante, por mais chaves que a
+# instância veja. Duas chaves na mesma faixa só esperam uma pela outra; nenhum
+# trecho segura dois destes locks ao mesmo tempo.
+EMISSOES_LOCKS_FAIXAS = 1024
+_emissoes_locks = [threading.Lock() for _ in range(EMISSOES_LOCKS_FAIXAS)]
+
+
+def normalizar_nome(nome):
+    # "  JOÃO   da Silva " e "joao da silva" são a mesma pessoa. Só as marcas
+    # combinantes (acentos) caem: 王伟, محمد e שרה continuam distintos entre si
+    decomposto = unicodedata.normalize("NFKD", nome)
+    sem_acentos = "".join(c for c in decomposto if unicodedata.category(c) != "Mn")
+    normalizado = " ".join(unicodedata.normalize("NFC", sem_acentos).casefold().split())
+    # Nome feito só de marcas combinantes não pode virar a chave vazia da turma
+    return normalizado or " ".join(unicodedata.normalize("NFC", nome).casefold().split())
+
+
+def chave_emissao(turma_id, nome):
+    return hashlib.sha256(f"{turma_id}|{normalizar_nome(nome)}".encode("utf-8")).hexdigest()[:32]
+
+
+def _lock_emissao(chave):
+    faixa = int.from_bytes(hashlib.blake2b(chave.encode("utf-8"), digest_size=8).digest(), "little")
+    return _emissoes_locks[faixa % EMISSOES_LOCKS_FAIXAS]
+
+
+def _lembrar_emissao(chave, codigo):
+    with _emissoes_cache_lock:
+        _emissoes_cache[chave] = codigo
+        _emissoes_cache.move_to_end(chave)
+        while len(_emissoes_cache) > EMISSOES_CACHE_MAX:
+            _emissoes_cache.popitem(last=False)
+
+
+def buscar_emissao_existente(chave):
+    """Código já emitido para a chave (turma, nome normalizado), ou None."""
+    with _emissoes_cache_lock:
+        codigo = _emissoes_cache.get(chave)
+    registrar_cache("emissoes", codigo is not None)
+    if codigo:
+        return codigo
+
+    doc = buscar_documento("emissoes", chave)
+    if not doc.exists:
+        return None
 
-        # Define a data de emissão e gera o código único
-        date = get_current_date()
-        unique_hash = str(uuid.uuid4())[:16]
-        logger.info(f"📅 Data de emissão: {date} | 🔐 Código único gerado: {unique_hash}")
+    codigo = doc.to_dict().get("codigo")
+    if codigo:
+        _lembrar_emissao(chave, codigo)
+    return codigo
+
+
+def reservar_emissao(chave, turma_id, nome, codigo, data_emissao=None):
+    """Grava o índice antes de renderizar; devolve False se outra requisição chegou antes."""
+    try:
+        criar_documento("emissoes", chave, {
+            "codigo": codigo,
+            "turma_id": turma_id,
+            "nome_normalizado": normalizar_nome(nome),
+            "data_emissao": data_emissao,
+            # Checkpoint: o que já foi feito para esta emissão (ver retomar_emissao)
+            "renderizado": False,
+            "registrado": False,
+        })
+    except AlreadyExists:
+        return False
+    _lembrar_emissao(chave, codigo)
+    return True
+
+
+def marcar_emissao(chave, **estado):
+    try:
+        atualizar_documento("emissoes", chave, estado)
+    except Exception as e:
+        # Sem a marca, a próxima tentativa só confere de novo o que já foi feito
+        logger.warning("⚠️ Não foi possível atualizar o checkpoint da emissão %s: %s", chave, e)
+
+
+def retomar_emissao(turma_id, nome, idioma=None):
+    """Checkpoint de uma linha do lote: (chave, estado).
+
+    Linha nova reserva código e data antes de renderizar. Linha já vista (lote
+    interrompido, CSV reenviado ou aluno que emitiu pelo /aluno) volta com o mesmo
+    código e data e com o que já foi feito (renderizado, registrado). O índice é
+    lido antes de gerar o código: linha já vista não gasta código do bloco.
+    """
+    chave = chave_emissao(turma_id, nome)
+    data_emissao = get_current_date(idioma)
+    doc = buscar_documento("emissoes", chave)
+    if not doc.exists:
+        codigo = gerar_codigo()
+        if reservar_emissao(chave, turma_id, nome, codigo, data_emissao):
+            return chave, {"codigo": codigo, "data_emissao": data_emissao, "renderizado": False, "registrado": False}
+        # Outra requisição reservou no meio tempo: vale o código dela
+        doc = buscar_documento("emissoes", chave)
+
+    estado = doc.to_dict()
+    _lembrar_emissao(chave, estado["codigo"])
+    if "registrado" not in estado or not estado.get("data_emissao"):
+        # Índice gravado antes dos checkpoints: o próprio registro diz se já foi salvo
+        certificado = buscar_documento("certificados", estado["codigo"])
+        estado.setdefault("registrado", certificado.exists)
+        if certificado.exists and not estado.get("data_emissao"):
+            estado["data_emissao"] = certificado.to_dict().get("data_emissao")
+    estado["data_emissao"] = estado.get("data_emissao") or data_emissao
+    return chave, estado
+
+
+def dados_turma_para_emissao(turma_data):
+    """Campos da turma copiados em cada certificado, com o template já fixado (id e versão)."""
+    template_id, template_versao, _ = registro_templates.resolver(
+        turma_data.get("template_id"), turma_data.get("template_versao")
+    )
+    return {
+        "turma_nome": turma_data.get("nome", "Turma sem nome"),
+        "data_evento": turma_data.get("data_evento", "Data do evento não informada"),
+        "nome_treinamento": turma_data.get("nome_treinamento", "Treinamento não especificado"),
+        "carga_horaria": turma_data.get("carga_horaria", "Carga horária não informada"),
+        "template_id": template_id,
+        "template_versao": template_versao,
+        "idioma": idioma_valido(turma_data.get("idioma")),
+    }
+
+
+def iniciar_emissao_lote(turma_id, nome, dados_turma, base_url, renderizado_em=None):
+    """Primeira metade da emissão de um aluno do lote: checkpoint e, se a imagem ainda
+    não existe, renderização enviada ao pool (prioridade de lote). O item devolvido
+    vai para concluir_emissao_lote. renderizado_em é o da turma (última reemissão)."""
+    chave, estado = retomar_emissao(turma_id, nome, dados_turma["idioma"])
+    # Só o checkpoint prova que a imagem guardada é desta emissão: um arquivo com o
+    # mesmo código pode ter sobrado de outro Firestore (memória reiniciada, emulador)
+    artefato = armazem_artefatos.obter(estado["codigo"], "png") if estado.get("renderizado") else None
+    if not artefato_atual(artefato, renderizado_em):
+        artefato = None
+    future = None
+    if artefato is None:
+        future = enviar_artefatos(
+            prioridade=PRIORIDADE_LOTE,
+            nome=nome,
+            data_emissao=estado["data_emissao"],
+            codigo=estado["codigo"],
+            base_url=base_url,
+            **dados_turma
+        )
+    return {"nome": nome, "chave": chave, "estado": estado, "artefato": artefato, "future": future, "png": None}
+
+
+def aguardar_render_lote(item):
+    """Espera a renderização do item (se houve) e guarda os artefatos; False se falhou."""
+    if item["future"] is None:
+        return True
+    artefatos = item["future"].result()
+    if not artefatos:
+        logger.error("❌ Falha ao montar certificado para %s", item["nome"])
+        return False
+    guardar_artefatos(item["estado"]["codigo"], artefatos)
+    # Checkpoint próprio do render: numa nova tentativa a linha só falta registrar
+    marcar_emissao(item["chave"], renderizado=True)
+    item["estado"]["renderizado"] = True
+    item["png"] = artefatos["png"]
+    return True
+
+
+def concluir_emissao_lote(item, turma_id, dados_turma):
+    """Espera a renderização, guarda os artefatos e registra no Firestore uma vez só.
+
+    Devolve "emitido", "retomado" (já registrado numa tentativa anterior),
+    "falha_render" ou "falha_registro". O PNG renderizado fica em item["png"].
+    """
+    estado = item["estado"]
+    if not aguardar_render_lote(item):
+        return "falha_render"
+
+    if estado["registrado"]:
+        return "retomado"
+
+    registrado = save_certificate_to_firestore(
+        nome=item["nome"],
+        data_emissao=estado["data_emissao"],
+        codigo=estado["codigo"],
+        turma_id=turma_id,
+        **dados_turma
+    )
+    if not registrado:
+        return "falha_registro"
+    marcar_emissao(item["chave"], renderizado=True, registrado=True)
+    return "emitido"
+
+
+def registrar_emissoes_em_lote(itens, turma_id, dados_turma):
+    """Registra os certificados dos itens já renderizados em WriteBatches.
+
+    Cada certificado vai no mesmo commit que o checkpoint "registrado" da sua
+    emissão, então nunca fica registro sem checkpoint. Itens de um commit que
+    falhou continuam com estado["registrado"] False e podem ser tentados de novo.
+    """
+    por_commit = FIRESTORE_ESCRITAS_POR_LOTE // 2  # duas escritas por certificado
+    for inicio in range(0, len(itens), por_commit):
+        parte = itens[inicio:inicio + por_commit]
+        lote = db.batch()
+        for item in parte:
+            estado = item["estado"]
+            lote.set(
+                db.collection("certificados").document(estado["codigo"]),
+                registro_certificado(item["nome"], estado["data_emissao"], estado["codigo"], turma_id=turma_id, **dados_turma)
+            )
+            lote.set(db.collection("emissoes").document(item["chave"]), {"renderizado": True, "registrado": True}, merge=True)
+        try:
+            with metricas.medir("firestore_segundos", operacao="batch", colecao="certificados"):
+                lote.commit()
+        except Exception as e:
+            logger.error("❌ Erro ao registrar %s certificados da turma %s: %s", len(parte), turma_id, e)
+            continue
+        for item in parte:
+            item["estado"]["registrado"] = True
+            filtro_codigos.adicionar(item["estado"]["codigo"])
+
+
+def generate_certificate_for_student(
+    name,
+    base_url,
+    turma_id=None,
+    nome_turma=None,
+    data_evento=None,
+    nome_treinamento=None,
+    carga_horaria=None,
+    template_id=None,
+    template_versao=None,
+    idioma=None
+):
+    """Emite (ou reaproveita) o certificado de um aluno.
+
+    Retorna (artefato_png, codigo, reaproveitado) ou None em caso de erro. Os
+    artefatos (PNG, prévia web e card social) são renderizados aqui, uma vez só.
+    Se a pessoa já tem certificado nesta turma, devolve o mesmo código sem
+    renderizar nem gravar de novo.
+    """
+    try:
+        logger.debug("🚀 Iniciando geração de certificado para estudante: %s", name)
 
         # ✅ Garantir que todos os campos tenham valor (fallbacks)
         if not nome_turma:
-            logger.warning(f"⚠️ Nome da turma não informado para {name}")
+            logger.warning("⚠️ Nome da turma não informado para %s", name)
             nome_turma = "Turma não especificada"
 
         if not data_evento:
-            logger.warning(f"⚠️ Data do evento não informada para {name}")
+            logger.warning("⚠️ Data do evento não informada para %s", name)
             data_evento = "Data não informada"
 
         if not nome_treinamento:
-            logger.warning(f"⚠️ Nome do treinamento não informado para {name}")
+            logger.warning("⚠️ Nome do treinamento não informado para %s", name)
             nome_treinamento = "Treinamento não especificado"
 
         if not carga_horaria:
-            logger.warning(f"⚠️ Carga horária não informada para {name}")
+            logger.warning("⚠️ Carga horária não informada para %s", name)
             carga_horaria = "Carga horária não informada"
 
-        # Monta o certificado com as novas informações
-        certificate = montar_certificado_imagem(
-            nome=name,
-            data_emissao=date,
-            codigo=unique_hash,
-            base_url=base_url,
-            turma_nome=nome_turma,
-            data_evento=data_evento,
-            nome_treinamento=nome_treinamento,
-            carga_horaria=carga_horaria
-        )
+        # Fixa o template (id e versão) no certificado: remontagens futuras saem iguais
+        template_id, template_versao, _ = registro_templates.resolver(template_id, template_versao)
+
+        chave = chave_emissao(turma_id, name) if turma_id else None
+
+        # O lock evita que dois cliques simultâneos na mesma instância renderizem duas vezes;
+        # entre instâncias quem garante é o create() do índice.
+        with _lock_emissao(chave) if chave else contextlib.nullcontext():
+            unique_hash = buscar_emissao_existente(chave) if chave else None
+            reaproveitado = unique_hash is not None
+
+            if reaproveitado:
+                # O registro diz se a turma foi reemitida depois da imagem guardada aqui
+                doc = buscar_documento("certificados", unique_hash)
+                registro = doc.to_dict() if doc.exists else {}
+                artefato = armazem_artefatos.obter(unique_hash, "png")
+                atual = artefato_atual(artefato, registro.get("renderizado_em"))
+                registrar_cache("artefatos", atual)
+                if atual:
+                    log_evento(logging.INFO, "certificado_reutilizado", codigo=unique_hash, turma_id=turma_id)
+                    return artefato, unique_hash, True
+
+                # Índice existe mas a imagem não está nesta instância (ou é anterior à
+                # reemissão): remonta com os dados gravados
+                date = registro.get("data_emissao") or get_current_date(idioma)
+                registro_existe = doc.exists
+            else:
+                date = get_current_date(idioma)
+                unique_hash = gerar_codigo()
+                registro_existe = False
+
+                if chave and not reservar_emissao(chave, turma_id, name, unique_hash, date):
+                    # Outra instância emitiu no meio tempo: usa o código dela
+                    unique_hash = buscar_emissao_existente(chave)
+                    reaproveitado = True
+                    doc = buscar_documento("certificados", unique_hash)
+                    registro_existe = doc.exists
+                    if registro_existe:
+                        date = doc.to_dict().get("data_emissao", date)
+
+            logger.debug("📅 Data de emissão: %s | 🔐 Código: %s", date, unique_hash)
+
+            # Monta o certificado com as novas informações (no pool, com prioridade interativa)
+            artefatos = renderizar_artefatos(
+                prioridade=PRIORIDADE_INTERATIVA,
+                nome=name,
+                data_emissao=date,
+                codigo=unique_hash,
+                base_url=base_url,
+                turma_nome=nome_turma,
+                data_evento=data_evento,
+                nome_treinamento=nome_treinamento,
+                carga_horaria=carga_horaria,
+                template_id=template_id,
+                template_versao=template_versao,
+                idioma=idioma
+            )
 
-        if not certificate:
-            logger.error(f"❌ Falha ao montar o certificado para {name}")
-            return None
+            if not artefatos:
+                logger.error("❌ Falha ao montar o certificado para %s", name)
+                return None
 
-        # Salva o certificado como imagem
-        output_file = os.path.join(OUTPUT_FOLDER, f"{name.replace(' ', '_')}_certificate.png")
-        certificate.save(output_file)
-        logger.info(f"✅ Certificado salvo em {output_file}")
-
-        # Salva no Firestore com todos os dados
-        save_certificate_to_firestore(
-            nome=name,
-            data_emissao=date,
-            codigo=unique_hash,
-            turma_nome=nome_turma,
-            data_evento=data_evento,
-            nome_treinamento=nome_treinamento,
-            carga_horaria=carga_horaria
-        )
-        logger.info(f"✅ Dados do certificado salvos no Firestore para {name} (ID: {unique_hash})")
+            # Guarda os artefatos antes do registro: quem achar o código já encontra as imagens
+            guardar_artefatos(unique_hash, artefatos)
+            if chave:
+                marcar_emissao(chave, renderizado=True)
+            logger.debug("✅ Artefatos do certificado %s guardados", unique_hash)
+
+            # Salva no Firestore com todos os dados (se ainda não estiver lá)
+            if not registro_existe:
+                registrado = save_certificate_to_firestore(
+                    nome=name,
+                    data_emissao=date,
+                    codigo=unique_hash,
+                    turma_nome=nome_turma,
+                    data_evento=data_evento,
+                    nome_treinamento=nome_treinamento,
+                    carga_horaria=carga_horaria,
+                    turma_id=turma_id,
+                    template_id=template_id,
+                    template_versao=template_versao,
+                    idioma=idioma
+                )
+                if registrado and chave:
+                    marcar_emissao(chave, registrado=True)
+                logger.debug("✅ Dados do certificado salvos no Firestore para %s (ID: %s)", name, unique_hash)
 
-        logger.info(f"🎉 Certificado gerado com sucesso para {name}")
-        return output_file, unique_hash
+            logger.debug("🎉 Certificado gerado com sucesso para %s", name)
+            return armazem_artefatos.obter(unique_hash, "png"), unique_hash, reaproveitado
 
+    except RenderPoolSaturado:
+        raise
     except Exception as e:
-        logger.error(f"❌ Erro inesperado ao gerar certificado para {name}: {e}")
+        logger.error("❌ Erro inesperado ao gerar certificado para %s: %s", name, e)
         return None
 
 
@@ -478,106 +2898,1480 @@ def generate_template_csv():
         f.write(template_csv)
     return template_path
 
-def generate_certificates(csv_path, base_url, turma_id):
+##### Importação de CSV em fluxo
+
+CSV_MAX_LINHAS = int(os.getenv("CSV_MAX_LINHAS", 5000))
+CSV_MAX_NOME = 120
+CSV_BLOCO = 64 * 1024
+CSV_DELIMITADORES = [",", ";", "\t", "|"]
+CSV_COLUNAS_NOME = ("name", "nome")
+CSV_COLUNAS_EMAIL = ("email", "e-mail")
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
+def _blocos_do_arquivo(arquivo, tamanho=CSV_BLOCO):
+    while True:
+        bloco = arquivo.read(tamanho)
+        if not bloco:
+            return
+        yield bloco
+
+
+def detectar_encoding(amostra):
+    """Excel costuma exportar em Windows-1252; UTF-8 com ou sem BOM também aparece."""
+    if amostra.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if amostra.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        # final=False tolera um caractere multibyte cortado no fim da amostra
+        codecs.getincrementaldecoder("utf-8")().decode(amostra, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+
+def detectar_delimitador(primeira_linha):
+    contagens = {d: primeira_linha.count(d) for d in CSV_DELIMITADORES}
+    delimitador = max(contagens, key=contagens.get)
+    return delimitador if contagens[delimitador] else ","
+
+
+def _linhas_decodificadas(blocos, amostra, encoding):
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    pendente = ""
+    for bloco in itertools.chain([amostra], blocos):
+        pendente += decoder.decode(bloco)
+        linhas = pendente.splitlines(keepends=True)
+        # A última linha pode estar incompleta (ou ser um \r esperando o \n)
+        pendente = linhas.pop() if linhas and not linhas[-1].endswith("\n") else ""
+        yield from linhas
+    pendente += decoder.decode(b"", final=True)
+    if pendente:
+        yield pendente
+
+
+def erro_no_nome(nome):
+    if not nome:
+        return "nome vazio"
+    if "\ufffd" in nome:
+        return "caracteres inválidos para o encoding detectado"
+    if len(nome) > CSV_MAX_NOME:
+        return f"nome com mais de {CSV_MAX_NOME} caracteres"
+    return None
+
+
+def ler_csv_em_fluxo(blocos, relatorio, max_linhas=CSV_MAX_LINHAS):
+    """Lê o CSV à medida que os bytes chegam e gera {"linha", "nome", "email"} por aluno válido.
+
+    A coluna de e-mail é opcional ("email" fica None sem ela ou com valor
+    inválido). Detecta encoding e delimitador pela primeira amostra, remove nomes
+    repetidos (comparando com normalizar_nome) e para em max_linhas. Cada
+    linha descartada vai para relatorio["erros"]; se o cabeçalho for
+    inválido, relatorio["erro_fatal"] é preenchido e nada é gerado.
+    """
+    blocos = iter(blocos)
+    relatorio.setdefault("erros", [])
+    relatorio.setdefault("linhas_lidas", 0)
+    relatorio.setdefault("duplicados", 0)
+    relatorio.setdefault("vazios", 0)
+
+    amostra = b""
+    for bloco in blocos:
+        amostra += bloco
+        if len(amostra) >= CSV_BLOCO or b"\n" in amostra:
+            break
+    if not amostra:
+        relatorio["erro_fatal"] = "Arquivo CSV vazio."
+        return
+
+    encoding = detectar_encoding(amostra)
+    linhas = _linhas_decodificadas(blocos, amostra, encoding)
+
+    primeira = next(linhas, "")
+    delimitador = detectar_delimitador(primeira)
+    relatorio["encoding"] = encoding
+    relatorio["delimitador"] = delimitador
+
+    reader = csv.reader(itertools.chain([primeira], linhas), delimiter=delimitador)
+    cabecalho = [c.strip().lstrip("\ufeff").lower() for c in next(reader, [])]
+    coluna = next((cabecalho.index(c) for c in CSV_COLUNAS_NOME if c in cabecalho), None)
+    if coluna is None:
+        relatorio["erro_fatal"] = "CSV inválido. Coluna 'name' não encontrada!"
+        return
+    coluna_email = next((cabecalho.index(c) for c in CSV_COLUNAS_EMAIL if c in cabecalho), None)
+
+    vistos = {}
+    validos = 0
+    for row in reader:
+        numero = reader.line_num
+        if not any(c.strip() for c in row):
+            relatorio["vazios"] += 1
+            continue
+
+        relatorio["linhas_lidas"] += 1
+        nome = " ".join(row[coluna].split()) if coluna < len(row) else ""
+
+        if validos >= max_linhas:
+            relatorio["truncado"] = True
+            relatorio["erros"].append({"linha": numero, "erro": f"limite de {max_linhas} linhas atingido", "valor": nome})
+            return
+        erro = erro_no_nome(nome)
+        if erro:
+            relatorio["erros"].append({"linha": numero, "erro": erro, "valor": nome})
+            continue
+
+        normalizado = normalizar_nome(nome)
+        if normalizado in vistos:
+            relatorio["duplicados"] += 1
+            relatorio["erros"].append({"linha": numero, "erro": f"duplicado da linha {vistos[normalizado]}", "valor": nome})
+            continue
+        vistos[normalizado] = numero
+
+        email = row[coluna_email].strip() if coluna_email is not None and coluna_email < len(row) else ""
+        if email and not EMAIL_RE.match(email):
+            # A linha é emitida mesmo assim, só não recebe o e-mail
+            relatorio["erros"].append({"linha": numero, "erro": "e-mail inválido (certificado emitido sem envio)", "valor": email})
+            email = ""
+
+        validos += 1
+        yield {"linha": numero, "nome": nome, "email": email or None}
+
+
+def relatorio_importacao_csv(relatorio):
+    saida = io.StringIO()
+    writer = csv.writer(saida)
+    writer.writerow(["linha", "erro", "valor"])
+    for erro in relatorio.get("erros", []):
+        writer.writerow([erro["linha"], erro["erro"], erro["valor"]])
+    return saida.getvalue()
+
+
+class UploadCsvEmFluxo:
+    """Lê um multipart/form-data direto do corpo da requisição, sem salvar em disco.
+
+    iniciar() avança até o campo de arquivo "file" guardando os campos de
+    texto vistos antes dele; blocos() entrega os bytes do arquivo conforme
+    chegam e, ao final, consome o restante do corpo para capturar campos
+    enviados depois do arquivo.
+    """
+
+    def __init__(self, stream, boundary, campo_arquivo="file"):
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary.encode("latin-1"), max_form_memory_size=CSV_BLOCO * 4)
+        self._campo_arquivo = campo_arquivo
+        self._eventos = self._ler_eventos()
+        self._campo_atual = None
+        self._valor_atual = b""
+        self.campos = {}
+        self.filename = None
+
+    def _ler_eventos(self):
+        while True:
+            bloco = self._stream.read(CSV_BLOCO)
+            self._decoder.receive_data(bloco or None)
+            while True:
+                evento = self._decoder.next_event()
+                if isinstance(evento, NeedData):
+                    break
+                if isinstance(evento, MultipartEpilogue):
+                    return
+                yield evento
+            if not bloco:
+                return
+
+    def _acumular_campo(self, evento):
+        if isinstance(evento, MultipartField):
+            self._campo_atual = evento.name
+            self._valor_atual = b""
+        elif isinstance(evento, MultipartData) and self._campo_atual is not None:
+            self._valor_atual += evento.data
+            if not evento.more_data:
+                self.campos[self._campo_atual] = self._valor_atual.decode("utf-8", "replace")
+                self._campo_atual = None
+
+    def iniciar(self):
+        for evento in self._eventos:
+            if isinstance(evento, MultipartFile) and evento.name == self._campo_arquivo:
+                self.filename = evento.filename
+                return True
+            if isinstance(evento, MultipartFile):
+                self._campo_atual = None
+                continue
+            self._acumular_campo(evento)
+        return False
+
+    def blocos(self):
+        for evento in self._eventos:
+            if not isinstance(evento, MultipartData):
+                break
+            if evento.data:
+                yield evento.data
+            if not evento.more_data:
+                break
+        for evento in self._eventos:
+            self._acumular_campo(evento)
+
+
+##### Pré-visualização do lote (rascunhos, sem gravar nada)
+
+PREVIA_ESCALA = float(os.getenv("PREVIA_ESCALA", 0.25))
+PREVIA_MAX_AMOSTRA = 60
+PREVIA_COLUNAS = 3
+# Com o deslocamento de 200px do nome, ele só cabe inteiro até essa largura (template de 2000px)
+LARGURA_MAX_NOME = 1500
+
+
+def nome_cabe_no_certificado(nome):
+    return cadeia_fontes.largura(nome, tamanho_fonte_nome(nome)) <= LARGURA_MAX_NOME
+
+
+def _montar_folha_contato_worker(itens, dados_turma, escala, colunas):
+    # Roda no pool: monta os rascunhos e cola tudo numa única imagem
+    with coletar_estagios() as estagios:
+        miniaturas = []
+        alertas = []
+        for item in itens:
+            rascunho = montar_certificado_imagem(
+                nome=item["nome"],
+                data_emissao=get_current_date(dados_turma.get("idioma")),
+                codigo="PRÉVIA",
+                base_url="",
+                escala=escala,
+                **dados_turma
+            )
+            if rascunho is None:
+                alertas.append({"linha": item["linha"], "nome": item["nome"], "alerta": "falha ao montar o rascunho"})
+                continue
+            if not nome_cabe_no_certificado(item["nome"]):
+                alertas.append({"linha": item["linha"], "nome": item["nome"], "alerta": "nome pode ultrapassar a margem"})
+            sem_fonte = cadeia_fontes.sem_cobertura(item["nome"])
+            if sem_fonte:
+                alertas.append({
+                    "linha": item["linha"],
+                    "nome": item["nome"],
+                    "alerta": "caracteres sem fonte (sairão como quadrados): " + " ".join(sem_fonte),
+                })
+            miniaturas.append((item, rascunho))
+
+        if not miniaturas:
+            return None, alertas, estagios
+
+        with medir_estagio("contact_sheet"):
+            largura, altura = miniaturas[0][1].size
+            legenda = 24
+            margem = 10
+            linhas = math.ceil(len(miniaturas) / colunas)
+            folha = Image.new("RGB", (
+                colunas * (largura + margem) + margem,
+                linhas * (altura + legenda + margem) + margem
+            ), "white")
+            draw = ImageDraw.Draw(folha)
+            linhas_com_alerta = {a["linha"] for a in alertas}
+
+            for i, (item, rascunho) in enumerate(miniaturas):
+                x = margem + (i % colunas) * (largura + margem)
+                y = margem + (i // colunas) * (altura + legenda + margem)
+                folha.paste(rascunho.convert("RGB"), (x, y))
+                cor = "red" if item["linha"] in linhas_com_alerta else "black"
+                cadeia_fontes.desenhar(draw, (x, y + altura + 4), f"Linha {item['linha']}: {item['nome']}", 14, cor)
+
+        with medir_estagio("png_encode"):
+            img_io = io.BytesIO()
+            folha.save(img_io, "PNG", compress_level=1)
+    return img_io.getvalue(), alertas, estagios
+
+
+def gerar_previa_lote(blocos, turma_id, amostra=12, modo="primeiras", relatorio=None):
+    """Lê o CSV inteiro (para o relatório), escolhe as primeiras N linhas ou uma
+    amostra aleatória e devolve (png_folha_contato, alertas). Só lê a turma do
+    Firestore; nenhum certificado é gravado."""
+    relatorio = relatorio if relatorio is not None else {}
+
+    turma_doc = buscar_documento("turmas", turma_id)
+    if not turma_doc.exists:
+        relatorio["erro_fatal"] = f"Turma com código {turma_id} não encontrada."
+        return None, []
+
+    dados_turma = dados_turma_para_emissao(turma_doc.to_dict())
+
+    # Amostragem por reservatório: uma passada só, memória limitada ao tamanho da amostra
+    escolhidos = []
+    rnd = random.Random()
+    for i, row in enumerate(ler_csv_em_fluxo(blocos, relatorio)):
+        if len(escolhidos) < amostra:
+            escolhidos.append(row)
+        elif modo == "aleatoria":
+            j = rnd.randint(0, i)
+            if j < amostra:
+                escolhidos[j] = row
+
+    if relatorio.get("erro_fatal") or not escolhidos:
+        return None, []
+
+    escolhidos.sort(key=lambda row: row["linha"])
+    png_bytes, alertas, estagios = get_render_pool().render(
+        _montar_folha_contato_worker, escolhidos, dados_turma, PREVIA_ESCALA, PREVIA_COLUNAS,
+        prioridade=PRIORIDADE_INTERATIVA
+    )
+    registrar_estagios(estagios, rota_atual())
+    return png_bytes, alertas
+
+
+def generate_certificates(fonte, base_url, turma_id, relatorio=None, enviar_email=False):
+    """Gera os certificados de um lote.
+
+    fonte pode ser o caminho de um CSV ou um iterável de blocos de bytes (o
+    corpo do upload, lido em fluxo). A renderização começa já nas primeiras
+    linhas; os problemas por linha ficam em relatorio e também vão no ZIP
+    como relatorio_importacao.csv. Reenviar o mesmo CSV depois de uma falha
+    retoma o lote: linhas já emitidas mantêm o código e não são refeitas.
+    Com enviar_email, quem tem e-mail no CSV recebe o certificado em segundo
+    plano depois do ZIP (ver agendar_envio_emails).
+    """
+    inicio_lote = time.perf_counter()
+    resumo = {"emitidos": 0, "retomados": 0, "renders_reaproveitados": 0, "falhas": 0}
+    destinatarios = []
+    relatorio = relatorio if relatorio is not None else {}
+    arquivo = None
+
     try:
-        logger.info(f"🚀 Iniciando geração de certificados em lote para a turma {turma_id}")
+        logger.debug("🚀 Iniciando geração de certificados em lote para a turma %s", turma_id)
+
+        # ✅ Verifica se o CSV existe
+        if isinstance(fonte, str):
+            if not os.path.exists(fonte):
+                logger.error("❌ Arquivo CSV não encontrado: %s", fonte)
+                return None
+            arquivo = open(fonte, "rb")
+            blocos = _blocos_do_arquivo(arquivo)
+        else:
+            blocos = fonte
+
+        # ✅ Busca dados da turma no Firestore
+        turma_doc = buscar_documento("turmas", turma_id)
+
+        if not turma_doc.exists:
+            logger.error("❌ Turma com ID %s não encontrada no Firestore", turma_id)
+            relatorio["erro_fatal"] = f"Turma com código {turma_id} não encontrada."
+            return None
+
+        turma_data = turma_doc.to_dict()
+
+        # ✅ Captura todos os dados relevantes da turma (e fixa o template)
+        dados_turma = dados_turma_para_emissao(turma_data)
+
+        logger.debug(
+            "✅ Turma encontrada: %s | Data do evento: %s | Treinamento: %s | Carga horária: %s",
+            dados_turma["turma_nome"], dados_turma["data_evento"], dados_turma["nome_treinamento"], dados_turma["carga_horaria"]
+        )
+
+        # ✅ Limpa a pasta de saída
+        clear_output_folder()
+        logger.debug("🧹 Pasta %s limpa para novos certificados", OUTPUT_FOLDER)
+
+        # ✅ Processa cada linha do CSV, mantendo até RENDER_WORKERS renderizações em andamento.
+        # Cada linha tem um checkpoint no índice de emissões: numa nova tentativa (mesmo CSV
+        # reenviado depois de uma queda) as linhas prontas são puladas e só o que falta é
+        # renderizado ou registrado, sempre com o mesmo código.
+        em_andamento = collections.deque()
+
+        def finalizar(item):
+            situacao = concluir_emissao_lote(item, turma_id, dados_turma)
+            if situacao.startswith("falha"):
+                logger.error("❌ Certificado de %s não emitido (%s), continuando para o próximo...", item["nome"], situacao)
+                resumo["falhas"] += 1
+                return
+            if item["future"] is None:
+                # Renderizado numa tentativa anterior
+                resumo["renders_reaproveitados"] += 1
+
+            # ✅ Salva o certificado na pasta de saída
+            output_file = os.path.join(OUTPUT_FOLDER, f"{item['nome'].replace(' ', '_')}_certificate.png")
+            with open(output_file, "wb") as f:
+                f.write(item["png"] if item["png"] is not None else item["artefato"].ler())
+            logger.debug("✅ Certificado salvo: %s", output_file)
+
+            resumo["emitidos" if situacao == "emitido" else "retomados"] += 1
+            if item["email"]:
+                destinatarios.append({"nome": item["nome"], "email": item["email"], "codigo": item["estado"]["codigo"]})
+
+        for row in ler_csv_em_fluxo(blocos, relatorio):
+            logger.debug("📝 Gerando certificado para: %s", row["nome"])
+            item = iniciar_emissao_lote(turma_id, row["nome"], dados_turma, base_url, turma_data.get("renderizado_em"))
+            item["email"] = row["email"]
+            em_andamento.append(item)
+
+            if len(em_andamento) >= max(RENDER_WORKERS, 1):
+                finalizar(em_andamento.popleft())
+
+        while em_andamento:
+            finalizar(em_andamento.popleft())
+
+        if relatorio.get("erro_fatal"):
+            logger.error("❌ %s", relatorio["erro_fatal"])
+            return None
+
+        # ✅ Compacta tudo em um arquivo ZIP
+        zip_filename = "certificates.zip"
+        zip_path = os.path.join(OUTPUT_FOLDER, zip_filename)
+
+        with medir_estagio("zip"), zipfile.ZipFile(zip_path, 'w') as zipf:
+            for file in os.listdir(OUTPUT_FOLDER):
+                if file.endswith(".png"):
+                    zipf.write(os.path.join(OUTPUT_FOLDER, file), file)
+            if relatorio.get("erros"):
+                zipf.writestr("relatorio_importacao.csv", relatorio_importacao_csv(relatorio))
+
+        if enviar_email and destinatarios:
+            relatorio["emails_agendados"] = agendar_envio_emails(destinatarios, turma_id, dados_turma, base_url)
+
+        log_evento(
+            logging.INFO,
+            "lote_concluido",
+            turma_id=turma_id,
+            duracao_s=round(time.perf_counter() - inicio_lote, 3),
+            zip=zip_path,
+            linhas_lidas=relatorio.get("linhas_lidas", 0),
+            erros_linha=len(relatorio.get("erros", [])),
+            duplicados=relatorio.get("duplicados", 0),
+            encoding=relatorio.get("encoding"),
+            emails_agendados=relatorio.get("emails_agendados", 0),
+            **resumo
+        )
+
+        return zip_path
+
+    except Exception as e:
+        logger.error("❌ Erro ao gerar certificados em lote: %s", e)
+        return None
+
+    finally:
+        if arquivo is not None:
+            arquivo.close()
+
+
+##### Envio dos certificados por e-mail
+# Sem SMTP_HOST o envio fica desativado. Para testar com um SMTP local que só
+# imprime as mensagens: python -m smtpd -n -c DebuggingServer localhost:1025
+# (ou aiosmtpd) e SMTP_HOST=localhost SMTP_PORTA=1025 SMTP_SEGURANCA=nenhum.
+
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORTA = int(os.getenv("SMTP_PORTA", 587))
+SMTP_SEGURANCA = os.getenv("SMTP_SEGURANCA", "starttls")  # "starttls", "ssl" ou "nenhum"
+SMTP_USUARIO = os.getenv("SMTP_USUARIO")
+SMTP_SENHA = os.getenv("SMTP_SENHA")
+SMTP_REMETENTE = os.getenv("SMTP_REMETENTE", SMTP_USUARIO or "certificados@localhost")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 30))
+SMTP_CONEXOES = int(os.getenv("SMTP_CONEXOES", 4))  # envios simultâneos (uma conexão cada)
+SMTP_MENSAGENS_POR_CONEXAO = int(os.getenv("SMTP_MENSAGENS_POR_CONEXAO", 100))  # provedores limitam por sessão
+SMTP_OCIOSA_S = 60  # conexão parada há mais tempo é testada com NOOP antes do uso
+SMTP_TENTATIVAS = int(os.getenv("SMTP_TENTATIVAS", 3))
+SMTP_ESPERA_S = float(os.getenv("SMTP_ESPERA_S", 2))  # dobra a cada tentativa
+EMAIL_ANEXO = os.getenv("EMAIL_ANEXO", "png")  # "png" anexa o certificado; "nenhum" manda só os links
+ENVIOS_STATUS_LOTE = 100  # registros de status gravados por commit durante o envio
+
+
+class PoolSmtp:
+    """Conexões SMTP persistentes, reaproveitadas entre mensagens e limitadas a `maximo` em uso."""
+
+    def __init__(self, maximo, mensagens_por_conexao):
+        self.mensagens_por_conexao = mensagens_por_conexao
+        self._vagas = threading.BoundedSemaphore(maximo)
+        self._livres = queue.LifoQueue()
+        self._abertas = 0
+        self._lock = threading.Lock()
+
+    def _abrir(self):
+        if SMTP_SEGURANCA == "ssl":
+            smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORTA, timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORTA, timeout=SMTP_TIMEOUT)
+            if SMTP_SEGURANCA == "starttls":
+                smtp.starttls()
+        if SMTP_USUARIO:
+            smtp.login(SMTP_USUARIO, SMTP_SENHA or "")
+        with self._lock:
+            self._abertas += 1
+        return smtp
+
+    def _fechar(self, smtp):
+        with contextlib.suppress(Exception):
+            smtp.quit()
+        with self._lock:
+            self._abertas -= 1
+
+    def _pegar(self):
+        while True:
+            try:
+                smtp, enviadas, usada_em = self._livres.get_nowait()
+            except queue.Empty:
+                return self._abrir(), 0
+            if time.monotonic() - usada_em < SMTP_OCIOSA_S:
+                return smtp, enviadas
+            try:
+                # O servidor pode ter derrubado a sessão ociosa
+                if smtp.noop()[0] == 250:
+                    return smtp, enviadas
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._fechar(smtp)
+
+    def enviar(self, mensagem):
+        with self._vagas:
+            smtp, enviadas = self._pegar()
+            try:
+                smtp.send_message(mensagem)
+            except BaseException:
+                # Depois de um erro o estado da sessão é incerto: descarta a conexão
+                self._fechar(smtp)
+                raise
+            enviadas += 1
+            if enviadas >= self.mensagens_por_conexao:
+                self._fechar(smtp)
+            else:
+                self._livres.put((smtp, enviadas, time.monotonic()))
+
+    def fechar_ociosas(self):
+        while True:
+            try:
+                smtp, _, _ = self._livres.get_nowait()
+            except queue.Empty:
+                return
+            self._fechar(smtp)
+
+    def stats(self):
+        with self._lock:
+            return {"conexoes_abertas": self._abertas, "conexoes_livres": self._livres.qsize()}
+
+
+pool_smtp = PoolSmtp(SMTP_CONEXOES, SMTP_MENSAGENS_POR_CONEXAO)
+atexit.register(pool_smtp.fechar_ociosas)
+
+
+def id_envio(codigo, email):
+    return hashlib.sha256(f"{codigo}|{email.casefold()}".encode("utf-8")).hexdigest()[:32]
+
+
+def montar_email_certificado(destinatario, dados_turma, base_url):
+    urls = urls_certificado(destinatario["codigo"], base_url)
+    mensagem = EmailMessage()
+    mensagem["Subject"] = f"Seu certificado: {dados_turma['nome_treinamento']}"
+    mensagem["From"] = SMTP_REMETENTE
+    mensagem["To"] = destinatario["email"]
+    mensagem["Message-ID"] = make_msgid(domain=SMTP_REMETENTE.rpartition("@")[2] or None)
+    mensagem.set_content(
+        f"Olá, {destinatario['nome']}!\n\n"
+        f"Seu certificado do treinamento \"{dados_turma['nome_treinamento']}\" "
+        f"({dados_turma['turma_nome']}) está disponível.\n\n"
+        f"Ver e compartilhar: {urls['url_conquista']}\n"
+        f"Baixar: {urls['url_certificado']}\n"
+        f"Validar (código {destinatario['codigo']}): {urls['url_validacao']}\n"
+    )
+
+    if EMAIL_ANEXO == "png":
+        artefato = armazem_artefatos.obter(destinatario["codigo"], "png")
+        if artefato is not None:
+            nome_arquivo = _nome_no_arquivo(destinatario["nome"], destinatario["codigo"])
+            mensagem.add_attachment(artefato.ler(), maintype="image", subtype="png", filename=nome_arquivo)
+    return mensagem
+
+
+def enviar_email_certificado(destinatario, dados_turma, base_url):
+    """Envia com novas tentativas em erros temporários. Devolve (status, erro, tentativas)."""
+    erro = None
+    for tentativa in range(1, SMTP_TENTATIVAS + 1):
+        try:
+            pool_smtp.enviar(montar_email_certificado(destinatario, dados_turma, base_url))
+            return "enviado", None, tentativa
+        except smtplib.SMTPRecipientsRefused as e:
+            return "falha", f"destinatário recusado: {e.recipients}", tentativa
+        except smtplib.SMTPResponseException as e:
+            erro = f"{e.smtp_code} {e.smtp_error!r}"
+            if e.smtp_code >= 500:
+                # Erro permanente: repetir não muda o resultado
+                return "falha", erro, tentativa
+        except (smtplib.SMTPException, OSError) as e:
+            erro = str(e) or type(e).__name__
+        if tentativa < SMTP_TENTATIVAS:
+            time.sleep(SMTP_ESPERA_S * 2 ** (tentativa - 1) * random.uniform(0.5, 1.5))
+    return "falha", erro, SMTP_TENTATIVAS
+
+
+def enviar_certificados_por_email(destinatarios, turma_id, dados_turma, base_url):
+    """Envia os certificados de um lote e mantém um registro por mensagem em "envios".
+
+    Quem já tem status "enviado" (lote reenviado ou retomado) é pulado. Os
+    registros são gravados em WriteBatches: todos como "pendente" antes de
+    começar e depois em blocos, conforme as mensagens saem.
+    """
+    inicio = time.perf_counter()
+    por_id = {id_envio(d["codigo"], d["email"]): d for d in destinatarios}
+    ja_enviados = {
+        doc_id for doc_id, snapshot in buscar_documentos("envios", por_id, campos=["status"]).items()
+        if snapshot.exists and snapshot.to_dict().get("status") == "enviado"
+    }
+    pendentes = {doc_id: d for doc_id, d in por_id.items() if doc_id not in ja_enviados}
+
+    agora = datetime.now(timezone.utc)
+    gravar_em_lotes("envios", {
+        doc_id: {
+            "codigo": d["codigo"],
+            "email": d["email"],
+            "nome": d["nome"],
+            "turma_id": turma_id,
+            "status": "pendente",
+            "atualizado_em": agora,
+        }
+        for doc_id, d in pendentes.items()
+    })
+
+    contagem = {"enviado": 0, "falha": 0}
+    registros = {}
+    with ThreadPoolExecutor(max_workers=max(SMTP_CONEXOES, 1), thread_name_prefix="smtp") as executor:
+        futures = {
+            executor.submit(enviar_email_certificado, d, dados_turma, base_url): doc_id
+            for doc_id, d in pendentes.items()
+        }
+        for future in as_completed(futures):
+            try:
+                status, erro, tentativas = future.result()
+            except Exception as e:
+                status, erro, tentativas = "falha", str(e), 0
+            contagem[status] += 1
+            metricas.incrementar("emails_total", status=status)
+            registros[futures[future]] = {
+                "status": status,
+                "erro": erro,
+                "tentativas": tentativas,
+                "atualizado_em": datetime.now(timezone.utc),
+            }
+            if len(registros) >= ENVIOS_STATUS_LOTE:
+                gravar_em_lotes("envios", registros)
+                registros = {}
+    if registros:
+        gravar_em_lotes("envios", registros)
+
+    log_evento(
+        logging.INFO,
+        "emails_enviados",
+        turma_id=turma_id,
+        total=len(por_id),
+        ja_enviados=len(ja_enviados),
+        enviados=contagem["enviado"],
+        falhas=contagem["falha"],
+        duracao_s=round(time.perf_counter() - inicio, 3),
+    )
+    return contagem
+
+
+def agendar_envio_emails(destinatarios, turma_id, dados_turma, base_url):
+    """Dispara o envio em segundo plano; devolve quantos e-mails foram agendados."""
+    if not SMTP_HOST:
+        logger.warning("⚠️ Envio por e-mail pedido, mas SMTP_HOST não está configurado")
+        return 0
+
+    def enviar():
+        try:
+            enviar_certificados_por_email(destinatarios, turma_id, dados_turma, base_url)
+        except Exception as e:
+            # Os registros que ficaram "pendente" são enviados ao reenviar o lote
+            logger.error("❌ Erro no envio de e-mails da turma %s: %s", turma_id, e)
+
+    threading.Thread(target=enviar, name=f"emails-{turma_id}", daemon=True).start()
+    return len(destinatarios)
+
+
+##### Reemissão da turma (correção de dados)
+
+REEMISSAO_PROGRESSO_S = float(os.getenv("REEMISSAO_PROGRESSO_S", 2))
+
+# Campo da turma -> campo copiado no certificado por save_certificate_to_firestore
+CAMPOS_TURMA_NO_CERTIFICADO = {
+    "nome": "turma_nome",
+    "data_evento": "data_evento",
+    "nome_treinamento": "nome_treinamento",
+    "carga_horaria": "carga_horaria",
+    "idioma": "idioma",
+}
+
+
+def certificados_da_turma(turma_id):
+    """[(codigo, dados)] de todos os certificados da turma (lote e /aluno)."""
+    consulta = db.collection("certificados").where(filter=firestore.FieldFilter("turma_id", "==", turma_id))
+    with metricas.medir("firestore_segundos", operacao="consulta", colecao="certificados"):
+        return [(doc.id, doc.to_dict()) for doc in consulta.stream()]
+
+
+def reemitir_turma(turma_id, base_url):
+    """Aplica os dados atuais da turma a todos os certificados dela e renderiza de novo.
+
+    Código, nome, data de emissão e template de cada certificado são mantidos (a
+    data só é reescrita quando o idioma da turma muda). Os registros alterados
+    ganham um renderizado_em novo, gravado nos mesmos WriteBatches: as outras
+    instâncias passam a ignorar as imagens anteriores a ele. As imagens são
+    renderizadas no pool (prioridade de lote) e substituem as do armazém.
+
+    Reenviar o formulário retoma uma reemissão interrompida: certificados que já
+    têm os dados da turma e imagem atual neste armazém são pulados. Gera o
+    progresso ({"feitos", "total", "falhas", "certificados_por_s", "concluido"}).
+    """
+    inicio = time.perf_counter()
+    turma_data = buscar_documento("turmas", turma_id).to_dict() or {}
+    campos = {
+        campo_certificado: turma_data[campo_turma]
+        for campo_turma, campo_certificado in CAMPOS_TURMA_NO_CERTIFICADO.items()
+        if turma_data.get(campo_turma)
+    }
+
+    certificados = certificados_da_turma(turma_id)
+    progresso = {"feitos": 0, "total": len(certificados), "falhas": 0, "certificados_por_s": 0.0, "concluido": False}
+
+    renderizado_em = datetime.now(timezone.utc)
+    atualizacoes, pendentes = {}, []
+    for codigo, dados in certificados:
+        novos = dict(campos)
+        if "idioma" in campos:
+            # A data de emissão é gravada por extenso: acompanha o idioma novo
+            novos["data_emissao"] = data_no_idioma(dados.get("data_emissao"), campos["idioma"])
+        if dados.get("renderizado_em") is None or any(dados.get(campo) != valor for campo, valor in novos.items()):
+            novos["renderizado_em"] = renderizado_em
+            atualizacoes[codigo] = novos
+            dados.update(novos)
+        elif all(artefato_atual(armazem_artefatos.obter(codigo, tipo), dados["renderizado_em"]) for tipo in TIPOS_ARTEFATO):
+            # Já reemitido com estes dados (execução anterior interrompida)
+            progresso["feitos"] += 1
+            continue
+        pendentes.append((codigo, dados))
+
+    if atualizacoes:
+        atualizar_em_lotes("certificados", atualizacoes)
+        # O lote por CSV compara as imagens guardadas com a reemissão da turma
+        atualizar_documento("turmas", turma_id, {"renderizado_em": renderizado_em})
+
+    em_andamento = collections.deque()
+    ultimo_aviso = time.perf_counter()
+
+    def finalizar(item):
+        codigo, future = item
+        artefatos = future.result()
+        if artefatos:
+            # Sobrescreve PNG, prévia e card: a ETag muda e os clientes buscam a versão nova
+            guardar_artefatos(codigo, artefatos)
+        else:
+            logger.error("❌ Falha ao reemitir o certificado %s", codigo)
+            progresso["falhas"] += 1
+        progresso["feitos"] += 1
+        progresso["certificados_por_s"] = round(progresso["feitos"] / (time.perf_counter() - inicio), 2)
+
+    for codigo, dados in pendentes:
+        em_andamento.append((codigo, enviar_artefatos(prioridade=PRIORIDADE_LOTE, **dados_para_render(codigo, dados, base_url))))
+        if len(em_andamento) >= max(RENDER_WORKERS, 1):
+            finalizar(em_andamento.popleft())
+        if time.perf_counter() - ultimo_aviso >= REEMISSAO_PROGRESSO_S:
+            ultimo_aviso = time.perf_counter()
+            yield dict(progresso)
+
+    while em_andamento:
+        finalizar(em_andamento.popleft())
+
+    # O ZIP guardado da turma (em qualquer instância) leva a revisão anterior no
+    # carimbo e é refeito na próxima exportação
+    progresso["concluido"] = True
+    log_evento(
+        logging.INFO,
+        "turma_reemitida",
+        turma_id=turma_id,
+        total=progresso["total"],
+        falhas=progresso["falhas"],
+        duracao_s=round(time.perf_counter() - inicio, 3),
+        certificados_por_s=progresso["certificados_por_s"],
+    )
+    yield dict(progresso)
+
+
+##### Arquivo da turma (ZIP com todos os certificados)
+
+def _caminho_arquivo_turma(turma_id):
+    return os.path.join(ARQUIVOS_TURMA_FOLDER, f"{turma_id}.zip")
+
+
+def _nome_no_arquivo(nome, codigo):
+    # O código vai no fim do nome: é por ele que se sabe o que já está no ZIP
+    return "{}_{}.png".format(re.sub(r"[^\w.-]+", "_", nome or "certificado"), codigo)
+
+
+def descartar_arquivo_turma(turma_id):
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(_caminho_arquivo_turma(turma_id))
+
+
+def _carimbo_arquivo_turma(certificados):
+    # Revisão mais recente dos certificados (renderizado_em da reemissão), gravada no
+    # comentário do ZIP: carimbo diferente quer dizer imagens de antes da reemissão
+    revisoes = [dados["renderizado_em"] for _, dados in certificados if dados.get("renderizado_em")]
+    return f"{max(revisoes).timestamp():.6f}".encode("ascii") if revisoes else b""
+
+
+def arquivo_turma(turma_id, base_url):
+    """Caminho do ZIP com todos os certificados da turma (lote e /aluno).
+
+    O ZIP fica guardado por turma. A cada exportação só entram os certificados
+    emitidos depois da anterior: os que já estão no armazém são copiados dele e os
+    que faltam são renderizados no pool. O acréscimo é feito numa cópia trocada com
+    os.replace(), então downloads em andamento seguem lendo a versão anterior.
+    Depois de uma reemissão o carimbo do ZIP não bate mais e ele é refeito inteiro.
+    """
+    inicio = time.perf_counter()
+    caminho = _caminho_arquivo_turma(turma_id)
+
+    with _lock_emissao(f"arquivo_turma:{turma_id}"):
+        certificados = certificados_da_turma(turma_id)
+        carimbo = _carimbo_arquivo_turma(certificados)
+        incluidos, atual = set(), False
+        try:
+            with zipfile.ZipFile(caminho) as zipf:
+                atual = zipf.comment == carimbo
+                if atual:
+                    incluidos = {nome[:-len(".png")].rsplit("_", 1)[-1] for nome in zipf.namelist()}
+                else:
+                    logger.info("🔁 ZIP da turma %s é anterior à última reemissão, refazendo", turma_id)
+        except FileNotFoundError:
+            pass
+        except zipfile.BadZipFile as e:
+            logger.warning("⚠️ ZIP da turma %s corrompido, refazendo: %s", turma_id, e)
+            descartar_arquivo_turma(turma_id)
+
+        novos = [(codigo, dados) for codigo, dados in certificados if codigo not in incluidos]
+        if not novos and atual:
+            registrar_cache("arquivo_turma", True)
+            return caminho
+        registrar_cache("arquivo_turma", False)
+
+        resumo = {"copiados": 0, "renderizados": 0, "falhas": 0}
+        temporario = f"{caminho}.{uuid.uuid4().hex}.tmp"
+        try:
+            if incluidos:
+                shutil.copyfile(caminho, temporario)
+
+            # PNG já é comprimido: ZIP_STORED só empacota
+            with zipfile.ZipFile(temporario, "a") as zipf:
+                zipf.comment = carimbo
+                em_andamento = collections.deque()
+
+                def finalizar(item):
+                    codigo, dados, future = item
+                    artefatos = future.result()
+                    if not artefatos:
+                        logger.error("❌ Falha ao renderizar %s para o ZIP da turma %s", codigo, turma_id)
+                        resumo["falhas"] += 1
+                        return
+                    guardar_artefatos(codigo, artefatos)
+                    zipf.writestr(_nome_no_arquivo(dados.get("nome"), codigo), artefatos["png"])
+                    resumo["renderizados"] += 1
+
+                for codigo, dados in novos:
+                    artefato = armazem_artefatos.obter(codigo, "png")
+                    if artefato_atual(artefato, dados.get("renderizado_em")):
+                        if artefato.caminho:
+                            zipf.write(artefato.caminho, _nome_no_arquivo(dados.get("nome"), codigo))
+                        else:
+                            zipf.writestr(_nome_no_arquivo(dados.get("nome"), codigo), artefato.ler())
+                        resumo["copiados"] += 1
+                        continue
+
+                    em_andamento.append((codigo, dados, enviar_artefatos(
+                        prioridade=PRIORIDADE_LOTE, **dados_para_render(codigo, dados, base_url)
+                    )))
+                    if len(em_andamento) >= max(RENDER_WORKERS, 1):
+                        finalizar(em_andamento.popleft())
+
+                while em_andamento:
+                    finalizar(em_andamento.popleft())
+
+            os.replace(temporario, caminho)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temporario)
+
+    log_evento(
+        logging.INFO,
+        "arquivo_turma_atualizado",
+        turma_id=turma_id,
+        ja_incluidos=len(incluidos),
+        duracao_s=round(time.perf_counter() - inicio, 3),
+        bytes=os.path.getsize(caminho),
+        **resumo
+    )
+    return caminho
+
+
+##### Validação em lote (API JSON)
+
+VALIDACAO_LOTE_MAX = int(os.getenv("VALIDACAO_LOTE_MAX", 1000))
+CAMPOS_VALIDACAO = ["nome", "data_emissao", "turma_nome", "data_evento", "nome_treinamento", "carga_horaria"]
+
+
+def validar_codigos(codigos, base_url):
+    """Gera um resultado por código, na ordem recebida, sem renderizar nada.
+
+    Códigos inválidos ou descartados pelo filtro de códigos emitidos não vão ao
+    Firestore; os demais são lidos com get_all() em grupos, só com os campos exibidos.
+    """
+    inicio = time.perf_counter()
+    contagem = {"valido": 0, "nao_encontrado": 0, "invalido": 0}
+    leituras = 0
+
+    for posicao in range(0, len(codigos), FIRESTORE_LEITURAS_POR_LOTE):
+        grupo = codigos[posicao:posicao + FIRESTORE_LEITURAS_POR_LOTE]
+        situacoes = {codigo: verificar_codigo(codigo) for codigo in grupo}
+        consultar = [codigo for codigo in situacoes if not codigo_descartado(codigo, situacoes[codigo])]
+        documentos = buscar_documentos("certificados", consultar, CAMPOS_VALIDACAO) if consultar else {}
+        leituras += len(consultar)
+        for codigo in consultar:
+            doc = documentos.get(codigo)
+            filtro_codigos.confirmar(codigo, doc is not None and doc.exists)
+
+        for codigo in grupo:
+            doc = documentos.get(codigo)
+            if situacoes[codigo] == "invalido":
+                resultado = {"codigo": codigo, "status": "invalido"}
+            elif doc is None or not doc.exists:
+                resultado = {"codigo": codigo, "status": "nao_encontrado"}
+            else:
+                dados = doc.to_dict()
+                resultado = {
+                    "codigo": codigo,
+                    "status": "valido",
+                    **{campo: dados.get(campo) for campo in CAMPOS_VALIDACAO},
+                    "url_validacao": f"{base_url}/validar?codigo={quote_plus(codigo)}",
+                    "url_certificado": f"{base_url}/certificado/{quote_plus(codigo)}",
+                }
+            contagem[resultado["status"]] += 1
+            yield resultado
+
+    log_evento(
+        logging.INFO,
+        "validacao_lote",
+        total=len(codigos),
+        leituras_firestore=leituras,
+        duracao_s=round(time.perf_counter() - inicio, 3),
+        **contagem
+    )
+
+
+def ler_codigos_validacao():
+    """Códigos do corpo da requisição: JSON ({"codigos": [...]} ou lista) ou NDJSON.
+
+    Devolve (codigos, None) ou (None, mensagem de erro).
+    """
+    if request.mimetype == "application/x-ndjson":
+        try:
+            itens = [json.loads(linha) for linha in request.get_data(as_text=True).splitlines() if linha.strip()]
+        except ValueError as e:
+            return None, f"NDJSON inválido: {e}"
+    else:
+        corpo = request.get_json(silent=True)
+        itens = corpo.get("codigos") if isinstance(corpo, dict) else corpo
+        if not isinstance(itens, list):
+            return None, 'Envie {"codigos": [...]}, uma lista JSON ou NDJSON (um código por linha).'
 
-        # ✅ Verifica se o CSV existe
-        if not os.path.exists(csv_path):
-            logger.error(f"❌ Arquivo CSV não encontrado: {csv_path}")
-            return None
+    codigos = []
+    for item in itens:
+        codigo = item.get("codigo") if isinstance(item, dict) else item
+        if not isinstance(codigo, str):
+            return None, f"Código inválido na posição {len(codigos)}: {item!r}"
+        codigos.append(normalizar_codigo(codigo))
+    return codigos, None
 
-        # ✅ Busca dados da turma no Firestore
-        turma_ref = db.collection("turmas").document(turma_id)
-        turma_doc = turma_ref.get()
 
-        if not turma_doc.exists:
-            logger.error(f"❌ Turma com ID {turma_id} não encontrada no Firestore")
-            return None
+def quer_ndjson(padrao=False):
+    if request.args.get("formato"):
+        return request.args.get("formato") == "ndjson"
+    if not request.accept_mimetypes:
+        return padrao
+    # Com Accept: */* vale o primeiro da lista, isto é, o padrão da rota
+    opcoes = ["application/json", "application/x-ndjson"]
+    return request.accept_mimetypes.best_match(opcoes[::-1] if padrao else opcoes) == "application/x-ndjson"
 
-        turma_data = turma_doc.to_dict()
 
-        # ✅ Captura todos os dados relevantes da turma
-        nome_turma = turma_data.get("nome", "Turma sem nome")
-        data_evento = turma_data.get("data_evento", "Data do evento não informada")
-        nome_treinamento = turma_data.get("nome_treinamento", "Treinamento não especificado")
-        carga_horaria = turma_data.get("carga_horaria", "Carga horária não informada")
+##### API de emissão (JSON, v1)
 
-        logger.info(f"✅ Turma encontrada: {nome_turma} | Data do evento: {data_evento} | Treinamento: {nome_treinamento} | Carga horária: {carga_horaria}")
+API_PREFIXO = "/api/v1"
+# Com API_TOKEN definido, a emissão pela API exige "Authorization: Bearer <token>"
+API_TOKEN = os.getenv("API_TOKEN")
 
-        # ✅ Limpa a pasta de saída
-        clear_output_folder()
-        logger.info(f"🧹 Pasta {OUTPUT_FOLDER} limpa para novos certificados")
 
-        # ✅ Processa o CSV
-        with open(csv_path, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
+def api_autorizada():
+    if not API_TOKEN:
+        return True
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {API_TOKEN}")
 
-            if "name" not in reader.fieldnames:
-                logger.error("❌ CSV inválido. Coluna 'name' não encontrada!")
-                return None
 
-            # ✅ Processa cada linha do CSV
-            for row in reader:
-                name = row["name"].strip()
+def urls_certificado(codigo, base_url):
+    codigo = quote_plus(codigo)
+    return {
+        "url_validacao": f"{base_url}/validar?codigo={codigo}",
+        "url_certificado": f"{base_url}/certificado/{codigo}",
+        "url_conquista": f"{base_url}/conquista/{codigo}",
+    }
 
-                if not name:
-                    logger.warning("⚠️ Nome vazio encontrado no CSV, pulando...")
-                    continue
 
-                logger.info(f"📝 Gerando certificado para: {name}")
+def ler_destinatarios():
+    """Destinatários do corpo: JSON ({"destinatarios": [...]} ou lista) ou NDJSON,
+    cada um {"nome": ...} ou só o nome. Devolve (nomes, None) ou (None, erro)."""
+    if request.mimetype == "application/x-ndjson":
+        try:
+            itens = [json.loads(linha) for linha in request.get_data(as_text=True).splitlines() if linha.strip()]
+        except ValueError as e:
+            return None, f"NDJSON inválido: {e}"
+    else:
+        corpo = request.get_json(silent=True)
+        itens = corpo.get("destinatarios") if isinstance(corpo, dict) else corpo
+        if not isinstance(itens, list):
+            return None, 'Envie {"destinatarios": [...]}, uma lista JSON ou NDJSON (um destinatário por linha).'
+
+    nomes = []
+    for item in itens:
+        nome = item.get("nome") if isinstance(item, dict) else item
+        if not isinstance(nome, str):
+            return None, f"Destinatário inválido na posição {len(nomes)}: {item!r}"
+        nomes.append(" ".join(nome.split()))
+    return nomes, None
+
+
+def emitir_lote_api(turma_id, turma_data, nomes, base_url):
+    """Emite para cada nome e gera um resultado por destinatário assim que ele fica pronto.
+
+    Usa os mesmos checkpoints do lote por CSV: reenviar a mesma lista não duplica
+    nada e devolve os mesmos códigos. Cada resultado traz o "indice" do
+    destinatário na lista, porque a ordem de chegada é a de conclusão.
+    """
+    inicio = time.perf_counter()
+    dados_turma = dados_turma_para_emissao(turma_data)
+    contagem = {"emitido": 0, "reaproveitado": 0, "erro": 0}
+    pendentes = {}
+    vistos = {}
+
+    def resultado(item):
+        situacao = concluir_emissao_lote(item, turma_id, dados_turma)
+        if situacao.startswith("falha"):
+            linha = {"indice": item["indice"], "nome": item["nome"], "status": "erro", "erro": situacao, "codigo": item["estado"]["codigo"]}
+        else:
+            linha = {
+                "indice": item["indice"],
+                "nome": item["nome"],
+                "status": "emitido" if situacao == "emitido" else "reaproveitado",
+                "codigo": item["estado"]["codigo"],
+                **urls_certificado(item["estado"]["codigo"], base_url),
+            }
+        contagem[linha["status"]] += 1
+        return linha
+
+    def concluir_prontos(limite):
+        while len(pendentes) > limite:
+            prontos, _ = wait(list(pendentes), return_when=FIRST_COMPLETED)
+            for future in prontos:
+                yield resultado(pendentes.pop(future))
+
+    for indice, nome in enumerate(nomes):
+        erro = erro_no_nome(nome)
+        normalizado = normalizar_nome(nome)
+        if not erro and normalizado in vistos:
+            erro = f"duplicado do destinatário {vistos[normalizado]}"
+        if erro:
+            contagem["erro"] += 1
+            yield {"indice": indice, "nome": nome, "status": "erro", "erro": erro}
+            continue
+        vistos[normalizado] = indice
+
+        item = iniciar_emissao_lote(turma_id, nome, dados_turma, base_url, turma_data.get("renderizado_em"))
+        item["indice"] = indice
+        if item["future"] is None:
+            yield resultado(item)
+            continue
+        pendentes[item["future"]] = item
+        yield from concluir_prontos(max(RENDER_WORKERS, 1) - 1)
+
+    yield from concluir_prontos(0)
+
+    log_evento(
+        logging.INFO,
+        "lote_api_concluido",
+        turma_id=turma_id,
+        total=len(nomes),
+        duracao_s=round(time.perf_counter() - inicio, 3),
+        **contagem
+    )
 
-                date = get_current_date()
-                unique_hash = str(uuid.uuid4())[:16]
 
-                # ✅ Gera o certificado com as infos completas
-                certificate = montar_certificado_imagem(
-                    nome=name,
-                    data_emissao=date,
-                    codigo=unique_hash,
-                    base_url=base_url,
-                    turma_nome=nome_turma,
-                    data_evento=data_evento,
-                    nome_treinamento=nome_treinamento,
-                    carga_horaria=carga_horaria
+##### Fila de eventos do LMS (emissão automática)
+
+FILA_BACKEND = os.getenv("FILA_BACKEND", "sqlite")
+FILA_ARQUIVO = os.getenv("FILA_ARQUIVO", "fila_eventos.sqlite3")
+FILA_CONSUMIDORES = int(os.getenv("FILA_CONSUMIDORES", 2))
+FILA_LOTE_MAX = int(os.getenv("FILA_LOTE_MAX", 200))  # eventos de uma turma por lote
+# Espera antes de consumir um evento novo, para juntar a rajada da turma num lote só
+FILA_JANELA_S = float(os.getenv("FILA_JANELA_S", 2))
+FILA_VISIBILIDADE_S = int(os.getenv("FILA_VISIBILIDADE_S", 600))  # reserva de consumidor que sumiu expira
+FILA_MAX_TENTATIVAS = int(os.getenv("FILA_MAX_TENTATIVAS", 5))
+FILA_ESPERA_TENTATIVA_S = float(os.getenv("FILA_ESPERA_TENTATIVA_S", 30))  # dobra a cada tentativa
+FILA_RETENCAO_S = int(os.getenv("FILA_RETENCAO_S", 7 * 24 * 3600))  # eventos concluídos ficam para auditoria
+FILA_INTERVALO_S = float(os.getenv("FILA_INTERVALO_S", 1))
+FILA_TIPOS_CONCLUSAO = {"curso_concluido", "course_completed"}
+
+
+class FilaSQLite:
+    """Fila durável de eventos de conclusão num arquivo SQLite local (WAL): sobrevive
+    a reinícios da instância.
+
+    Entrega pelo menos uma vez: um evento reservado e não concluído volta para a
+    fila. Repetir a emissão é seguro (ver retomar_emissao). Um broker de verdade
+    (Pub/Sub, SQS) entra como outra classe com os mesmos métodos.
+    """
+
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        with self._conectar() as conexao:
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS eventos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id_externo TEXT UNIQUE,
+                    turma_id TEXT NOT NULL,
+                    dados TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pendente',
+                    tentativas INTEGER NOT NULL DEFAULT 0,
+                    criado_em REAL NOT NULL,
+                    disponivel_em REAL NOT NULL,
+                    concluido_em REAL,
+                    codigo TEXT,
+                    erro TEXT
                 )
+            """)
+            conexao.execute("CREATE INDEX IF NOT EXISTS eventos_prontos ON eventos (status, disponivel_em)")
+            conexao.execute("CREATE INDEX IF NOT EXISTS eventos_turma ON eventos (turma_id, status)")
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        # Uma conexão por operação: a fila é usada por várias threads
+        conexao = sqlite3.connect(self.arquivo, timeout=30, isolation_level=None)
+        try:
+            yield conexao
+        finally:
+            conexao.close()
+
+    @contextlib.contextmanager
+    def _transacao(self):
+        with self._conectar() as conexao:
+            conexao.execute("BEGIN IMMEDIATE")
+            try:
+                yield conexao
+            except BaseException:
+                conexao.execute("ROLLBACK")
+                raise
+            conexao.execute("COMMIT")
+
+    def publicar(self, eventos):
+        """Enfileira [{id_externo, turma_id, nome, base_url}]; devolve quantos entraram
+        (id_externo repetido é ignorado)."""
+        agora = time.time()
+        with self._transacao() as conexao:
+            antes = conexao.total_changes
+            conexao.executemany(
+                "INSERT OR IGNORE INTO eventos (id_externo, turma_id, dados, criado_em, disponivel_em)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        evento.get("id_externo"),
+                        evento["turma_id"],
+                        json.dumps({"nome": evento["nome"], "base_url": evento["base_url"]}, ensure_ascii=False),
+                        agora,
+                        agora + FILA_JANELA_S,
+                    )
+                    for evento in eventos
+                ]
+            )
+            return conexao.total_changes - antes
+
+    def reservar(self, limite):
+        """Eventos prontos da turma com o evento mais antigo (até limite), ou []."""
+        agora = time.time()
+        with self._transacao() as conexao:
+            linha = conexao.execute(
+                "SELECT turma_id FROM eventos WHERE status IN ('pendente', 'processando') AND disponivel_em <= ?"
+                " ORDER BY id LIMIT 1",
+                (agora,)
+            ).fetchone()
+            if linha is None:
+                return []
+
+            # Leva junto a rajada da turma, inclusive o que chegou depois (ainda na janela)
+            linhas = conexao.execute(
+                "SELECT id, turma_id, dados, tentativas, criado_em FROM eventos WHERE turma_id = ? AND ("
+                " (status = 'pendente' AND (tentativas = 0 OR disponivel_em <= ?))"
+                " OR (status = 'processando' AND disponivel_em <= ?)"
+                ") ORDER BY id LIMIT ?",
+                (linha[0], agora, agora, limite)
+            ).fetchall()
+            conexao.executemany(
+                "UPDATE eventos SET status = 'processando', tentativas = tentativas + 1, disponivel_em = ? WHERE id = ?",
+                [(agora + FILA_VISIBILIDADE_S, id_evento) for id_evento, *_ in linhas]
+            )
 
-                if not certificate:
-                    logger.error(f"❌ Falha ao montar certificado para {name}, continuando para o próximo...")
-                    continue
+        return [
+            {"id": id_evento, "turma_id": turma_id, "tentativas": tentativas + 1, "criado_em": criado_em, **json.loads(dados)}
+            for id_evento, turma_id, dados, tentativas, criado_em in linhas
+        ]
+
+    def concluir(self, codigos):
+        """Marca {id: codigo} como concluídos."""
+        agora = time.time()
+        with self._transacao() as conexao:
+            conexao.executemany(
+                "UPDATE eventos SET status = 'concluido', concluido_em = ?, codigo = ?, erro = NULL WHERE id = ?",
+                [(agora, codigo, id_evento) for id_evento, codigo in codigos.items()]
+            )
 
-                # ✅ Salva o certificado na pasta de saída
-                output_file = os.path.join(OUTPUT_FOLDER, f"{name.replace(' ', '_')}_certificate.png")
-                certificate.save(output_file)
-                logger.info(f"✅ Certificado salvo: {output_file}")
+    def falhar(self, erros):
+        """Devolve {id: erro} para a fila, com espera crescente, ou desiste após FILA_MAX_TENTATIVAS."""
+        agora = time.time()
+        with self._transacao() as conexao:
+            for id_evento, erro in erros.items():
+                (tentativas,) = conexao.execute("SELECT tentativas FROM eventos WHERE id = ?", (id_evento,)).fetchone()
+                if tentativas >= FILA_MAX_TENTATIVAS:
+                    conexao.execute(
+                        "UPDATE eventos SET status = 'erro', concluido_em = ?, erro = ? WHERE id = ?",
+                        (agora, erro, id_evento)
+                    )
+                else:
+                    conexao.execute(
+                        "UPDATE eventos SET status = 'pendente', disponivel_em = ?, erro = ? WHERE id = ?",
+                        (agora + FILA_ESPERA_TENTATIVA_S * 2 ** (tentativas - 1), erro, id_evento)
+                    )
+
+    def limpar(self):
+        with self._transacao() as conexao:
+            conexao.execute(
+                "DELETE FROM eventos WHERE status IN ('concluido', 'erro') AND concluido_em < ?",
+                (time.time() - FILA_RETENCAO_S,)
+            )
 
-                # ✅ Salva dados no Firestore com todas as informações
-                save_certificate_to_firestore(
-                    nome=name,
-                    data_emissao=date,
-                    codigo=unique_hash,
-                    turma_nome=nome_turma,
-                    data_evento=data_evento,
-                    nome_treinamento=nome_treinamento,
-                    carga_horaria=carga_horaria
-                )
+    def estatisticas(self):
+        agora = time.time()
+        with self._conectar() as conexao:
+            por_status = dict(conexao.execute("SELECT status, COUNT(*) FROM eventos GROUP BY status").fetchall())
+            (mais_antigo,) = conexao.execute(
+                "SELECT MIN(criado_em) FROM eventos WHERE status IN ('pendente', 'processando')"
+            ).fetchone()
+            (concluidos_5min,) = conexao.execute(
+                "SELECT COUNT(*) FROM eventos WHERE status = 'concluido' AND concluido_em >= ?", (agora - 300,)
+            ).fetchone()
+        return {
+            "pendentes": por_status.get("pendente", 0),
+            "processando": por_status.get("processando", 0),
+            "concluidos": por_status.get("concluido", 0),
+            "erros": por_status.get("erro", 0),
+            # Atraso da fila: idade do evento mais antigo ainda não emitido
+            "atraso_s": round(agora - mais_antigo, 3) if mais_antigo else 0.0,
+            "eventos_por_s_5min": round(concluidos_5min / 300, 3),
+        }
 
-        # ✅ Compacta tudo em um arquivo ZIP
-        zip_filename = "certificates.zip"
-        zip_path = os.path.join(OUTPUT_FOLDER, zip_filename)
 
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file in os.listdir(OUTPUT_FOLDER):
-                if file.endswith(".png"):
-                    zipf.write(os.path.join(OUTPUT_FOLDER, file), file)
+def processar_eventos_da_turma(turma_id, eventos):
+    """Emite os certificados de uma rajada de eventos da mesma turma.
+
+    Todas as renderizações vão juntas para o pool (prioridade de lote) e os
+    registros saem em WriteBatches. Devolve ({id: codigo}, {id: erro}).
+    """
+    turma_doc = buscar_documento("turmas", turma_id)
+    if not turma_doc.exists:
+        return {}, {evento["id"]: f"Turma {turma_id} não encontrada" for evento in eventos}
+    turma_data = turma_doc.to_dict()
+    dados_turma = dados_turma_para_emissao(turma_data)
+
+    # O LMS reenvia eventos: a mesma pessoa vira uma emissão só
+    por_chave = {}
+    for evento in eventos:
+        por_chave.setdefault(chave_emissao(turma_id, evento["nome"]), []).append(evento)
+
+    renderizados, falhas = [], {}
+    pendentes = collections.deque()
+
+    def aguardar(item):
+        if aguardar_render_lote(item):
+            item["png"] = None
+            renderizados.append(item)
+        else:
+            falhas.update((evento["id"], "falha_render") for evento in item["eventos"])
+
+    for grupo in por_chave.values():
+        item = iniciar_emissao_lote(
+            turma_id, grupo[0]["nome"], dados_turma, grupo[0]["base_url"], turma_data.get("renderizado_em")
+        )
+        item["eventos"] = grupo
+        pendentes.append(item)
+        # Janela de renderização: limita os PNGs em memória, como no lote por CSV
+        while len(pendentes) > max(RENDER_WORKERS, 1) * 2:
+            aguardar(pendentes.popleft())
+    while pendentes:
+        aguardar(pendentes.popleft())
+
+    registrar_emissoes_em_lote(
+        [item for item in renderizados if not item["estado"]["registrado"]], turma_id, dados_turma
+    )
 
-        logger.info(f"✅ Certificados em lote gerados e compactados com sucesso: {zip_path}")
+    codigos = {}
+    for item in renderizados:
+        for evento in item["eventos"]:
+            if item["estado"]["registrado"]:
+                codigos[evento["id"]] = item["estado"]["codigo"]
+            else:
+                falhas[evento["id"]] = "falha_registro"
+    return codigos, falhas
+
+
+class ConsumidoresFila:
+    """Threads que drenam a fila: reservam a rajada de uma turma e emitem tudo de uma vez."""
+
+    def __init__(self, fila, consumidores):
+        self.fila = fila
+        self.consumidores = consumidores
+        self._sinal = threading.Event()
+        self._lock = threading.Lock()
+        self._iniciado = False
+        self._processados = 0
+        self._falhas = 0
+        self._ultimo_lote = None
+
+    def iniciar(self):
+        with self._lock:
+            if self._iniciado:
+                return
+            self._iniciado = True
+        for i in range(self.consumidores):
+            threading.Thread(target=self._consumir_sempre, name=f"fila-consumidor-{i}", daemon=True).start()
+        logger.info("📥 %s consumidores da fila de eventos iniciados", self.consumidores)
+
+    def avisar(self):
+        self._sinal.set()
+
+    def _consumir_sempre(self):
+        ocioso_desde = time.monotonic()
+        while True:
+            try:
+                eventos = self.fila.reservar(FILA_LOTE_MAX)
+            except Exception as e:
+                logger.error("❌ Erro ao ler a fila de eventos: %s", e)
+                eventos = []
+
+            if not eventos:
+                if time.monotonic() - ocioso_desde > 3600:
+                    with contextlib.suppress(Exception):
+                        self.fila.limpar()
+                    ocioso_desde = time.monotonic()
+                self._sinal.wait(FILA_INTERVALO_S)
+                self._sinal.clear()
+                continue
+            self._processar(eventos)
+
+    def _processar(self, eventos):
+        turma_id = eventos[0]["turma_id"]
+        inicio = time.perf_counter()
+        try:
+            codigos, falhas = processar_eventos_da_turma(turma_id, eventos)
+        except Exception as e:
+            logger.error("❌ Erro ao processar %s eventos da turma %s: %s", len(eventos), turma_id, e)
+            codigos, falhas = {}, {evento["id"]: str(e) for evento in eventos}
+
+        if codigos:
+            self.fila.concluir(codigos)
+        if falhas:
+            self.fila.falhar(falhas)
+
+        duracao = time.perf_counter() - inicio
+        atraso_max = time.time() - min(evento["criado_em"] for evento in eventos)
+        with self._lock:
+            self._processados += len(codigos)
+            self._falhas += len(falhas)
+            self._ultimo_lote = {
+                "turma_id": turma_id,
+                "eventos": len(eventos),
+                "duracao_s": round(duracao, 3),
+                "eventos_por_s": round(len(eventos) / duracao, 3) if duracao else None,
+            }
+        metricas.incrementar("fila_eventos_total", len(codigos), resultado="concluido")
+        metricas.incrementar("fila_eventos_total", len(falhas), resultado="falha")
+        metricas.observar("fila_atraso_segundos", atraso_max)
+        log_evento(
+            logging.INFO,
+            "fila_lote_processado",
+            turma_id=turma_id,
+            eventos=len(eventos),
+            concluidos=len(codigos),
+            falhas=len(falhas),
+            duracao_s=round(duracao, 3),
+            eventos_por_s=self._ultimo_lote["eventos_por_s"],
+            atraso_max_s=round(atraso_max, 3),
+        )
 
-        return zip_path
+    def stats(self):
+        with self._lock:
+            return {
+                "consumidores": self.consumidores if self._iniciado else 0,
+                "processados": self._processados,
+                "falhas": self._falhas,
+                "ultimo_lote": self._ultimo_lote,
+            }
 
-    except Exception as e:
-        logger.error(f"❌ Erro ao gerar certificados em lote: {e}")
-        return None
+
+# Criadas por inicializar(), só no processo principal
+fila_eventos = None
+consumidores_fila = None
+
+
+def ler_eventos_conclusao():
+    """Eventos do corpo: um objeto, {"eventos": [...]}, lista JSON ou NDJSON.
+
+    Cada evento traz turma_id e nome (ou aluno.nome) e, de preferência, um "id"
+    único do LMS, usado para ignorar reenvios. Eventos de outro tipo são ignorados.
+    Devolve (eventos, ignorados, rejeitados) ou (None, None, erro).
+    """
+    if request.mimetype == "application/x-ndjson":
+        try:
+            itens = [json.loads(linha) for linha in request.get_data(as_text=True).splitlines() if linha.strip()]
+        except ValueError as e:
+            return None, None, f"NDJSON inválido: {e}"
+    else:
+        corpo = request.get_json(silent=True)
+        if isinstance(corpo, dict) and "eventos" in corpo:
+            corpo = corpo["eventos"]
+        itens = [corpo] if isinstance(corpo, dict) else corpo
+        if not isinstance(itens, list):
+            return None, None, 'Envie um evento JSON, {"eventos": [...]}, uma lista JSON ou NDJSON.'
+
+    eventos, ignorados, rejeitados = [], 0, []
+    for indice, item in enumerate(itens):
+        if not isinstance(item, dict):
+            rejeitados.append({"indice": indice, "erro": "evento não é um objeto JSON"})
+            continue
+        if item.get("tipo", "curso_concluido") not in FILA_TIPOS_CONCLUSAO:
+            ignorados += 1
+            continue
+        aluno = item.get("aluno") if isinstance(item.get("aluno"), dict) else {}
+        nome = " ".join(str(item.get("nome") or aluno.get("nome") or "").split())
+        turma_id = str(item.get("turma_id") or "").strip()
+        erro = erro_no_nome(nome) if turma_id else "turma_id é obrigatório"
+        if erro:
+            rejeitados.append({"indice": indice, "erro": erro})
+            continue
+        id_externo = item.get("id")
+        eventos.append({
+            "id_externo": str(id_externo) if id_externo is not None else None,
+            "turma_id": turma_id,
+            "nome": nome,
+        })
+    return eventos, ignorados, rejeitados
 
 
 @app.route('/')
@@ -660,12 +4454,26 @@ def lote():
         <p><a href="/download_template">⬇️ Baixar modelo de CSV</a></p>
 
         <form action="/upload" method="post" enctype="multipart/form-data">
-            <label for="file">Selecione o arquivo CSV:</label><br>
-            <input type="file" name="file" accept=".csv" required><br><br>
-
+            <!-- O código da turma vem antes do arquivo para o lote começar enquanto o CSV é enviado -->
             <label for="turma_id">Digite o código da turma:</label><br>
             <input type="text" name="turma_id" required><br><br>
 
+            <label for="amostra">Certificados na prévia:</label><br>
+            <input type="number" name="amostra" value="12" min="1" max="60">
+            <select name="modo">
+                <option value="primeiras">Primeiras linhas</option>
+                <option value="aleatoria">Amostra aleatória</option>
+            </select><br><br>
+
+            <label>
+                <input type="checkbox" name="enviar_email">
+                📧 Enviar o certificado por e-mail para quem tiver a coluna "email" preenchida
+            </label><br><br>
+
+            <label for="file">Selecione o arquivo CSV:</label><br>
+            <input type="file" name="file" accept=".csv" required><br><br>
+
+            <button type="submit" formaction="/lote/previa">👀 Pré-visualizar (sem gravar)</button>
             <button type="submit">Gerar Certificados em Lote</button>
         </form>
     </body>
@@ -693,8 +4501,7 @@ def aluno():
 
         # ✅ Busca os dados da turma no Firestore
         try:
-            turma_ref = db.collection("turmas").document(turma_id)
-            turma_doc = turma_ref.get()
+            turma_doc = buscar_documento("turmas", turma_id)
 
             if not turma_doc.exists:
                 return f"Erro: Turma com código {turma_id} não encontrada."
@@ -704,37 +4511,44 @@ def aluno():
             data_evento = turma_data.get("data_evento", "Data do evento não informada")
             nome_treinamento = turma_data.get("nome_treinamento", "Treinamento não especificado")
             carga_horaria = turma_data.get("carga_horaria", "Carga horária não informada")
+            template_id = turma_data.get("template_id")
+            template_versao = turma_data.get("template_versao")
+            idioma = idioma_valido(turma_data.get("idioma"))
 
-            logger.info(f"✅ Turma encontrada: {nome_turma} - {data_evento}")
-            logger.info(f"🔎 Turma Info | Nome: {nome_turma}, Data Evento: {data_evento}, Treinamento: {nome_treinamento}, Carga Horária: {carga_horaria}")
+            logger.debug("✅ Turma encontrada: %s - %s", nome_turma, data_evento)
+            logger.debug("🔎 Turma Info | Nome: %s, Data Evento: %s, Treinamento: %s, Carga Horária: %s", nome_turma, data_evento, nome_treinamento, carga_horaria)
 
 
         except Exception as e:
-            logger.error(f"❌ Erro ao buscar turma {turma_id}: {e}")
+            logger.error("❌ Erro ao buscar turma %s: %s", turma_id, e)
             return "Erro ao buscar informações da turma."
 
         # ✅ Chama e captura o caminho e o código único corretamente!
-        logger.info(f"🚀 Gerando certificado para {name} na turma {nome_turma} ({turma_id})")
+        logger.debug("🚀 Gerando certificado para %s na turma %s (%s)", name, nome_turma, turma_id)
 
         result = generate_certificate_for_student(
             name,
             base_url,
+            turma_id=turma_id,
             nome_turma=nome_turma,
             data_evento=data_evento,
             nome_treinamento=nome_treinamento,
-            carga_horaria=carga_horaria
+            carga_horaria=carga_horaria,
+            template_id=template_id,
+            template_versao=template_versao,
+            idioma=idioma
         )
 
         # ✅ Se não veio nada, erro!
         if not result:
-            logger.error(f"❌ Erro ao gerar o certificado para {name}")
+            logger.error("❌ Erro ao gerar o certificado para %s", name)
             return "Erro ao gerar o certificado."
 
-        certificate_path, unique_hash = result
+        artefato_png, unique_hash, reaproveitado = result
 
         # ✅ Se o código veio vazio, erro!
         if not unique_hash:
-            logger.error(f"❌ Código único vazio após geração de certificado para {name}")
+            logger.error("❌ Código único vazio após geração de certificado para %s", name)
             return "Erro ao gerar o código do certificado."
 
         # ✅ Monta o link de validação e compartilhamento com o código correto!
@@ -742,16 +4556,11 @@ def aluno():
         linkedin_share_url = f"https://www.linkedin.com/sharing/share-offsite/?url={base_url}/conquista/{unique_hash}"
 
         # 🔎 LOGS PARA DEBUG!
-        logger.info("DEBUG INFO:")
-        logger.info(f"Base URL: {base_url}")
-        logger.info(f"Unique Hash: {unique_hash}")
-        logger.info(f"Cert Path: {certificate_path}")
-        logger.info(f"Validar URL: {validar_url}")
-        logger.info(f"LinkedIn URL: {linkedin_share_url}")
-
-        # ✅ Gera o Base64 da imagem para exibir na tela
-        with open(certificate_path, "rb") as image_file:
-            img_base64 = base64.b64encode(image_file.read()).decode('utf-8')
+        logger.debug("Base URL: %s", base_url)
+        logger.debug("Unique Hash: %s", unique_hash)
+        logger.debug("Artefato PNG: %s bytes", artefato_png.tamanho if artefato_png else None)
+        logger.debug("Validar URL: %s", validar_url)
+        logger.debug("LinkedIn URL: %s", linkedin_share_url)
 
         # ✅ Retorna a página HTML com a imagem e os links
         return f'''
@@ -784,9 +4593,9 @@ def aluno():
             </style>
         </head>
         <body>
-            <h1>🎉 Certificado Gerado!</h1>
+            <h1>{"📄 Você já havia emitido este certificado!" if reaproveitado else "🎉 Certificado Gerado!"}</h1>
 
-            <img class="cert-image" src="data:image/png;base64,{img_base64}" alt="Certificado">
+            <img class="cert-image" src="{base_url}/certificado/{unique_hash}/web" alt="Certificado">
 
             <div class="button-container">
                 <a href="{base_url}/download_cert/{unique_hash}">⬇️ Baixar Certificado</a>
@@ -833,54 +4642,156 @@ def aluno():
     </html>
     '''
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    base_url = get_secure_base_url()
-
-    # ✅ Pega o arquivo e o código da turma
-    uploaded_file = request.files.get('file')
-    turma_id = request.form.get('turma_id')
+def ler_upload_csv():
+    """Abre o CSV enviado direto do corpo da requisição, sem salvar em disco.
+
+    Aceita multipart (formulário /lote) ou o próprio CSV como corpo (text/csv,
+    com ?turma_id=). Retorna (campos, blocos) ou (None, resposta_de_erro).
+    """
+    campos = dict(request.args)
+
+    if request.mimetype == 'multipart/form-data':
+        boundary = request.mimetype_params.get('boundary')
+        if not boundary:
+            return None, ("❌ Requisição multipart inválida!", 400)
+
+        upload = UploadCsvEmFluxo(request.stream, boundary)
+        if not upload.iniciar():
+            logger.error("❌ CSV não fornecido!")
+            return None, ("❌ Arquivo CSV e código da turma são obrigatórios!", 400)
+
+        campos.update({k: v for k, v in upload.campos.items() if k not in campos})
+        campos['filename'] = upload.filename or ""
+        blocos = upload.blocos()
+
+        if not campos.get('turma_id'):
+            # O campo da turma veio depois do arquivo: guarda o CSV até descobrir a turma
+            spool = tempfile.SpooledTemporaryFile(max_size=CSV_BLOCO * 16)
+            for bloco in blocos:
+                spool.write(bloco)
+            spool.seek(0)
+            campos.update({k: v for k, v in upload.campos.items() if k not in campos})
+            blocos = _blocos_do_arquivo(spool)
+    else:
+        campos.setdefault('filename', 'upload.csv')
+        blocos = _blocos_do_arquivo(request.stream)
 
-    if not uploaded_file or not turma_id:
+    if not campos.get('turma_id'):
         logger.error("❌ CSV ou ID da turma não fornecido!")
-        return "❌ Arquivo CSV e código da turma são obrigatórios!", 400
-
-    logger.info(f"📥 Recebido arquivo CSV '{uploaded_file.filename}' para a turma {turma_id}")
+        return None, ("❌ Arquivo CSV e código da turma são obrigatórios!", 400)
 
     # ✅ Valida o tipo do arquivo (só pra garantir)
-    if not uploaded_file.filename.endswith('.csv'):
-        logger.error(f"❌ O arquivo '{uploaded_file.filename}' não é um CSV válido!")
-        return "❌ Apenas arquivos CSV são aceitos!", 400
+    if not campos['filename'].lower().endswith('.csv'):
+        logger.error("❌ O arquivo '%s' não é um CSV válido!", campos['filename'])
+        return None, ("❌ Apenas arquivos CSV são aceitos!", 400)
+
+    logger.info("📥 Recebido arquivo CSV '%s' para a turma %s", campos['filename'], campos['turma_id'])
+    return campos, blocos
 
-    try:
-        # ✅ Salva temporariamente o arquivo no servidor
-        file_path = os.path.join(UPLOAD_FOLDER, uploaded_file.filename)
-        uploaded_file.save(file_path)
 
-        logger.info(f"✅ Arquivo CSV salvo temporariamente em {file_path}")
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    base_url = get_secure_base_url()
+    relatorio = {}
+
+    campos, blocos = ler_upload_csv()
+    if campos is None:
+        return blocos
+    turma_id = campos['turma_id']
 
-        # ✅ Gera os certificados em lote (com a turma)
-        zip_path = generate_certificates(file_path, base_url, turma_id)
+    try:
+        # ✅ Gera os certificados em lote (com a turma), renderizando enquanto o upload é lido
+        zip_path = generate_certificates(
+            blocos, base_url, turma_id, relatorio=relatorio, enviar_email=campos.get('enviar_email') == 'on'
+        )
 
         if not zip_path:
             logger.error("❌ Erro durante a geração dos certificados em lote.")
+            if relatorio.get("erro_fatal"):
+                return f"❌ {relatorio['erro_fatal']}", 400
             return "❌ Erro ao gerar os certificados em lote.", 500
 
-        logger.info(f"✅ Certificados em lote gerados e compactados! ZIP pronto para download: {zip_path}")
+        logger.debug("✅ Certificados em lote gerados e compactados! ZIP pronto para download: %s", zip_path)
 
         # ✅ Envia o ZIP para download
-        return send_file(
+        response = send_file(
             zip_path,
             mimetype='application/zip',
             as_attachment=True,
             download_name='certificados_lote.zip'
         )
+        response.headers['X-Linhas-Lidas'] = str(relatorio.get("linhas_lidas", 0))
+        response.headers['X-Linhas-Com-Erro'] = str(len(relatorio.get("erros", [])))
+        response.headers['X-Emails-Agendados'] = str(relatorio.get("emails_agendados", 0))
+        return response
 
     except Exception as e:
-        logger.error(f"❌ Erro inesperado durante upload e geração de certificados: {e}")
+        logger.error("❌ Erro inesperado durante upload e geração de certificados: %s", e)
         return "❌ Ocorreu um erro interno ao processar o upload e gerar os certificados.", 500
 
 
+@app.route('/lote/previa', methods=['POST'])
+def previa_lote():
+    base_url = get_secure_base_url()
+    relatorio = {}
+
+    campos, blocos = ler_upload_csv()
+    if campos is None:
+        return blocos
+
+    try:
+        amostra = min(max(int(campos.get('amostra') or 12), 1), PREVIA_MAX_AMOSTRA)
+    except ValueError:
+        return "❌ Quantidade da prévia inválida!", 400
+    modo = "aleatoria" if campos.get('modo') == "aleatoria" else "primeiras"
+
+    try:
+        png_bytes, alertas = gerar_previa_lote(blocos, campos['turma_id'], amostra=amostra, modo=modo, relatorio=relatorio)
+    except RenderPoolSaturado:
+        raise
+    except Exception as e:
+        logger.error("❌ Erro ao gerar a prévia do lote: %s", e)
+        return "❌ Erro ao gerar a prévia do lote.", 500
+
+    if relatorio.get("erro_fatal"):
+        return f"❌ {relatorio['erro_fatal']}", 400
+    if not png_bytes:
+        return "❌ Nenhuma linha válida encontrada no CSV.", 400
+
+    img_base64 = base64.b64encode(png_bytes).decode('utf-8')
+
+    problemas = [(a["linha"], a["alerta"], a["nome"]) for a in alertas]
+    problemas += [(e["linha"], e["erro"], e["valor"]) for e in relatorio.get("erros", [])]
+    linhas_problemas = "".join(
+        f"<tr><td>{linha}</td><td>{html.escape(str(problema))}</td><td>{html.escape(str(valor))}</td></tr>"
+        for linha, problema, valor in sorted(problemas, key=lambda p: p[0])
+    )
+
+    return f'''
+    <html>
+    <head>
+        <title>Prévia do Lote</title>
+        <link rel="stylesheet" href="{base_url}/static/styles.css">
+    </head>
+    <body>
+        <h1>👀 Prévia do Lote (nada foi gravado)</h1>
+
+        <p><strong>Linhas lidas:</strong> {relatorio.get("linhas_lidas", 0)} |
+           <strong>Com problema:</strong> {len(problemas)} |
+           <strong>Encoding:</strong> {relatorio.get("encoding")} |
+           <strong>Delimitador:</strong> {html.escape(repr(relatorio.get("delimitador")))}</p>
+
+        <img src="data:image/png;base64,{img_base64}" alt="Prévia dos certificados" style="max-width: 100%;">
+
+        {"<h2>⚠️ Problemas encontrados</h2><table><tr><th>Linha</th><th>Problema</th><th>Valor</th></tr>" + linhas_problemas + "</table>" if problemas else "<p>✅ Nenhum problema encontrado.</p>"}
+
+        <br>
+        <a href="/lote">🔙 Voltar ao lote</a>
+    </body>
+    </html>
+    '''
+
+
 @app.route('/test_firestore', methods=['GET'])
 def test_firestore():
     global db  # <-- isso garante que ele acessa a variável global
@@ -900,7 +4811,7 @@ def test_firestore():
         return jsonify({"status": "✅ Firestore está funcionando! Documento de teste criado."})
 
     except Exception as e:
-        app.logger.error(f"❌ ERRO DETALHADO NO FIRESTORE: {e}")
+        app.logger.error("❌ ERRO DETALHADO NO FIRESTORE: %s", e)
         return jsonify({"status": "❌ Erro ao salvar no Firestore", "erro": str(e)}), 500
 
 ## Rota de validação
@@ -945,16 +4856,37 @@ def validar_certificado():
         </html>
         '''
 
+    codigo = normalizar_codigo(codigo)
+    situacao_codigo = verificar_codigo(codigo)
+
+    # Validação rápida: a assinatura basta para confirmar que o código é nosso
+    if VALIDACAO_RAPIDA and situacao_codigo == "assinado" and not request.args.get('completo'):
+        logger.debug("⚡ Código assinado confirmado sem consulta ao Firestore: %s", codigo)
+        return f'''
+        <html>
+        <head>
+            <title>Validação de Certificado</title>
+            <link rel="stylesheet" href="{base_url}/static/styles.css">
+        </head>
+        <body>
+            <h1>✅ Código autêntico!</h1>
+            <p>O código <strong>{codigo}</strong> foi emitido pela EquilibriON.</p>
+            <a href="/validar?codigo={codigo}&completo=1">📄 Ver os dados do certificado</a>
+            <br><br>
+            <a class="back-link" href="/validar">🔙 Validar outro certificado</a>
+        </body>
+        </html>
+        '''
+
     # Agora tem código, vamos validar
     try:
-        logger.info(f"🔍 Validando certificado com ID: {codigo}")
+        logger.debug("🔍 Validando certificado com ID: %s", codigo)
 
-        # 1️⃣ Busca o documento no Firestore
-        doc_ref = db.collection("certificados").document(codigo)
-        doc = doc_ref.get()
+        # 1️⃣ Busca o documento no Firestore (códigos inválidos ou já confirmados ausentes nem chegam lá)
+        doc = buscar_certificado(codigo, situacao_codigo)
 
-        if not doc.exists:
-            logger.warning(f"❌ Documento não encontrado para o código: {codigo}")
+        if doc is None or not doc.exists:
+            logger.warning("❌ Documento não encontrado para o código: %s", codigo)
             return f'''
             <html>
             <head>
@@ -980,31 +4912,10 @@ def validar_certificado():
         nome_treinamento = data.get('nome_treinamento', 'Treinamento não especificado')
         carga_horaria = data.get('carga_horaria', 'Carga horária não informada')
 
-        logger.info(f"✅ Certificado válido! Nome: {nome}, Turma: {turma_nome}, Evento: {data_evento}, Treinamento: {nome_treinamento}, Carga Horária: {carga_horaria}, Data emissão: {data_emissao}")
-
-        # 3️⃣ Gerar certificado para exibir
-        try:
-            certificate = montar_certificado_imagem(
-                nome=nome,
-                data_emissao=data_emissao,
-                codigo=codigo,
-                base_url=base_url,
-                turma_nome=turma_nome,
-                data_evento=data_evento,
-                nome_treinamento=nome_treinamento,
-                carga_horaria=carga_horaria
-            )
-
-            img_io = io.BytesIO()
-            certificate.save(img_io, 'PNG')
-            img_io.seek(0)
-
-            import base64
-            img_base64 = base64.b64encode(img_io.getvalue()).decode('utf-8')
+        logger.debug("✅ Certificado válido! Nome: %s, Turma: %s, Evento: %s, Treinamento: %s, Carga Horária: %s, Data emissão: %s", nome, turma_nome, data_evento, nome_treinamento, carga_horaria, data_emissao)
 
-        except Exception as e:
-            logger.error(f"❌ Erro ao gerar imagem do certificado para visualização: {e}")
-            img_base64 = None
+        # 3️⃣ A imagem vem pronta do armazém de artefatos (rota /certificado/<codigo>/web)
+        img_url = f"{base_url}/certificado/{codigo}/web"
 
         # 4️⃣ Retorna a página HTML com o resultado
         return f'''
@@ -1038,7 +4949,7 @@ def validar_certificado():
                 <p><strong>ID de Validação:</strong> {codigo}</p>
             </div>
 
-            {'<img class="cert-image" src="data:image/png;base64,' + img_base64 + '">' if img_base64 else '<p>Erro ao carregar a imagem do certificado.</p>'}
+            <img class="cert-image" src="{img_url}" alt="Certificado de {nome}">
 
             <div style="margin-top: 30px;">
                 <a class="back-link" href="/validar">🔙 Validar outro certificado</a>
@@ -1047,8 +4958,10 @@ def validar_certificado():
         </html>
         '''
 
+    except RenderPoolSaturado:
+        raise
     except Exception as e:
-        logger.error(f"❌ Erro inesperado na validação: {e}")
+        logger.error("❌ Erro inesperado na validação: %s", e)
         return f'''
         <html>
         <head>
@@ -1064,44 +4977,179 @@ def validar_certificado():
         ''', 500
 
 
-## Rota para remontar o certificado na consulta!
+## Validação em lote (JSON ou NDJSON)
+@app.route('/api/validar', methods=['POST'])
+@app.route(f'{API_PREFIXO}/validar', methods=['POST'])
+def api_validar():
+    if db is None:
+        return jsonify({"erro": "Firestore não inicializado"}), 500
+
+    codigos, erro = ler_codigos_validacao()
+    if erro:
+        return jsonify({"erro": erro}), 400
+    if len(codigos) > VALIDACAO_LOTE_MAX:
+        return jsonify({"erro": f"No máximo {VALIDACAO_LOTE_MAX} códigos por requisição (recebidos: {len(codigos)})."}), 413
+
+    resultados = validar_codigos(codigos, get_secure_base_url())
+    if quer_ndjson():
+        # Uma linha por código, enviada a cada grupo lido do Firestore
+        linhas = (json.dumps(resultado, ensure_ascii=False) + "\n" for resultado in resultados)
+        return Response(stream_with_context(linhas), mimetype="application/x-ndjson")
+
+    resultados = list(resultados)
+    return jsonify({
+        "total": len(resultados),
+        "validos": sum(1 for resultado in resultados if resultado["status"] == "valido"),
+        "resultados": resultados,
+    })
+
+
+## Emissão pela API (um aluno)
+@app.route(f'{API_PREFIXO}/certificados', methods=['POST'])
+def api_emitir_certificado():
+    if not api_autorizada():
+        return jsonify({"erro": "Token de API ausente ou inválido"}), 401
+    if db is None:
+        return jsonify({"erro": "Firestore não inicializado"}), 500
+
+    corpo = request.get_json(silent=True)
+    if not isinstance(corpo, dict):
+        return jsonify({"erro": 'Envie um objeto JSON: {"turma_id": ..., "nome": ...}'}), 400
+    turma_id, nome = corpo.get("turma_id"), corpo.get("nome")
+    if not isinstance(turma_id, str) or not turma_id.strip():
+        return jsonify({"erro": "turma_id é obrigatório (texto)"}), 400
+    if not isinstance(nome, str):
+        return jsonify({"erro": "nome é obrigatório (texto)"}), 400
+    turma_id, nome = turma_id.strip(), " ".join(nome.split())
+    erro = erro_no_nome(nome)
+    if erro:
+        return jsonify({"erro": erro}), 400
+
+    turma_doc = buscar_documento("turmas", turma_id)
+    if not turma_doc.exists:
+        return jsonify({"erro": f"Turma {turma_id} não encontrada"}), 404
+    dados_turma = dados_turma_para_emissao(turma_doc.to_dict())
+
+    base_url = get_secure_base_url()
+    result = generate_certificate_for_student(
+        nome,
+        base_url,
+        turma_id=turma_id,
+        nome_turma=dados_turma["turma_nome"],
+        data_evento=dados_turma["data_evento"],
+        nome_treinamento=dados_turma["nome_treinamento"],
+        carga_horaria=dados_turma["carga_horaria"],
+        template_id=dados_turma["template_id"],
+        template_versao=dados_turma["template_versao"],
+        idioma=dados_turma["idioma"]
+    )
+    if not result:
+        return jsonify({"erro": "Erro ao gerar o certificado"}), 500
+
+    _, codigo, reaproveitado = result
+    return jsonify({
+        "nome": nome,
+        "status": "reaproveitado" if reaproveitado else "emitido",
+        "codigo": codigo,
+        **urls_certificado(codigo, base_url),
+    }), 200 if reaproveitado else 201
+
+
+## Emissão pela API (lote, resultados em NDJSON à medida que ficam prontos)
+@app.route(f'{API_PREFIXO}/turmas/<turma_id>/certificados', methods=['POST'])
+def api_emitir_lote(turma_id):
+    if not api_autorizada():
+        return jsonify({"erro": "Token de API ausente ou inválido"}), 401
+    if db is None:
+        return jsonify({"erro": "Firestore não inicializado"}), 500
+
+    nomes, erro = ler_destinatarios()
+    if erro:
+        return jsonify({"erro": erro}), 400
+    if len(nomes) > CSV_MAX_LINHAS:
+        return jsonify({"erro": f"No máximo {CSV_MAX_LINHAS} destinatários por requisição (recebidos: {len(nomes)})."}), 413
+
+    turma_doc = buscar_documento("turmas", turma_id)
+    if not turma_doc.exists:
+        return jsonify({"erro": f"Turma {turma_id} não encontrada"}), 404
+
+    resultados = emitir_lote_api(turma_id, turma_doc.to_dict(), nomes, get_secure_base_url())
+    if quer_ndjson(padrao=True):
+        linhas = (json.dumps(resultado, ensure_ascii=False) + "\n" for resultado in resultados)
+        return Response(stream_with_context(linhas), mimetype="application/x-ndjson")
+
+    resultados = sorted(resultados, key=lambda resultado: resultado["indice"])
+    return jsonify({"total": len(resultados), "resultados": resultados})
+
+
+## Eventos de conclusão do LMS (curso concluído → certificado emitido pela fila)
+@app.route(f'{API_PREFIXO}/eventos/conclusao', methods=['POST'])
+def api_eventos_conclusao():
+    if not api_autorizada():
+        return jsonify({"erro": "Token de API ausente ou inválido"}), 401
+    if fila_eventos is None or db is None:
+        return jsonify({"erro": "Fila de eventos indisponível"}), 503
+
+    eventos, ignorados, rejeitados = ler_eventos_conclusao()
+    if eventos is None:
+        return jsonify({"erro": rejeitados}), 400
+    if len(eventos) > CSV_MAX_LINHAS:
+        return jsonify({"erro": f"No máximo {CSV_MAX_LINHAS} eventos por requisição (recebidos: {len(eventos)})."}), 413
+
+    # A URL pública vai junto do evento: o consumidor não tem requisição para descobri-la
+    base_url = get_secure_base_url()
+    for evento in eventos:
+        evento["base_url"] = base_url
+    aceitos = fila_eventos.publicar(eventos) if eventos else 0
+
+    consumidores_fila.iniciar()
+    consumidores_fila.avisar()
+    log_evento(
+        logging.INFO,
+        "eventos_recebidos",
+        aceitos=aceitos,
+        duplicados=len(eventos) - aceitos,
+        ignorados=ignorados,
+        rejeitados=len(rejeitados)
+    )
+    return jsonify({
+        "aceitos": aceitos,
+        "duplicados": len(eventos) - aceitos,
+        "ignorados": ignorados,
+        "rejeitados": rejeitados,
+    }), 202 if aceitos else 200
+
+## Rota para exibir o certificado (PNG completo, prévia web ou card social)
 @app.route('/certificado/<codigo>')
-def mostrar_certificado(codigo):
+@app.route('/certificado/<codigo>/<tipo>')
+def mostrar_certificado(codigo, tipo="png"):
     global db
     try:
-        print(f"🔍 Buscando certificado com ID: {codigo}")
+        logger.debug("🔍 Buscando certificado com ID: %s", codigo)
+
+        if tipo not in TIPOS_ARTEFATO:
+            return "❌ Formato de certificado inválido!", 404
 
         # 1. Buscar o documento do certificado
-        doc_ref = db.collection("certificados").document(codigo)
-        doc = doc_ref.get()
+        doc = buscar_certificado(codigo)
 
-        if not doc.exists:
-            print("❌ Documento não encontrado no Firestore.")
+        if doc is None or not doc.exists:
+            logger.warning("❌ Documento não encontrado no Firestore: %s", codigo)
             return "❌ Certificado não encontrado!", 404
 
-        data = doc.to_dict()
-        nome = data.get('nome')
-        data_emissao = data.get('data_emissao')
-
-        print(f"✅ Documento encontrado: Nome={nome}, Data={data_emissao}")
-
-        base_url = get_secure_base_url()
-        certificate = montar_certificado_imagem(nome, data_emissao, codigo, base_url)
+        # 2. Os bytes já estão prontos no armazém de artefatos
+        artefato = obter_artefato(codigo, tipo, doc.to_dict(), get_secure_base_url())
 
-        if not certificate:
-            print("❌ Erro ao montar o certificado.")
+        if not artefato:
+            logger.error("❌ Erro ao montar o certificado %s.", codigo)
             return "❌ Erro ao montar o certificado.", 500
 
-        # 5. Salvar a imagem no buffer e retornar
-        img_io = io.BytesIO()
-        certificate.save(img_io, 'PNG')
-        img_io.seek(0)
-
-        print("✅ Certificado gerado com sucesso!")
-        return send_file(img_io, mimetype='image/png')
+        return servir_artefato(artefato)
 
+    except RenderPoolSaturado:
+        raise
     except Exception as e:
-        print(f"❌ Erro inesperado ao gerar certificado dinâmico: {e}")
+        logger.error("❌ Erro inesperado ao gerar certificado dinâmico: %s", e)
         return "❌ Erro ao gerar certificado!", 500
 
 @app.route('/download_zip')
@@ -1116,7 +5164,7 @@ def download_certificado(codigo):
     global db
 
     try:
-        logger.info(f"🔍 Iniciando download do certificado com ID: {codigo}")
+        logger.debug("🔍 Iniciando download do certificado com ID: %s", codigo)
 
         # 1️⃣ Verifica se o Firestore está inicializado
         if db is None:
@@ -1124,66 +5172,71 @@ def download_certificado(codigo):
             return "❌ Erro interno: Firestore não inicializado!", 500
 
         # 2️⃣ Busca o certificado no Firestore pelo código único
-        doc_ref = db.collection("certificados").document(codigo)
-        doc = doc_ref.get()
+        doc = buscar_certificado(codigo)
 
-        if not doc.exists:
-            logger.warning(f"❌ Certificado com ID {codigo} não encontrado para download!")
+        if doc is None or not doc.exists:
+            logger.warning("❌ Certificado com ID %s não encontrado para download!", codigo)
             return "❌ Certificado não encontrado!", 404
 
-        # 3️⃣ Recupera os dados básicos + novos campos
+        # 3️⃣ Recupera os dados básicos
         data = doc.to_dict()
         nome = data.get('nome')
-        data_emissao = data.get('data_emissao')
-
-        turma_nome = data.get('turma_nome', 'Turma não informada')
-        data_evento = data.get('data_evento', 'Data do evento não informada')
-        nome_treinamento = data.get('nome_treinamento', 'Treinamento não especificado')
-        carga_horaria = data.get('carga_horaria', 'Carga horária não informada')
-
-        logger.info(f"✅ Dados do certificado recuperados: Nome={nome}, Data Emissão={data_emissao}, Turma={turma_nome}, Evento={data_evento}, Treinamento={nome_treinamento}, Carga Horária={carga_horaria}")
-
-        # 4️⃣ Gera a base URL para o QR Code
-        base_url = get_secure_base_url()
 
-        # 5️⃣ Monta novamente o certificado com TODAS as informações
-        certificate = montar_certificado_imagem(
-            nome=nome,
-            data_emissao=data_emissao,
-            codigo=codigo,
-            base_url=base_url,
-            turma_nome=turma_nome,
-            data_evento=data_evento,
-            nome_treinamento=nome_treinamento,
-            carga_horaria=carga_horaria
-        )
+        # 4️⃣ Busca o PNG pronto no armazém de artefatos
+        artefato = obter_artefato(codigo, "png", data, get_secure_base_url())
 
-        if not certificate:
+        if not artefato:
             logger.error("❌ Falha ao montar o certificado para download!")
             return "❌ Erro ao gerar o certificado!", 500
 
-        # 6️⃣ Salva o certificado em memória (buffer)
-        img_io = io.BytesIO()
-        certificate.save(img_io, 'PNG')
-        img_io.seek(0)
-
-        # 7️⃣ Prepara o nome do arquivo
+        # 5️⃣ Prepara o nome do arquivo
         filename = f"{nome.replace(' ', '_')}_certificado.png"
-        logger.info(f"✅ Certificado pronto para download: {filename}")
+        logger.debug("✅ Certificado pronto para download: %s", filename)
 
-        # 8️⃣ Retorna o arquivo para o usuário
-        return send_file(
-            img_io,
-            mimetype='image/png',
-            as_attachment=True,
-            download_name=filename
-        )
+        # 6️⃣ Retorna o arquivo para o usuário (com suporte a Range e cache condicional)
+        return servir_artefato(artefato, download_name=filename)
 
+    except RenderPoolSaturado:
+        raise
     except Exception as e:
-        logger.error(f"❌ Erro ao preparar download do certificado {codigo}: {e}")
+        logger.error("❌ Erro ao preparar download do certificado %s: %s", codigo, e)
         return "❌ Erro ao preparar o certificado para download!", 500
 
 
+## Card do og:image: rota leve, sem Firestore quando o card já existe
+@app.route('/og/<codigo>.jpg')
+def card_social(codigo):
+    try:
+        if codigo_descartado(codigo):
+            return "❌ Certificado não encontrado!", 404
+
+        artefato = armazem_artefatos.obter(codigo, "social")
+        # A página de conquista põe a revisão (renderizado_em, em ms) na URL: card
+        # guardado antes dela é de antes da reemissão da turma
+        revisao = request.args.get("v", type=int)
+        if artefato and revisao and artefato.modificado.timestamp() * 1000 < revisao:
+            artefato = None
+        registrar_cache("artefatos", artefato is not None)
+
+        if not artefato:
+            doc = buscar_certificado(codigo)
+            if doc is None or not doc.exists:
+                return "❌ Certificado não encontrado!", 404
+            artefato = obter_artefato(codigo, "social", doc.to_dict(), get_secure_base_url())
+
+        if not artefato:
+            return "❌ Erro ao gerar o card!", 500
+
+        # Cache longo: crawlers e CDNs reaproveitam o card por dias
+        return servir_artefato(artefato, max_age=CARD_SOCIAL_MAX_AGE)
+
+    except RenderPoolSaturado:
+        raise
+    except Exception as e:
+        logger.error("❌ Erro ao servir o card social do certificado %s: %s", codigo, e)
+        return "❌ Erro ao gerar o card!", 500
+
+
 @app.route('/favicon.ico')
 def favicon():
     return "", 204
@@ -1278,7 +5331,7 @@ def listar_certificados():
         """
 
     except Exception as e:
-        print(f"❌ Erro ao listar certificados: {e}")
+        logger.error("❌ Erro ao listar certificados: %s", e)
         return f"❌ Erro ao listar certificados: {e}", 500
 
 ##### Turmas
@@ -1297,6 +5350,8 @@ def criar_turma():
         nome_cliente = request.form.get('nome_cliente')
         nome_treinamento = request.form.get('nome_treinamento')
         carga_horaria = request.form.get('carga_horaria')
+        template_id = request.form.get('template_id')
+        idioma = idioma_valido(request.form.get('idioma'))
 
         # ✅ Valida se os campos obrigatórios estão preenchidos
         if not nome or not data_evento or not nome_cliente or not nome_treinamento or not carga_horaria:
@@ -1304,19 +5359,23 @@ def criar_turma():
 
         try:
             turma_id = str(uuid.uuid4())[:16]  # ID único da turma
+            # A turma fica presa à versão atual do template; versões novas valem para turmas novas
+            template_id, template_versao, _ = registro_templates.resolver(template_id)
 
             # ✅ Salva no Firestore na coleção "turmas"
-            doc_ref = db.collection("turmas").document(turma_id)
-            doc_ref.set({
+            gravar_documento("turmas", turma_id, {
                 "id": turma_id,
                 "nome": nome,
                 "data_evento": data_evento,
                 "nome_cliente": nome_cliente,
                 "nome_treinamento": nome_treinamento,
-                "carga_horaria": carga_horaria
+                "carga_horaria": carga_horaria,
+                "template_id": template_id,
+                "template_versao": template_versao,
+                "idioma": idioma
             })
 
-            print(f"✅ Turma criada: {nome} - {data_evento} (ID: {turma_id}) | Carga horária: {carga_horaria}")
+            logger.info("✅ Turma criada: %s - %s (ID: %s) | Carga horária: %s", nome, data_evento, turma_id, carga_horaria)
 
             return f'''
             <html>
@@ -1331,6 +5390,8 @@ def criar_turma():
                 <p><strong>Cliente:</strong> {nome_cliente}</p>
                 <p><strong>Treinamento:</strong> {nome_treinamento}</p>
                 <p><strong>Carga Horária:</strong> {carga_horaria} horas</p>
+                <p><strong>Template:</strong> {template_id} (versão {template_versao})</p>
+                <p><strong>Idioma:</strong> {IDIOMAS[idioma]["nome"]}</p>
                 <p><strong>ID da Turma:</strong> {turma_id}</p>
                 <br>
                 <a href="/turmas/criar">➕ Criar Nova Turma</a><br>
@@ -1341,10 +5402,15 @@ def criar_turma():
             '''
 
         except Exception as e:
-            print(f"❌ Erro ao criar turma: {e}")
+            logger.error("❌ Erro ao criar turma: %s", e)
             return f"❌ Erro ao criar turma: {e}", 500
 
     # Se for GET, exibe o formulário com o novo campo de carga horária
+    opcoes_template = "".join(
+        f'<option value="{html.escape(template_id)}"{" selected" if template_id == registro_templates.padrao else ""}>'
+        f'{html.escape(nome)} (versão {versao})</option>'
+        for template_id, nome, versao in registro_templates.listar()
+    )
     return f'''
     <html>
     <head>
@@ -1369,6 +5435,16 @@ def criar_turma():
             <label for="carga_horaria">Carga Horária (horas):</label><br>
             <input type="number" id="carga_horaria" name="carga_horaria" min="1" required><br><br>
 
+            <label for="template_id">Template do Certificado:</label><br>
+            <select id="template_id" name="template_id">
+                {opcoes_template}
+            </select><br><br>
+
+            <label for="idioma">Idioma do Certificado:</label><br>
+            <select id="idioma" name="idioma">
+                {opcoes_idioma(IDIOMA_PADRAO)}
+            </select><br><br>
+
             <button type="submit">Criar Turma</button>
         </form>
         <br>
@@ -1415,6 +5491,10 @@ def listar_turmas():
                     <td>{turma['nome_cliente']}</td>
                     <td>{turma['nome_treinamento']}</td>
                     <td>{turma['carga_horaria']} horas</td>
+                    <td>
+                        <a href="/turmas/{turma['id']}/certificados.zip">📦 Baixar</a>
+                        <a href="/turmas/{turma['id']}/corrigir">✏️ Corrigir</a>
+                    </td>
                 </tr>
             """
 
@@ -1454,6 +5534,7 @@ def listar_turmas():
                     <th>Cliente</th>
                     <th>Treinamento</th>
                     <th>Carga Horária</th> <!-- ✅ Nova coluna -->
+                    <th></th>
                 </tr>
                 {table_rows}
             </table>
@@ -1465,22 +5546,167 @@ def listar_turmas():
         '''
 
     except Exception as e:
-        print(f"❌ Erro ao listar turmas: {e}")
+        logger.error("❌ Erro ao listar turmas: %s", e)
         return f"❌ Erro ao listar turmas: {e}", 500
 
 
+@app.route('/turmas/<turma_id>/certificados.zip')
+def baixar_certificados_turma(turma_id):
+    global db
+    if db is None:
+        return "❌ Firestore não inicializado!", 500
+
+    if not buscar_documento("turmas", turma_id).exists:
+        return f"❌ Turma com código {html.escape(turma_id)} não encontrada.", 404
+
+    try:
+        caminho = arquivo_turma(turma_id, get_secure_base_url())
+    except Exception as e:
+        logger.error("❌ Erro ao montar o ZIP da turma %s: %s", turma_id, e)
+        return "❌ Erro ao montar o arquivo da turma.", 500
+
+    return send_file(
+        caminho,
+        mimetype="application/zip",
+        as_attachment=True,
+        download_name=f"certificados_{turma_id}.zip",
+        conditional=True,
+        max_age=0,
+    )
+
+
+@app.route('/turmas/<turma_id>/corrigir', methods=['GET', 'POST'])
+def corrigir_turma(turma_id):
+    global db
+    if db is None:
+        return "❌ Firestore não inicializado!", 500
+
+    base_url = get_secure_base_url()
+    turma_doc = buscar_documento("turmas", turma_id)
+    if not turma_doc.exists:
+        return f"❌ Turma com código {html.escape(turma_id)} não encontrada.", 404
+    turma = turma_doc.to_dict()
+
+    if request.method == 'POST':
+        campos = {campo: request.form.get(campo) for campo in ("nome", "data_evento", "nome_cliente", "nome_treinamento", "carga_horaria")}
+        if not all(campos.values()):
+            return "❌ Todos os campos são obrigatórios: Nome da Turma, Data do Evento, Nome do Cliente, Nome do Treinamento e Carga Horária."
+        campos["idioma"] = idioma_valido(request.form.get("idioma"))
+
+        atualizar_documento("turmas", turma_id, campos)
+        logger.info("✏️ Turma %s corrigida, reemitindo os certificados", turma_id)
+
+        def progresso():
+            yield f'''
+            <html>
+            <head>
+                <title>Reemissão da Turma</title>
+                <link rel="stylesheet" href="{base_url}/static/styles.css">
+            </head>
+            <body>
+                <h1>🔁 Reemitindo os certificados de {html.escape(campos["nome"])}</h1>
+            '''
+            try:
+                for estado in reemitir_turma(turma_id, base_url):
+                    if estado["concluido"]:
+                        yield (
+                            f"<p>✅ {estado['feitos'] - estado['falhas']} de {estado['total']} certificado(s) reemitido(s) "
+                            f"({estado['certificados_por_s']} certificados/s), {estado['falhas']} falha(s).</p>"
+                        )
+                    else:
+                        yield f"<p>⏳ {estado['feitos']}/{estado['total']} ({estado['certificados_por_s']} certificados/s)</p>\n"
+            except Exception as e:
+                logger.error("❌ Erro ao reemitir a turma %s: %s", turma_id, e)
+                yield f"<p>❌ Erro ao reemitir os certificados: {html.escape(str(e))}. Envie o formulário de novo para retomar.</p>"
+            yield '''
+                <a href="/turmas">📋 Ver Turmas Criadas</a><br>
+                <a href="/">🔙 Voltar ao Início</a>
+            </body>
+            </html>
+            '''
+
+        return Response(stream_with_context(progresso()), mimetype="text/html")
+
+    def valor(campo):
+        return html.escape(str(turma.get(campo, "")), quote=True)
+
+    return f'''
+    <html>
+    <head>
+        <title>Corrigir Turma</title>
+        <link rel="stylesheet" href="{base_url}/static/styles.css">
+    </head>
+    <body>
+        <h1>✏️ Corrigir Turma</h1>
+        <p>Os certificados já emitidos nesta turma serão atualizados e renderizados de novo, mantendo os códigos.</p>
+        <form method="post">
+            <label for="nome">Nome da Turma:</label><br>
+            <input type="text" id="nome" name="nome" value="{valor('nome')}" required><br><br>
+
+            <label for="data_evento">Data do Evento:</label><br>
+            <input type="date" id="data_evento" name="data_evento" value="{valor('data_evento')}" required><br><br>
+
+            <label for="nome_cliente">Nome do Cliente:</label><br>
+            <input type="text" id="nome_cliente" name="nome_cliente" value="{valor('nome_cliente')}" required><br><br>
+
+            <label for="nome_treinamento">Nome do Treinamento:</label><br>
+            <input type="text" id="nome_treinamento" name="nome_treinamento" value="{valor('nome_treinamento')}" required><br><br>
+
+            <label for="carga_horaria">Carga Horária (horas):</label><br>
+            <input type="number" id="carga_horaria" name="carga_horaria" min="1" value="{valor('carga_horaria')}" required><br><br>
+
+            <label for="idioma">Idioma do Certificado:</label><br>
+            <select id="idioma" name="idioma">
+                {opcoes_idioma(idioma_valido(turma.get('idioma')))}
+            </select><br><br>
+
+            <button type="submit">Salvar e Reemitir Certificados</button>
+        </form>
+        <br>
+        <a href="/turmas">📋 Ver Turmas Criadas</a><br>
+        <a href="/">🔙 Voltar ao Início</a>
+    </body>
+    </html>
+    '''
+
+
+## Situação dos e-mails enviados para a turma (um registro por mensagem)
+@app.route('/turmas/<turma_id>/envios')
+def envios_turma(turma_id):
+    if db is None:
+        return jsonify({"erro": "Firestore não inicializado"}), 500
+
+    consulta = db.collection("envios").where(filter=firestore.FieldFilter("turma_id", "==", turma_id))
+    envios = []
+    for doc in consulta.stream():
+        dados = doc.to_dict()
+        envios.append({
+            "email": dados.get("email"),
+            "nome": dados.get("nome"),
+            "codigo": dados.get("codigo"),
+            "status": dados.get("status"),
+            "tentativas": dados.get("tentativas", 0),
+            "erro": dados.get("erro"),
+            "atualizado_em": dados["atualizado_em"].isoformat() if dados.get("atualizado_em") else None,
+        })
+    envios.sort(key=lambda envio: (envio["nome"] or "").casefold())
+    return jsonify({
+        "turma_id": turma_id,
+        "por_status": dict(collections.Counter(envio["status"] for envio in envios)),
+        "envios": envios,
+    })
+
 @app.route('/conquista/<codigo>')
 def conquista(codigo):
     global db
 
-    logger.info(f"🔍 Acessando página de conquista do certificado {codigo}")
+    logger.debug("🔍 Acessando página de conquista do certificado %s", codigo)
 
     # 1️⃣ Busca o certificado no Firestore
-    doc_ref = db.collection("certificados").document(codigo)
-    doc = doc_ref.get()
+    doc = buscar_certificado(codigo)
 
-    if not doc.exists:
-        logger.warning(f"❌ Certificado não encontrado: {codigo}")
+    if doc is None or not doc.exists:
+        logger.warning("❌ Certificado não encontrado: %s", codigo)
         return "❌ Certificado não encontrado!", 404
 
     # 2️⃣ Recupera todos os dados necessários
@@ -1493,13 +5719,15 @@ def conquista(codigo):
     nome_treinamento = data.get('nome_treinamento', "Treinamento não especificado")
     carga_horaria = data.get('carga_horaria', "Carga horária não informada")
 
-    logger.info(f"✅ Dados do certificado recuperados para a conquista:")
-    logger.info(f"Nome: {nome} | Emissão: {data_emissao} | Turma: {turma_nome} | Evento: {data_evento} | Treinamento: {nome_treinamento} | Carga horária: {carga_horaria}")
+    logger.debug("✅ Dados do certificado recuperados para a conquista:")
+    logger.debug("Nome: %s | Emissão: %s | Turma: %s | Evento: %s | Treinamento: %s | Carga horária: %s", nome, data_emissao, turma_nome, data_evento, nome_treinamento, carga_horaria)
 
     # 3️⃣ Informações para o Open Graph (LinkedIn e redes)
     base_url = get_secure_base_url()
 
-    image_url = f"{base_url}/download_cert/{codigo}"
+    image_url = f"{base_url}/og/{codigo}.jpg"
+    if data.get("renderizado_em"):
+        image_url += f"?v={int(data['renderizado_em'].timestamp() * 1000)}"
 
     # 4️⃣ Título e descrição para redes sociais com mais informações
     titulo = f"{nome} conquistou seu certificado no treinamento {nome_treinamento}!"
@@ -1523,6 +5751,11 @@ def conquista(codigo):
         <meta property="og:title" content="{titulo}" />
         <meta property="og:description" content="{descricao}" />
         <meta property="og:image" content="{image_url}" />
+        <meta property="og:image:type" content="image/jpeg" />
+        <meta property="og:image:width" content="{CARD_SOCIAL_TAMANHO[0]}" />
+        <meta property="og:image:height" content="{CARD_SOCIAL_TAMANHO[1]}" />
+        <meta property="og:image:alt" content="Certificado de {nome} - {nome_treinamento}" />
+        <meta name="twitter:card" content="summary_large_image" />
         <meta property="og:type" content="website" />
         <meta property="og:url" content="{base_url}/conquista/{codigo}" />
 
@@ -1539,7 +5772,7 @@ def conquista(codigo):
             <h1>🎉 {titulo}</h1>
             <p>{descricao}</p>
 
-            <img src="{image_url}" alt="Certificado de {nome}" style="width:100%; max-width:600px; margin: 20px auto; border-radius: 10px;">
+            <img src="{base_url}/certificado/{codigo}/web" alt="Certificado de {nome}" style="width:100%; max-width:600px; margin: 20px auto; border-radius: 10px;">
 
             <div class="details-section" style="margin-top: 30px;">
                 <h2>📄 Detalhes do Certificado</h2>
@@ -1575,6 +5808,66 @@ def conquista(codigo):
     </body>
     </html>
     '''
+@app.route('/status/render')
+def status_render():
+    return jsonify(get_render_pool().stats())
+
+
+@app.route('/status/fila')
+def status_fila():
+    if fila_eventos is None:
+        return jsonify({"erro": "Fila de eventos desativada"}), 404
+    return jsonify({**fila_eventos.estatisticas(), **consumidores_fila.stats()})
+
+
+@app.before_request
+def iniciar_cronometro():
+    g.inicio_requisicao = time.perf_counter()
+
+
+@app.after_request
+def registrar_duracao_requisicao(response):
+    inicio = g.pop("inicio_requisicao", None)
+    if inicio is not None:
+        metricas.observar(
+            "http_requisicao_segundos",
+            time.perf_counter() - inicio,
+            rota=rota_atual(),
+            metodo=request.method,
+            status=response.status_code
+        )
+    return response
+
+
+@app.route('/metrics')
+def exportar_metricas():
+    # Gauges do pool são lidos na hora da coleta
+    if render_pool is not None:
+        stats = render_pool.stats()
+        metricas.definir("render_fila_profundidade", stats["fila_interativa"], prioridade="interativa")
+        metricas.definir("render_fila_profundidade", stats["fila_lote"], prioridade="lote")
+        metricas.definir("render_em_execucao", stats["em_execucao"])
+    if fila_eventos is not None:
+        stats = fila_eventos.estatisticas()
+        metricas.definir("fila_profundidade", stats["pendentes"], status="pendente")
+        metricas.definir("fila_profundidade", stats["processando"], status="processando")
+        metricas.definir("fila_atraso_atual_segundos", stats["atraso_s"])
+
+    return Response(metricas.exportar(), mimetype="text/plain; version=0.0.4")
+
+
+@app.errorhandler(RenderPoolSaturado)
+def render_pool_saturado(e):
+    logger.warning("⏳ Pool de renderização saturado: %s (retry em %ss)", request.path, e.retry_after)
+    if request.path.startswith("/api/"):
+        return jsonify({"erro": "Fila de renderização cheia", "retry_after": e.retry_after}), 503, {"Retry-After": str(e.retry_after)}
+    return (
+        "⏳ Muitos certificados sendo gerados no momento. Tente novamente em instantes.",
+        503,
+        {"Retry-After": str(e.retry_after)}
+    )
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     base_url = get_secure_base_url()  # já existe no seu código!
@@ -1598,8 +5891,36 @@ def page_not_found(e):
 
 
 
+def inicializar():
+    """Efeitos colaterais do processo principal: cliente do Firestore, sincronização do
+    filtro de códigos e fila de eventos do LMS (com os consumidores, se houver
+    eventos pendentes).
+
+    Fica fora do import porque os workers do pool de renderização (forkserver/spawn)
+    importam este módulo de novo. Quem importa o app para servir ou medir (WSGI,
+    benchmark.py) chama inicializar() uma vez antes de atender.
+    """
+    global fila_eventos, consumidores_fila
+    if db is not None:
+        return
+    inicializar_firestore()
+    if db is None:
+        return
+
+    if FILTRO_CODIGOS:
+        filtro_codigos.iniciar()
+        atexit.register(filtro_codigos.salvar_snapshot)
+
+    if FILA_BACKEND == "sqlite":
+        fila_eventos = FilaSQLite(FILA_ARQUIVO)
+        consumidores_fila = ConsumidoresFila(fila_eventos, FILA_CONSUMIDORES)
+        # Eventos que ficaram na fila quando a instância caiu voltam a ser consumidos
+        estatisticas = fila_eventos.estatisticas()
+        if estatisticas["pendentes"] or estatisticas["processando"]:
+            consumidores_fila.iniciar()
+
+
 if __name__ == '__main__':
-    print("Rotas disponíveis:")
-    for rule in app.url_map.iter_rules():
-        print(rule)
+    inicializar()
+    logger.info("Rotas disponíveis: %s", ", ".join(str(rule) for rule in app.url_map.iter_rules()))
     app.run(host='0.0.0.0', port=8080, threaded=True)
\ No newline at end of file
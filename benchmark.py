@@ -0,0 +1,315 @@
+"""Benchmarks de renderização, codificação PNG e emissão em lote.
+
+Uso:
+    python benchmark.py                          # roda tudo e imprime JSON
+    python benchmark.py --saida resultado.json   # grava o resultado
+    python benchmark.py --salvar-baseline        # grava benchmark_baseline.json
+    python benchmark.py --linhas 10,100          # lote sem a rodada de 1000 linhas
+
+Se existir um baseline (--baseline, padrão benchmark_baseline.json) os resultados
+são comparados com ele e o processo sai com código 1 quando algum p50 piora
+mais que a tolerância (--tolerancia, padrão 0.25 = 25%).
+
+O app é importado com FIRESTORE_BACKEND=memoria (e inicializado com inicializar()),
+então nada toca o Firestore real.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("FIRESTORE_BACKEND", "memoria")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+BASELINE_PADRAO = "benchmark_baseline.json"
+BASE_URL = "https://certificados.exemplo.com"
+
+DADOS_CERTIFICADO = {
+    "data_emissao": "10 de março de 2025",
+    "codigo": "0123456789abcdef",
+    "base_url": BASE_URL,
+    "turma_nome": "Turma Benchmark",
+    "data_evento": "2025-03-10",
+    "nome_treinamento": "Treinamento de Desempenho",
+    "carga_horaria": "8",
+}
+
+
+def _pico_rss_mb():
+    # ru_maxrss é em KB no Linux; inclui os workers do pool via RUSAGE_CHILDREN
+    proprio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    filhos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(proprio, filhos) / 1024, 1)
+
+
+def _percentil(amostras, p):
+    ordenadas = sorted(amostras)
+    k = (len(ordenadas) - 1) * p
+    baixo = int(k)
+    alto = min(baixo + 1, len(ordenadas) - 1)
+    return ordenadas[baixo] + (ordenadas[alto] - ordenadas[baixo]) * (k - baixo)
+
+
+def _resumo(amostras, operacoes_por_amostra=1, **extra):
+    total = sum(amostras)
+    resultado = {
+        "amostras": len(amostras),
+        "ops_s": round(operacoes_por_amostra * len(amostras) / total, 3) if total else None,
+        "p50_ms": round(_percentil(amostras, 0.50) * 1000, 3),
+        "p99_ms": round(_percentil(amostras, 0.99) * 1000, 3),
+        "media_ms": round(statistics.fmean(amostras) * 1000, 3),
+        "pico_rss_mb": _pico_rss_mb(),
+    }
+    resultado.update(extra)
+    return resultado
+
+
+def _cronometrar(fn, repeticoes, aquecimento=1):
+    for _ in range(aquecimento):
+        fn()
+    amostras = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        fn()
+        amostras.append(time.perf_counter() - inicio)
+    return amostras
+
+
+def _nomes(qtd, semente=42):
+    rnd = random.Random(semente)
+    primeiros = ["Ana", "Bruno", "Carla", "Diego", "Eduarda", "Felipe", "Gabriela", "Heitor", "João", "Márcia"]
+    sobrenomes = ["Silva", "Souza", "Oliveira", "Gurgel", "Albuquerque de Medeiros", "Conceição", "Pereira"]
+    return [f"{rnd.choice(primeiros)} {rnd.choice(sobrenomes)}" for _ in range(qtd)]
+
+
+### Benchmarks
+
+def bench_render_frio(amostras):
+    # Cada amostra roda num processo novo, então nenhum asset está carregado
+    tempos = []
+    for _ in range(amostras):
+        saida = subprocess.run(
+            [sys.executable, __file__, "--_amostra-fria"],
+            capture_output=True, text=True, check=True, env=os.environ.copy()
+        )
+        tempos.append(float(saida.stdout.strip().splitlines()[-1]))
+    return _resumo(tempos)
+
+
+def _amostra_fria():
+    import app
+    inicio = time.perf_counter()
+    app.montar_certificado_imagem(nome="Maria Silva", **DADOS_CERTIFICADO)
+    print(time.perf_counter() - inicio)
+
+
+def bench_render_quente(app, repeticoes):
+    nomes = iter(_nomes(repeticoes + 1) * 2)
+    return _resumo(_cronometrar(
+        lambda: app.montar_certificado_imagem(nome=next(nomes), **DADOS_CERTIFICADO),
+        repeticoes
+    ))
+
+
+def bench_qr_code(app, repeticoes):
+    return _resumo(_cronometrar(lambda: app.gerar_qr_code("0123456789abcdef", BASE_URL), repeticoes))
+
+
+def bench_png_encode(app, repeticoes):
+    certificate = app.montar_certificado_imagem(nome="Maria Silva", **DADOS_CERTIFICADO)
+    resultados = {}
+    configuracoes = {
+        "compress_level_1": {"compress_level": 1},
+        "compress_level_6": {"compress_level": 6},
+        "compress_level_9": {"compress_level": 9},
+        "optimize": {"optimize": True},
+    }
+    for nome, opcoes in configuracoes.items():
+        tamanho = {}
+
+        def codificar():
+            buffer = io.BytesIO()
+            certificate.save(buffer, "PNG", **opcoes)
+            tamanho["bytes"] = buffer.tell()
+
+        amostras = _cronometrar(codificar, repeticoes)
+        resultados[nome] = _resumo(amostras, bytes=tamanho["bytes"])
+    return resultados
+
+
+def bench_lote(app, linhas):
+    turma_id = "turma-benchmark"
+    app.db.collection("turmas").document(turma_id).set({
+        "id": turma_id,
+        "nome": DADOS_CERTIFICADO["turma_nome"],
+        "data_evento": DADOS_CERTIFICADO["data_evento"],
+        "nome_treinamento": DADOS_CERTIFICADO["nome_treinamento"],
+        "carga_horaria": DADOS_CERTIFICADO["carga_horaria"],
+    })
+
+    resultados = {}
+    for qtd in linhas:
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, encoding="utf-8") as f:
+            f.write("name\n")
+            for i, nome in enumerate(_nomes(qtd)):
+                f.write(f"{nome} {i}\n")
+            csv_path = f.name
+        try:
+            inicio = time.perf_counter()
+            zip_path = app.generate_certificates(csv_path, BASE_URL, turma_id)
+            duracao = time.perf_counter() - inicio
+        finally:
+            os.unlink(csv_path)
+
+        if not zip_path:
+            raise RuntimeError(f"generate_certificates falhou com {qtd} linhas")
+        resultados[f"{qtd}_linhas"] = _resumo([duracao], operacoes_por_amostra=qtd)
+    return resultados
+
+
+def bench_rotas_leitura(app, repeticoes):
+    codigo = app.gerar_codigo()
+    app.save_certificate_to_firestore(
+        nome="Maria Silva",
+        data_emissao=DADOS_CERTIFICADO["data_emissao"],
+        codigo=codigo,
+        turma_nome=DADOS_CERTIFICADO["turma_nome"],
+        data_evento=DADOS_CERTIFICADO["data_evento"],
+        nome_treinamento=DADOS_CERTIFICADO["nome_treinamento"],
+        carga_horaria=DADOS_CERTIFICADO["carga_horaria"],
+    )
+
+    client = app.app.test_client()
+    rotas = {
+        "validar_form": "/validar",
+        "validar": f"/validar?codigo={codigo}",
+        "certificado": f"/certificado/{codigo}",
+        "download_cert": f"/download_cert/{codigo}",
+        "conquista": f"/conquista/{codigo}",
+    }
+
+    resultados = {}
+    for nome, rota in rotas.items():
+        def requisitar():
+            resposta = client.get(rota, headers={"Host": "certificados.exemplo.com"})
+            if resposta.status_code != 200:
+                raise RuntimeError(f"{rota} respondeu {resposta.status_code}")
+            resposta.get_data()
+
+        resultados[nome] = _resumo(_cronometrar(requisitar, repeticoes))
+    return resultados
+
+
+### Baseline
+
+def _achatar(resultados, prefixo=""):
+    planos = {}
+    for chave, valor in resultados.items():
+        nome = f"{prefixo}{chave}"
+        if isinstance(valor, dict) and "p50_ms" in valor:
+            planos[nome] = valor
+        elif isinstance(valor, dict):
+            planos.update(_achatar(valor, prefixo=f"{nome}."))
+    return planos
+
+
+def comparar_com_baseline(resultados, baseline, tolerancia):
+    atuais = _achatar(resultados["benchmarks"])
+    anteriores = _achatar(baseline["benchmarks"])
+    regressoes = []
+    for nome, atual in atuais.items():
+        anterior = anteriores.get(nome)
+        if not anterior or not anterior.get("p50_ms"):
+            continue
+        variacao = (atual["p50_ms"] - anterior["p50_ms"]) / anterior["p50_ms"]
+        atual["variacao_p50"] = round(variacao, 3)
+        if variacao > tolerancia:
+            regressoes.append({
+                "benchmark": nome,
+                "p50_ms_baseline": anterior["p50_ms"],
+                "p50_ms_atual": atual["p50_ms"],
+                "variacao": round(variacao, 3),
+            })
+    return regressoes
+
+
+def _ambiente(app):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+
+    import PIL
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "render_workers": app.RENDER_WORKERS,
+        "commit": commit,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticoes", type=int, default=10, help="amostras por benchmark em processo")
+    parser.add_argument("--amostras-frias", type=int, default=3, help="processos novos para o render frio")
+    parser.add_argument("--linhas", default="10,100,1000", help="tamanhos de lote, separados por vírgula")
+    parser.add_argument("--saida", help="arquivo para gravar o JSON de resultados")
+    parser.add_argument("--baseline", default=BASELINE_PADRAO)
+    parser.add_argument("--salvar-baseline", action="store_true", help="grava os resultados como novo baseline")
+    parser.add_argument("--tolerancia", type=float, default=0.25)
+    parser.add_argument("--_amostra-fria", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args._amostra_fria:
+        _amostra_fria()
+        return 0
+
+    import app
+    app.inicializar()
+
+    linhas = [int(n) for n in args.linhas.split(",") if n.strip()]
+    benchmarks = {
+        "render_frio": bench_render_frio(args.amostras_frias),
+        "render_quente": bench_render_quente(app, args.repeticoes),
+        "qr_code": bench_qr_code(app, args.repeticoes * 10),
+        "png_encode": bench_png_encode(app, max(3, args.repeticoes // 2)),
+        "lote": bench_lote(app, linhas),
+        "rotas_leitura": bench_rotas_leitura(app, args.repeticoes),
+    }
+    resultados = {"ambiente": _ambiente(app), "benchmarks": benchmarks}
+
+    codigo_saida = 0
+    if os.path.exists(args.baseline) and not args.salvar_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressoes = comparar_com_baseline(resultados, json.load(f), args.tolerancia)
+        resultados["regressoes"] = regressoes
+        if regressoes:
+            codigo_saida = 1
+
+    texto = json.dumps(resultados, indent=2, ensure_ascii=False)
+    print(texto)
+
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(texto)
+    if args.salvar_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(texto)
+
+    return codigo_saida
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""Teste de carga com os picos reais do gerador de certificados.
+
+Cenários:
+    turma  - uma turma inteira emitindo o próprio certificado em /aluno logo
+             após o fim da aula (chegadas crescendo até o pico e caindo).
+    viral  - um compartilhamento no LinkedIn viralizando: muitas visitas em
+             /conquista/<codigo> e os crawlers buscando o card do og:image em
+             /og/<codigo>.jpg para montar o preview.
+
+Suba uma instância local com o Firestore em memória (ou com o emulador,
+definindo FIRESTORE_EMULATOR_HOST) e aponte o teste para ela:
+
+    FIRESTORE_BACKEND=memoria python app.py
+    python loadtest.py --url http://localhost:8080 --cenario turma
+    python loadtest.py --url http://localhost:8080 --cenario viral --escala 2 --saida viral.json
+
+O relatório (JSON) traz vazão, percentis de latência e taxa de erro por rota,
+com respostas 503 (pool de renderização saturado) contadas à parte.
+"""
+import argparse
+import http.client
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+# Cada fase tem duração (s), taxa de chegada (requisições/s) e a mistura de
+# requisições (peso por tipo). A taxa é multiplicada por --escala.
+CENARIOS = {
+    "turma": {
+        "descricao": "Turma de ~60 alunos emitindo o certificado nos minutos após a aula",
+        "preparo": {"certificados": 0},
+        "fases": [
+            {"duracao": 20, "taxa": 0.5, "mistura": {"aluno_form": 1, "aluno_emitir": 2}},
+            {"duracao": 40, "taxa": 2.0, "mistura": {"aluno_form": 1, "aluno_emitir": 3, "validar": 1}},
+            {"duracao": 20, "taxa": 0.5, "mistura": {"aluno_emitir": 1, "download_cert": 1}},
+        ],
+    },
+    "viral": {
+        "descricao": "Compartilhamento viral: páginas de conquista e crawlers buscando a imagem",
+        "preparo": {"certificados": 5},
+        "fases": [
+            {"duracao": 15, "taxa": 2.0, "mistura": {"conquista": 3, "og_card": 1}},
+            {"duracao": 45, "taxa": 10.0, "mistura": {"conquista": 6, "og_card": 3, "validar": 1}},
+            {"duracao": 15, "taxa": 3.0, "mistura": {"conquista": 3, "og_card": 1}},
+        ],
+    },
+}
+
+NOMES = ["Ana", "Bruno", "Carla", "Diego", "Eduarda", "Felipe", "Gabriela", "Heitor", "João", "Márcia"]
+SOBRENOMES = ["Silva", "Souza", "Oliveira", "Gurgel", "Pereira", "Conceição"]
+
+
+class Cliente:
+    """Uma conexão HTTP por thread, reaproveitada entre requisições."""
+
+    def __init__(self, url, timeout):
+        partes = urllib.parse.urlsplit(url)
+        self.https = partes.scheme == "https"
+        self.host = partes.netloc
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conexao(self):
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is None:
+            classe = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conexao = self._local.conexao = classe(self.host, timeout=self.timeout)
+        return conexao
+
+    def requisitar(self, metodo, caminho, formulario=None):
+        corpo = urllib.parse.urlencode(formulario) if formulario else None
+        cabecalhos = {"Content-Type": "application/x-www-form-urlencoded"} if corpo else {}
+        try:
+            conexao = self._conexao()
+            conexao.request(metodo, caminho, body=corpo, headers=cabecalhos)
+            resposta = conexao.getresponse()
+            return resposta.status, resposta.read()
+        except Exception:
+            self._local.conexao = None
+            raise
+
+
+class Estatisticas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = {}
+        self.status = {}
+        self.falhas_rede = {}
+
+    def registrar(self, tipo, latencia, status):
+        with self._lock:
+            self.latencias.setdefault(tipo, []).append(latencia)
+            por_status = self.status.setdefault(tipo, {})
+            por_status[status] = por_status.get(status, 0) + 1
+
+    def registrar_falha(self, tipo, latencia):
+        with self._lock:
+            self.latencias.setdefault(tipo, []).append(latencia)
+            self.falhas_rede[tipo] = self.falhas_rede.get(tipo, 0) + 1
+
+
+def _percentil(amostras, p):
+    ordenadas = sorted(amostras)
+    if not ordenadas:
+        return None
+    k = (len(ordenadas) - 1) * p
+    baixo = int(k)
+    alto = min(baixo + 1, len(ordenadas) - 1)
+    return ordenadas[baixo] + (ordenadas[alto] - ordenadas[baixo]) * (k - baixo)
+
+
+def _nome_aleatorio(rnd):
+    return f"{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {rnd.randint(1, 99999)}"
+
+
+### Preparação
+
+def criar_turma(cliente):
+    status, corpo = cliente.requisitar("POST", "/turmas/criar", {
+        "nome": "Turma Teste de Carga",
+        "data_evento": "2025-03-10",
+        "nome_cliente": "Cliente Teste",
+        "nome_treinamento": "Treinamento Teste de Carga",
+        "carga_horaria": "8",
+    })
+    encontrado = re.search(r"ID da Turma:</strong>\s*([\w-]+)", corpo.decode("utf-8", "replace"))
+    if status != 200 or not encontrado:
+        raise RuntimeError(f"Não foi possível criar a turma (HTTP {status})")
+    return encontrado.group(1)
+
+
+def emitir(cliente, turma_id, nome):
+    status, corpo = cliente.requisitar("POST", "/aluno", {"name": nome, "turma_id": turma_id})
+    encontrado = re.search(r"/download_cert/([\w-]+)", corpo.decode("utf-8", "replace"))
+    return status, (encontrado.group(1) if encontrado else None)
+
+
+### Execução
+
+def executar(cliente, cenario, escala, concorrencia, semente):
+    rnd = random.Random(semente)
+    turma_id = criar_turma(cliente)
+
+    codigos = []
+    for _ in range(cenario["preparo"]["certificados"]):
+        status, codigo = emitir(cliente, turma_id, _nome_aleatorio(rnd))
+        if codigo:
+            codigos.append(codigo)
+    codigos_lock = threading.Lock()
+
+    estatisticas = Estatisticas()
+
+    def requisicao(tipo, nome, sorteio):
+        # O sorteio vem do agendador: as threads não consomem o rnd, então a mesma
+        # --semente gera a mesma sequência de requisições
+        with codigos_lock:
+            codigo = codigos[int(sorteio * len(codigos))] if codigos else None
+
+        if tipo in ("conquista", "og_card", "download_cert", "validar") and not codigo:
+            tipo = "aluno_emitir"
+
+        inicio = time.perf_counter()
+        try:
+            if tipo == "aluno_form":
+                status, _ = cliente.requisitar("GET", "/aluno")
+            elif tipo == "aluno_emitir":
+                status, novo = emitir(cliente, turma_id, nome)
+                if novo:
+                    with codigos_lock:
+                        codigos.append(novo)
+            elif tipo == "conquista":
+                status, _ = cliente.requisitar("GET", f"/conquista/{codigo}")
+            elif tipo == "og_card":
+                status, _ = cliente.requisitar("GET", f"/og/{codigo}.jpg")
+            elif tipo == "download_cert":
+                status, _ = cliente.requisitar("GET", f"/download_cert/{codigo}")
+            elif tipo == "validar":
+                status, _ = cliente.requisitar("GET", f"/validar?codigo={codigo}")
+            else:
+                raise ValueError(f"Tipo de requisição desconhecido: {tipo}")
+        except Exception:
+            estatisticas.registrar_falha(tipo, time.perf_counter() - inicio)
+            return
+        estatisticas.registrar(tipo, time.perf_counter() - inicio, status)
+
+    # Chegadas em malha aberta (Poisson): a taxa não cai quando o servidor fica lento
+    inicio_teste = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        for fase in cenario["fases"]:
+            taxa = fase["taxa"] * escala
+            tipos, pesos = zip(*fase["mistura"].items())
+            fim_fase = time.perf_counter() + fase["duracao"]
+            proxima = time.perf_counter()
+            while proxima < fim_fase:
+                espera = proxima - time.perf_counter()
+                if espera > 0:
+                    time.sleep(espera)
+                tipo = rnd.choices(tipos, weights=pesos)[0]
+                executor.submit(requisicao, tipo, _nome_aleatorio(rnd), rnd.random())
+                proxima += rnd.expovariate(taxa)
+    duracao = time.perf_counter() - inicio_teste
+
+    return relatorio(estatisticas, duracao)
+
+
+def relatorio(estatisticas, duracao):
+    rotas = {}
+    total = erros = saturados = 0
+    for tipo, latencias in sorted(estatisticas.latencias.items()):
+        por_status = estatisticas.status.get(tipo, {})
+        falhas_rede = estatisticas.falhas_rede.get(tipo, 0)
+        qtd = len(latencias)
+        qtd_503 = por_status.get(503, 0)
+        qtd_erro = falhas_rede + sum(n for status, n in por_status.items() if status >= 400)
+
+        rotas[tipo] = {
+            "requisicoes": qtd,
+            "vazao_rps": round(qtd / duracao, 3),
+            "p50_ms": round(_percentil(latencias, 0.50) * 1000, 1),
+            "p90_ms": round(_percentil(latencias, 0.90) * 1000, 1),
+            "p99_ms": round(_percentil(latencias, 0.99) * 1000, 1),
+            "max_ms": round(max(latencias) * 1000, 1),
+            "status": {str(k): v for k, v in sorted(por_status.items())},
+            "falhas_rede": falhas_rede,
+            "taxa_erro": round(qtd_erro / qtd, 4) if qtd else 0.0,
+            "taxa_503": round(qtd_503 / qtd, 4) if qtd else 0.0,
+        }
+        total += qtd
+        erros += qtd_erro
+        saturados += qtd_503
+
+    todas = [l for latencias in estatisticas.latencias.values() for l in latencias]
+    return {
+        "duracao_s": round(duracao, 1),
+        "requisicoes": total,
+        "vazao_rps": round(total / duracao, 3) if duracao else 0.0,
+        "p50_ms": round(_percentil(todas, 0.50) * 1000, 1) if todas else None,
+        "p99_ms": round(_percentil(todas, 0.99) * 1000, 1) if todas else None,
+        "taxa_erro": round(erros / total, 4) if total else 0.0,
+        "taxa_503": round(saturados / total, 4) if total else 0.0,
+        "rotas": rotas,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--cenario", choices=sorted(CENARIOS), default="turma")
+    parser.add_argument("--escala", type=float, default=1.0, help="multiplica a taxa de chegada de todas as fases")
+    parser.add_argument("--concorrencia", type=int, default=64, help="máximo de requisições simultâneas")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--saida", help="arquivo para gravar o relatório JSON")
+    args = parser.parse_args()
+
+    cenario = CENARIOS[args.cenario]
+    cliente = Cliente(args.url, args.timeout)
+    resultado = {
+        "cenario": args.cenario,
+        "descricao": cenario["descricao"],
+        "url": args.url,
+        "escala": args.escala,
+        "concorrencia": args.concorrencia,
+        "resultado": executar(cliente, cenario, args.escala, args.concorrencia, args.semente),
+    }
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(texto)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())